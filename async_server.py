@@ -0,0 +1,494 @@
+"""
+Asyncio engine for the Pong server.
+
+Runs accept, per-client I/O and the physics ticks of every game as
+coroutines on a single event loop, with countdowns as timers of that loop,
+instead of one OS thread per client and two per game. Matchmaking and rematch semantics are the same as the
+threaded engine in server.py.
+"""
+
+import asyncio
+import socket
+import time
+from random import randint
+
+import backpressure
+import metrics
+import protocol
+import ratings
+from functools import partial
+from matchmaking import Matchmaker
+from sessions import Sessions, Session
+from spectators import Stands, Spectator
+from server import (Game, Player, UdpChannel, FixedTimestep, timed_update, start_countdown, check_hello,
+                    read_join, leave_match, expire_session, evict, TICK_RATE, SEND_RATE)
+
+async def parked(park) -> bool:
+    """Awaits the wake up registered by `park` (Game.park, Game.watch, BatchPhysics.park). False if it did not park"""
+    wake = asyncio.get_running_loop().create_future()
+    if not park(lambda: wake.done() or wake.set_result(None)):
+        return False
+    await wake
+    return True
+
+async def game_logic_task(game: Game):
+    """
+    Control the movement of the ball and check who won, at a fixed tick rate.
+    Sleeps without ticking whenever the ball is not in play.
+    """
+    print(f"Starting game {game.game_id} logic")
+
+    timestep = FixedTimestep(game.tick_rate)
+    running = True
+    while running:
+        if await parked(game.park):
+            game.skip_ticks(timestep.skip())
+        for _ in range(timestep.advance()):
+            running = timed_update(game, timestep.dt)
+            if not running:
+                break
+        await asyncio.sleep(timestep.time_to_next_tick())
+    print(f"Closing game {game.game_id} logic")
+
+async def batch_logic_task(physics):
+    """
+    Steps every game attached to a batch_physics.BatchPhysics, replacing the
+    per-game logic tasks. Sleeps without ticking while no ball is in play.
+    """
+    print("Starting batch physics")
+
+    timestep = FixedTimestep(physics.tick_rate)
+    while True:
+        if await parked(physics.park):
+            physics.skip_ticks(timestep.skip())
+        for _ in range(timestep.advance()):
+            physics.step(timestep.dt)
+        await asyncio.sleep(timestep.time_to_next_tick())
+
+class DatagramHandler(asyncio.DatagramProtocol):
+    """Feeds datagrams received on the loop to the UDP channel"""
+    def __init__(self, udp: UdpChannel):
+        self.udp = udp
+
+    def datagram_received(self, data: bytes, addr):
+        self.udp.handle_datagram(data, addr)
+
+async def snapshot_sender_task(writer: asyncio.StreamWriter, player: Player, udp: UdpChannel = None):
+    """
+    Pushes snapshots to a client at its send rate, independently of what
+    (and how fast) the client sends. Once the game was closed, sends the
+    final state and hangs up, which also ends the client's reader.
+    """
+    loop = asyncio.get_running_loop()
+    game = player.game
+    sock = writer.get_extra_info("socket")
+    next_send = loop.time()
+    while player.connected:
+        try:
+            # Read first, so the frame sent is at least as new
+            ended = not game.get_state().active
+            if player.link.due():
+                writer.write(player.ping(writer.transport.get_write_buffer_size() + backpressure.unsent_bytes(sock)))
+            if player.udp_addr is not None:
+                udp.send(player, player.encode_snapshot())
+            elif player.backlogged(writer.transport.get_write_buffer_size() + backpressure.unsent_bytes(sock)):
+                # Skipped, the next one sent is the newest
+                if player.stalled():
+                    evict(player, game, "too far behind")
+                    break
+            else:
+                version = game.version
+                frame = player.encode_snapshot(repeat=False)
+                if frame:
+                    writer.write(frame)
+                    await writer.drain()
+                # Nothing changed: sleep until the game does, if it is idle
+                elif not ended and await parked(lambda wake: game.watch(wake, version)):
+                    next_send = loop.time()
+                    continue
+            if ended:
+                writer.close()
+                break
+        except (ConnectionError, RuntimeError):
+            break
+
+        next_send += player.send_interval
+        delay = next_send - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        else:
+            # Fell behind, skip the missed sends instead of bursting them
+            next_send = loop.time()
+
+async def broadcast_task(broadcast, send_interval: float):
+    """Same as server.broadcast_thread"""
+    loop = asyncio.get_running_loop()
+    game = broadcast.game
+    next_send = loop.time()
+    while True:
+        version = game.version
+        published = broadcast.publish()
+        if broadcast.finished():
+            break
+        # Nothing changed: sleep until the game does or a spectator joins, if it is idle
+        if not published and await parked(lambda wake: broadcast.park(wake, version)):
+            next_send = loop.time()
+            continue
+
+        next_send += send_interval
+        delay = next_send - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        else:
+            next_send = loop.time()
+
+async def spectator_sender_task(writer: asyncio.StreamWriter, spectator: Spectator, wake: asyncio.Event):
+    """Writes the frames queued for a spectator as they come, hangs up once the game closed"""
+    try:
+        while True:
+            await wake.wait()
+            wake.clear()
+            closed = spectator.closed
+            frames = spectator.take()
+            if frames:
+                writer.write(b"".join(frames))
+                await asyncio.wait_for(writer.drain(), backpressure.write_timeout or None)
+            if closed:
+                writer.close()
+                break
+    except asyncio.TimeoutError:
+        # Its reader sees it drop
+        writer.transport.abort()
+    except (ConnectionError, RuntimeError):
+        pass
+
+async def spectate(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, stands: Stands, room: str,
+                   send_rate: int, tasks: set):
+    """Same as server.spectate"""
+    wake = asyncio.Event()
+    spectator = Spectator(wake.set)
+    game = stands.find(room)
+    broadcast, start = stands.watch(game, spectator) if game else (None, False)
+    if broadcast is None:
+        writer.write(protocol.pack_no_match())
+        return
+    print(f"Spectator watching game {game.game_id}")
+    writer.write(protocol.pack_spectating())
+    sender = spawn(tasks, spectator_sender_task(writer, spectator, wake))
+    if start:
+        spawn(tasks, broadcast_task(broadcast, 1 / send_rate))
+
+    # A spectator only ever says it leaves
+    try:
+        while not spectator.closed:
+            msg_type, _ = await protocol.read_frame(reader)
+            if msg_type == protocol.MSG_LEAVE:
+                break
+    except (ConnectionError, asyncio.IncompleteReadError, protocol.ProtocolError):
+        pass
+    broadcast.remove(spectator)
+    sender.cancel()
+    print(f"Spectator left game {game.game_id}")
+
+async def play_match(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, player: Player, session: Session,
+                     lobby, sessions: Sessions, tasks: set, udp: UdpChannel = None, resumed: bool = False,
+                     taken_over: bool = False):
+    """
+    Plays one match of a connected client: reads the client's messages as
+    they arrive while a sender task streams snapshots. Same as
+    server.play_match, returns the (name, room code) the client asked to be
+    matched with next, or None once it is gone.
+    """
+    game, player_id, player_name = session.game, session.player_id, session.player_name
+    player.join(game, player_id)
+    metrics.add_player(player)
+    writer.write(protocol.pack_matched(player_id, session.token))
+
+    if resumed:
+        print(f"Player {player_id+1} of game {game.game_id} resumed: {player_name}")
+        # Still counted in if the session was taken from a live connection
+        if not taken_over and game.resume_player():
+            start_countdown(game)
+    else:
+        print(f"Connected client: Game {game.game_id}, Player {player_id+1}")
+
+        # Save player name
+        game.set_player_name(player_id, player_name)
+        print(f"Player {player_id+1} of game {game.game_id} defined as: {player_name}")
+
+        game.update_connected_players(1)
+
+        # If both players are connected, countdown starts
+        if game.claim_start():
+            start_countdown(game)
+
+    sender = spawn(tasks, snapshot_sender_task(writer, player, udp))
+    deadline = backpressure.Deadline(player, game.timers, partial(evict, player, game, "silent for too long"))
+
+    # Client main loop
+    join = None
+    dropped = False
+    while game.get_state().active:
+        try:
+            msg_type, payload = await protocol.read_frame(reader)
+            # Over the rate: wait, and let TCP slow the client down meanwhile
+            delay = player.limiter.take()
+            if delay:
+                metrics.messages_throttled.inc()
+                await asyncio.sleep(delay)
+            if msg_type == protocol.MSG_JOIN:
+                # Wants a new opponent
+                join = read_join(msg_type, payload)
+                break
+            if msg_type == protocol.MSG_LEAVE:
+                break
+            if player.handle_message(msg_type, payload):
+                start_countdown(game)
+
+        except (ConnectionError, asyncio.IncompleteReadError): # Disconnected client
+            dropped = True
+            break
+        except Exception as e:
+            print(f"Error in communication with {player_name}: {e}")
+            break
+
+    deadline.cancel()
+    player.connected = False
+    sender.cancel()
+
+    # Keep the slot of a player who dropped out of a match in play
+    state = game.get_state()
+    if dropped and state.active and state.game_started and not state.player_leaved:
+        if sessions.suspend(session, player, partial(expire_session, lobby)):
+            print(f"{player_name} dropped from game {game.game_id}, slot kept for {sessions.grace}s")
+            return None
+    if not sessions.close(session, player):
+        # Another connection resumed the session, the match is theirs
+        return None
+    leave_match(game, player_name, lobby)
+    return join
+
+async def resume_match(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, player: Player, token: bytes,
+                       lobby, sessions: Sessions, tasks: set, udp: UdpChannel = None):
+    """Same as server.resume_match"""
+    session, previous = sessions.resume(token, player)
+    if session is None:
+        writer.write(protocol.pack_resume_failed())
+        return None
+    if previous and previous.hangup:
+        previous.hangup()
+    return await play_match(reader, writer, player, session, lobby, sessions, tasks, udp, resumed=True,
+                            taken_over=previous is not None)
+
+async def client_task(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, matchmaker: Matchmaker,
+                      sessions: Sessions, stands: Stands, new_game, tick_rate: int, send_rate: int, tasks: set,
+                      udp: UdpChannel = None):
+    """
+    Coroutine that handles a client for as long as it stays connected: the
+    handshake, then one match after another for as long as it asks for new
+    opponents, or a match watched as a spectator. new_game() creates a game
+    when there is nobody to join.
+    """
+    player_name = "So-and-so"
+    player = Player(send_rate)
+    player.hangup = writer.transport.abort
+    try:
+        # Check the protocol version and send the server's settings
+        try:
+            check_hello(*await protocol.read_frame(reader))
+        except protocol.ProtocolError:
+            writer.write(protocol.pack_reject())
+            raise
+        udp_token = udp.register(player) if udp else 0
+        writer.write(protocol.pack_welcome(tick_rate, udp_token))
+        await writer.drain()
+
+        # Receive player name and room, or the token of a dropped session
+        msg_type, payload = await protocol.read_frame(reader)
+        if msg_type == protocol.MSG_SPECTATE:
+            await spectate(reader, writer, stands, protocol.unpack_spectate(payload), send_rate, tasks)
+            join = None
+        elif msg_type == protocol.MSG_RESUME:
+            join = await resume_match(reader, writer, player, protocol.unpack_resume(payload),
+                                      matchmaker, sessions, tasks, udp)
+        else:
+            try:
+                join = read_join(msg_type, payload)
+            except Exception as e:
+                print(f"Erro ao receber nome: {e}")
+                join = (player_name, "")
+
+        while join is not None:
+            player_name, room = join
+            game, player_id = matchmaker.join(new_game, ratings.rating(player_name), room)
+            if player_id == 1:
+                print(f"Adding player to game {game.game_id}")
+            else:
+                stands.open(game, room)
+            session = sessions.issue(game, player_id, player_name, player)
+            join = await play_match(reader, writer, player, session, matchmaker, sessions, tasks, udp)
+            if join is not None:
+                metrics.matchmaking_requeues.inc()
+    except Exception as e:
+        print(f"Error in client task of {player_name}: {e}")
+    if udp:
+        udp.unregister(player)
+    metrics.remove_player(player)
+
+    try:
+        writer.close()
+    except:
+        pass
+
+def start_game_logic(game: Game, physics, tasks: set):
+    """Starts the game logic (ball movement, physics) of a new game"""
+    # Countdowns and the rematch window run as timers of the event loop
+    game.timers = asyncio.get_running_loop()
+    if physics:
+        physics.add(game)
+    else:
+        spawn(tasks, game_logic_task(game))
+
+def spawn(tasks: set, coro):
+    """Schedule a coroutine and keep a reference to it until it finishes"""
+    task = asyncio.get_running_loop().create_task(coro)
+    tasks.add(task)
+    task.add_done_callback(tasks.discard)
+    return task
+
+async def serve(s: socket.socket, tick_rate: int, send_rate: int, udp: UdpChannel = None, physics=None,
+                collision: str = "discrete"):
+    """
+    Accept loop of the asyncio engine. Each client is paired by a Matchmaker
+    once it sent its name.
+    """
+    matchmaker = Matchmaker()
+    sessions = Sessions()
+    stands = Stands()
+    metrics.games_unmatched.function = matchmaker.waiting
+    metrics.sessions_suspended.function = sessions.suspended
+    # Strong references to running tasks (the loop only keeps weak ones)
+    tasks = set()
+
+    if udp:
+        loop = asyncio.get_running_loop()
+        transport, _ = await loop.create_datagram_endpoint(lambda: DatagramHandler(udp), sock=udp.sock)
+        udp.sendto = transport.sendto
+    if physics:
+        spawn(tasks, batch_logic_task(physics))
+
+    def new_game() -> Game:
+        game = Game(str(randint(1000, 9999)), tick_rate, collision)
+        print(f"Creating new game {game.game_id}")
+
+        # Start the game logic (ball movement, physics)
+        start_game_logic(game, physics, tasks)
+        return game
+
+    def on_connect(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        print(f"New connection from {writer.get_extra_info('peername')}")
+        spawn(tasks, client_task(reader, writer, matchmaker, sessions, stands, new_game, tick_rate, send_rate, tasks,
+                                  udp))
+
+    server = await asyncio.start_server(on_connect, sock=s)
+    async with server:
+        await server.serve_forever()
+
+async def serve_worker(channel: socket.socket, sessions: Sessions, tick_rate: int, send_rate: int, physics=None,
+                       collision: str = "discrete"):
+    """
+    Asyncio engine inside a sharded worker: connections are handed over by
+    the front-end (see sharded_server.py) instead of accepted, and handed
+    back to it when they ask for a new opponent.
+    """
+    from sharded_server import WorkerLobby, recv_message, RESUME, SPECTATE
+
+    lobby = WorkerLobby(channel, tick_rate, collision)
+    stands = Stands()
+    metrics.games_unmatched.function = lobby.waiting
+    if ratings.store:
+        # The front-end keeps the ratings
+        ratings.report = lobby.report
+    tasks = set()
+    clients = set()
+
+    if physics:
+        spawn(tasks, batch_logic_task(physics))
+
+    loop = asyncio.get_running_loop()
+    closed = loop.create_future()
+
+    async def client_connection(conn: socket.socket, match=None, token: bytes = None):
+        """Plays the match handed over, as (game, player ID, name), or resumes the session of `token`"""
+        reader, writer = await asyncio.open_connection(sock=conn)
+        player = Player(send_rate)
+        player.hangup = writer.transport.abort
+        try:
+            if token is None:
+                session = sessions.issue(*match, player)
+                join = await play_match(reader, writer, player, session, lobby, sessions, tasks)
+            else:
+                join = await resume_match(reader, writer, player, token, lobby, sessions, tasks)
+            if join is not None:
+                lobby.requeue(conn, *join)
+        except Exception as e:
+            print(f"Error in client task: {e}")
+        metrics.remove_player(player)
+        writer.close()
+
+    async def spectator_connection(conn: socket.socket, room: str):
+        reader, writer = await asyncio.open_connection(sock=conn)
+        try:
+            await spectate(reader, writer, stands, room, send_rate, tasks)
+        except Exception as e:
+            print(f"Error in spectator task: {e}")
+        writer.close()
+
+    def on_handoff():
+        try:
+            message = recv_message(channel)
+        except BlockingIOError:
+            return
+        if message is None:
+            loop.remove_reader(channel.fileno())
+            closed.set_result(None)
+            return
+        kind, game_id, player_id, room, player_name, conn = message
+        conn.setblocking(False)
+
+        if kind == RESUME:
+            clients.add(spawn(tasks, client_connection(conn, token=bytes.fromhex(game_id))))
+            return
+        if kind == SPECTATE:
+            spawn(tasks, spectator_connection(conn, room))
+            return
+
+        game, created = lobby.join(game_id, player_id)
+        if game is None:
+            # Its first player left meanwhile: back to matchmaking
+            lobby.requeue(conn, player_name, room)
+            conn.close()
+            return
+        if created:
+            start_game_logic(game, physics, tasks)
+            stands.open(game, room)
+        clients.add(spawn(tasks, client_connection(conn, (game, player_id, player_name))))
+
+    channel.setblocking(False)
+    loop.add_reader(channel.fileno(), on_handoff)
+    await closed
+
+    # Front-end gone: take no new players, let running matches finish
+    while clients:
+        await asyncio.wait(clients)
+        clients = {task for task in clients if not task.done()}
+
+def run_worker(channel: socket.socket, sessions: Sessions, tick_rate: int = TICK_RATE, send_rate: int = SEND_RATE,
+               physics=None, collision: str = "discrete"):
+    """Run the asyncio engine in a sharded worker"""
+    asyncio.run(serve_worker(channel, sessions, tick_rate, send_rate, physics, collision))
+
+def run(s: socket.socket, tick_rate: int = TICK_RATE, send_rate: int = SEND_RATE, udp: UdpChannel = None, physics=None,
+        collision: str = "discrete"):
+    """Run the asyncio engine on an already bound and listening socket"""
+    asyncio.run(serve(s, tick_rate, send_rate, udp, physics, collision))
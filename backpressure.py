@@ -0,0 +1,124 @@
+"""
+Backpressure and limits on client connections.
+
+Snapshots are never queued for a client: the sender encodes the newest
+one when it is due. What a client has not received yet waits in the
+socket's send buffer (and, with the asyncio engine, the transport's), and
+while that holds more than SEND_BACKLOG bytes the sender skips its turns,
+so a slow link gets fewer but always current snapshots instead of an
+ever older queue. A client that stays that far behind for write_timeout
+seconds, or whose send blocks that long, is evicted.
+
+A player that sends nothing at all (over TCP or UDP) for read_timeout
+seconds is evicted too, see Deadline. Evicted players drop out like a
+broken connection, so their session is kept for them to resume.
+
+Messages from a client are limited to message_rate per second by a token
+bucket (RateLimiter): over TCP the reader waits for a token, so a client
+sending faster fills its own socket buffers and is slowed down by TCP
+itself. Datagrams over the limit are dropped.
+
+Limits are set once at startup with configure() (server.py flags).
+"""
+
+import fcntl
+import socket
+import struct
+import termios
+import time
+
+# Bytes a client may have unsent before snapshots are skipped
+SEND_BACKLOG = 1024
+# Seconds a client may stay behind, or a send may block, before the client is evicted
+WRITE_TIMEOUT = 10.0
+# Seconds a player may send nothing before being evicted
+READ_TIMEOUT = 30.0
+# Messages per second a client may send (the client sends an input per frame, at 60 fps)
+MESSAGE_RATE = 120
+# Messages a client may send at once above the rate
+MESSAGE_BURST = 60
+
+write_timeout = WRITE_TIMEOUT
+read_timeout = READ_TIMEOUT
+message_rate = MESSAGE_RATE
+
+def configure(write: float = WRITE_TIMEOUT, read: float = READ_TIMEOUT, rate: int = MESSAGE_RATE):
+    """Sets the limits of connections made from now on. 0 turns a limit off"""
+    global write_timeout, read_timeout, message_rate
+    write_timeout, read_timeout, message_rate = write, read, rate
+
+def unsent_bytes(sock: socket.socket) -> int:
+    """Bytes in the socket's send buffer not yet acknowledged by the client, 0 where it cannot be told"""
+    try:
+        return struct.unpack("i", fcntl.ioctl(sock.fileno(), termios.TIOCOUTQ, b"\0\0\0\0"))[0]
+    except (OSError, AttributeError):
+        return 0
+
+def set_write_timeout(sock: socket.socket):
+    """Makes blocking sends on `sock` fail after write_timeout seconds (SO_SNDTIMEO), if set"""
+    if not write_timeout:
+        return
+    seconds = int(write_timeout)
+    timeval = struct.pack("ll", seconds, int((write_timeout - seconds) * 1e6))
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDTIMEO, timeval)
+    except OSError:
+        pass
+
+class RateLimiter:
+    """Token bucket: `rate` messages per second on average, `burst` at once"""
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate: int = None, burst: int = MESSAGE_BURST):
+        self.rate = message_rate if rate is None else rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self) -> float:
+        """Takes a token for a message. Returns how many seconds the message has to wait for it"""
+        if not self.rate:
+            return 0.0
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+    def allow(self) -> bool:
+        """Takes a token if there is one, for messages that are dropped rather than delayed"""
+        if self.take():
+            # Not taken after all
+            self.tokens += 1
+            return False
+        return True
+
+class Deadline:
+    """
+    Evicts a player that went silent: `evict()` is called once nothing was
+    heard from it (player.last_heard) for read_timeout seconds. Scheduled
+    on `timers` (see scheduler.py), cancel() when the player leaves.
+    """
+    def __init__(self, player, timers, evict):
+        self.player = player
+        self.timers = timers
+        self.evict = evict
+        self.timer = None
+        self.cancelled = False
+        if read_timeout:
+            self.timer = timers.call_later(read_timeout, self.check)
+
+    def check(self):
+        if self.cancelled:
+            return
+        silent = time.monotonic() - self.player.last_heard
+        if silent >= read_timeout:
+            self.timer = None
+            self.evict()
+        else:
+            self.timer = self.timers.call_later(read_timeout - silent, self.check)
+
+    def cancel(self):
+        self.cancelled = True
+        if self.timer:
+            self.timer.cancel()
@@ -0,0 +1,245 @@
+"""
+Batch physics engine for the Pong server.
+
+Instead of one game logic thread (or task) per match, a single loop steps
+every match at once. While a game is attached, its ball, ball speed,
+racket positions and tick live in contiguous NumPy arrays indexed by the
+game's slot, and one vectorized pass advances all balls in play with the
+same rules and the same float operations as server.update_game, so matches
+play out exactly as with the per-game engine, tick for tick.
+
+No Python code runs per match and per tick: games push their rackets and
+countdown into the arrays when they change, every step publishes read-only
+copies of the arrays that Game.get_state() overlays on the game's own
+published state, and a match is only visited when it is won.
+"""
+
+import threading
+import time
+
+import numpy as np
+
+import metrics
+import ratings
+from server import (Game, StateView, WIDTH, HEIGHT, PADDLE_WIDTH, PADDLE_HEIGHT, BALL_RADIUS,
+                    SPEED_INCREASE_PER_FRAME, MAX_SPEED, BASE_TICK_RATE, TICK_RATE)
+
+BALL_SIZE = BALL_RADIUS * 2
+# Top edge of each player's racket, rackets only move sideways
+PADDLE_Y = (HEIGHT - 20 - PADDLE_HEIGHT, 20)
+NO_WINNER = -1
+INITIAL_CAPACITY = 64
+
+def rect_round(values: np.ndarray) -> np.ndarray:
+    """geometry.round_half_away() for arrays, how a Rect stores a float position"""
+    whole = np.trunc(values)
+    return (whole + np.sign(values) * (np.abs(values - whole) >= 0.5)).astype(np.int64)
+
+def collides(ball_x: np.ndarray, ball_y: np.ndarray, paddle_x: np.ndarray, paddle_y: int) -> np.ndarray:
+    """geometry.Rect.colliderect between the balls and one racket per ball"""
+    return ((ball_x < paddle_x + PADDLE_WIDTH) & (paddle_x < ball_x + BALL_SIZE)
+            & (ball_y < paddle_y + PADDLE_HEIGHT) & (paddle_y < ball_y + BALL_SIZE))
+
+def advance(pos: np.ndarray, speed: np.ndarray, paddles_x: np.ndarray, frames: float):
+    """
+    Advances N balls by one tick covering `frames` base frames.
+    pos and speed are (N, 2) floats, paddles_x is (N, 2) racket positions.
+    Returns (pos, speed, winner) with winner NO_WINNER, 0 or 1 per ball.
+    """
+    x, y = pos[:, 0], pos[:, 1]
+    speed_x, speed_y = speed[:, 0], speed[:, 1]
+
+    # Increase speed gradually
+    speed_y = np.where(np.abs(speed_y) < MAX_SPEED,
+                       np.copysign(np.abs(speed_y) + SPEED_INCREASE_PER_FRAME * frames, speed_y), speed_y)
+    speed_x = np.where(np.abs(speed_x) < MAX_SPEED,
+                       np.copysign(np.abs(speed_x) + SPEED_INCREASE_PER_FRAME * frames, speed_x), speed_x)
+
+    # New ball positions
+    new_x = x + speed_x * frames
+    new_y = y + speed_y * frames
+
+    # Collisions with side walls
+    wall = (new_x <= 0) | (new_x >= WIDTH - BALL_SIZE)
+    speed_x = np.where(wall, -speed_x, speed_x)
+    new_x = np.where(wall, x + speed_x * frames, new_x)
+
+    # Collisions with rackets, tested on whole pixels like the temporary Rect
+    ball_x, ball_y = np.trunc(new_x), np.trunc(new_y)
+    hit0 = collides(ball_x, ball_y, paddles_x[:, 0], PADDLE_Y[0]) & (speed_y > 0)
+    hit1 = ~hit0 & collides(ball_x, ball_y, paddles_x[:, 1], PADDLE_Y[1]) & (speed_y < 0)
+    speed_y = np.where(hit0, -np.abs(speed_y), np.where(hit1, np.abs(speed_y), speed_y))
+    new_y = np.where(hit0 | hit1, y + speed_y * frames, new_y)
+
+    # Victory conditions
+    winner = np.where(new_y <= 0, 0, np.where(new_y >= HEIGHT - BALL_SIZE, 1, NO_WINNER))
+
+    return np.stack((new_x, new_y), axis=1), np.stack((speed_x, speed_y), axis=1), winner
+
+class BatchPhysics:
+    """
+    Owns the physics state of every attached game and steps it in one pass.
+    Slots of finished games are reused by new ones.
+
+    Lock order is game.lock then self.lock: games call load()/store() while
+    holding their own lock, and step() never takes a game lock while
+    holding this one. Readers take no lock at all, they use the
+    (balls, ball pixels, ticks) copies in `published`.
+    """
+    def __init__(self, tick_rate: int = TICK_RATE, capacity: int = INITIAL_CAPACITY):
+        self.tick_rate = tick_rate
+        self.lock = threading.Lock()
+        self.games = [None] * capacity
+        self.free = list(range(capacity - 1, -1, -1))
+        # Ball x, y, speed x, speed y of each slot
+        self.balls = np.zeros((capacity, 4))
+        self.paddles_x = np.zeros((capacity, 2), dtype=np.int64)
+        self.ticks = np.zeros(capacity, dtype=np.int64)
+        # Ticks run with the ball in play, see GameState.steps
+        self.steps = np.zeros(capacity, dtype=np.int64)
+        # Slot holds an active game / a ball in play
+        self.active = np.zeros(capacity, dtype=bool)
+        self.moving = np.zeros(capacity, dtype=bool)
+        # Set while the batch loop sleeps, see park()
+        self.wake = None
+        self.parked_at = 0.0
+        self.publish()
+
+    def grow(self):
+        """Doubles the number of slots. Caller holds the lock"""
+        capacity = len(self.games)
+        self.games.extend([None] * capacity)
+        self.free.extend(range(2 * capacity - 1, capacity - 1, -1))
+        for name in ("balls", "paddles_x", "ticks", "steps", "active", "moving"):
+            array = getattr(self, name)
+            setattr(self, name, np.concatenate((array, np.zeros_like(array))))
+
+    def add(self, game: Game):
+        """Attaches a game, from then on its physics state lives here"""
+        with game.lock:
+            with self.lock:
+                if not self.free:
+                    self.grow()
+                slot = self.free.pop()
+                self.games[slot] = game
+                self.active[slot] = True
+            game.physics_slot = slot
+            self.load(game, ball=True)
+            # Readers overlay the arrays once both are set, see Game.get_state
+            game.physics = self
+            game.publish()
+
+    def remove(self, game: Game):
+        """Detaches a game, leaving its final physics state in game.state. Caller holds game.lock and publishes"""
+        self.store(game)
+        with self.lock:
+            slot = game.physics_slot
+            self.games[slot] = None
+            self.active[slot] = self.moving[slot] = False
+            self.free.append(slot)
+        game.physics, game.physics_slot = None, None
+        print(f"Closing game {game.game_id} logic")
+
+    def load(self, game: Game, ball: bool = False) -> int:
+        """
+        Copies the rackets, whether the ball is in play and optionally the
+        ball itself from game.state. Returns the ball step the changes take
+        effect after. Caller holds game.lock.
+        """
+        state = game.state
+        slot = game.physics_slot
+        with self.lock:
+            self.paddles_x[slot] = (state.paddles[0].x, state.paddles[1].x)
+            self.moving[slot] = state.active and state.countdown <= 0 and state.winner_id is None
+            if ball:
+                self.balls[slot] = (*state.ball_pos, *state.ball_speed)
+                self.ticks[slot] = state.tick
+                self.steps[slot] = state.steps
+                if self.wake is not None:
+                    # skip_ticks() counts from the park, not from when this game came
+                    self.ticks[slot] -= int((time.perf_counter() - self.parked_at) * self.tick_rate)
+                # Readers must not see the previous ball until the next step
+                self.publish()
+            if self.wake is not None and self.moving[slot]:
+                wake, self.wake = self.wake, None
+                wake()
+            return self.steps.item(slot)
+
+    def store(self, game: Game):
+        """Copies the ball, tick and steps into game, as update_game would have left them. Caller holds game.lock"""
+        state = game.state
+        slot = game.physics_slot
+        with self.lock:
+            x, y, speed_x, speed_y = self.balls[slot].tolist()
+            state.tick = self.ticks.item(slot)
+            state.steps = self.steps.item(slot)
+        state.ball_pos = [x, y]
+        state.ball.x = x
+        state.ball.y = y
+        state.ball_speed = [speed_x, speed_y]
+
+    def publish(self):
+        """Swaps in read-only copies of the arrays. Caller holds the lock"""
+        self.published = (self.balls.copy(), rect_round(self.balls[:, :2]), self.ticks.copy())
+
+    def park(self, wake) -> bool:
+        """
+        Lets the batch loop sleep while no ball is in play: `wake` is called
+        once one is served. Returns False, without registering it, if one is.
+        """
+        with self.lock:
+            if self.moving.any():
+                return False
+            self.wake = wake
+            self.parked_at = time.perf_counter()
+            return True
+
+    def skip_ticks(self, ticks: int):
+        """Counts the ticks that passed while the batch loop was parked"""
+        with self.lock:
+            self.ticks += self.active * ticks
+            self.publish()
+
+    def view(self, published, slot: int):
+        """A game's published StateView with the ball and tick of the last step"""
+        balls, pixels, ticks = self.published
+        x, y, speed_x, speed_y = balls[slot].tolist()
+        # Same as published._replace(), without its per-call overhead
+        return StateView(ticks.item(slot), (pixels.item(slot, 0), pixels.item(slot, 1)),
+                         (x, y), (speed_x, speed_y), *published[4:])
+
+    def step(self, dt: float = 1/BASE_TICK_RATE):
+        """Advances every attached game by one tick of `dt` seconds"""
+        start = time.perf_counter()
+        results = []
+        with self.lock:
+            self.ticks += self.active
+            slots = np.flatnonzero(self.moving)
+            if slots.size:
+                self.steps[slots] += 1
+                balls = self.balls[slots]
+                pos, speed, winner = advance(balls[:, :2], balls[:, 2:], self.paddles_x[slots], dt * BASE_TICK_RATE)
+                self.balls[slots] = np.concatenate((pos, speed), axis=1)
+
+                won = winner != NO_WINNER
+                ended = slots[won]
+                self.moving[ended] = False
+                results = [(self.games[slot], winner_id, step) for slot, winner_id, step
+                           in zip(ended.tolist(), winner[won].tolist(), self.steps[ended].tolist())]
+            self.publish()
+
+        # Only matches that just ended are visited
+        for game, winner_id, step in results:
+            with game.lock:
+                game.state.winner_id = winner_id
+                if game.recorder:
+                    game.recorder.win(step, winner_id)
+                game.open_rematch_window()
+                if game.physics is self:
+                    self.store(game)
+                game.publish()
+                if game.state.connected_players == 2:
+                    print(f'Game {game.game_id}: Player {winner_id+1} won!')
+                    ratings.record(game.state.player_names, winner_id)
+        if metrics.enabled:
+            metrics.batch_step_seconds.observe(time.perf_counter() - start)
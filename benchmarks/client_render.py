@@ -0,0 +1,215 @@
+"""
+Frame time of the client's rendering, headless (SDL dummy video driver).
+
+A scripted session (name screen being typed, looking for an opponent,
+waiting, countdown, a rally, the winner screen and a rematch vote) is drawn
+as a player on each side, two ways, each timed per frame:
+  full      as client.py drew before client_render.py: fill the window,
+            render every string with the font, new Rects for player 2's
+            view, flip the whole window
+  canvas    client.py's screens through client_render.Canvas: cached text,
+            unchanged frames skipped, only changed regions updated
+Every frame is also drawn both ways off screen and compared: the benchmark
+fails if any pixel differs.
+
+The dummy driver shows nothing, so flip() and update() cost no copy to a
+real window here: the savings on a real display are larger.
+
+Usage (from the repository root):
+    python -m benchmarks.client_render --rally 600
+"""
+
+import argparse
+import math
+import os
+import statistics
+import sys
+import time
+
+os.environ["SDL_VIDEODRIVER"] = "dummy"
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+
+import pygame
+
+import client
+from client import (WIDTH, HEIGHT, PADDLE_WIDTH, PADDLE_HEIGHT, BALL_RADIUS, BLACK, WHITE, BLUE, RED, GREEN_BTN,
+                    COLOR_ACTIVE, COLOR_INACTIVE, font, small_font, input_font, countdown_font)
+from client_render import Canvas
+
+INPUT_BOX = pygame.Rect(WIDTH/2 - 200, HEIGHT/2 - 110, 400, 50)
+ROOM_BOX = pygame.Rect(WIDTH/2 - 200, HEIGHT/2 + 10, 400, 50)
+OK_BUTTON = pygame.Rect(WIDTH/2 - 160, HEIGHT/2 + 90, 150, 60)
+WATCH_BUTTON = pygame.Rect(WIDTH/2 + 10, HEIGHT/2 + 90, 150, 60)
+PLAY_AGAIN_BUTTON = pygame.Rect(WIDTH/2 - 100, HEIGHT/2 + 50, 200, 60)
+NEW_OPPONENT_BUTTON = pygame.Rect(WIDTH/2 - 100, HEIGHT/2 + 130, 200, 60)
+
+# The screens as client.py drew them before, one full frame each time
+
+def full_button(win, button, label, color):
+    pygame.draw.rect(win, color, button, border_radius=10)
+    label_surface = small_font.render(label, True, WHITE)
+    win.blit(label_surface, label_surface.get_rect(center=button.center))
+
+def full_name_input_screen(win, text, room, active_box):
+    win.fill(BLACK)
+    for prompt, value, box in (("Enter your name:", text, INPUT_BOX), ("Room code (optional):", room, ROOM_BOX)):
+        prompt_surface = input_font.render(prompt, True, WHITE)
+        win.blit(prompt_surface, prompt_surface.get_rect(center=(WIDTH/2, box.y - 30)))
+        pygame.draw.rect(win, COLOR_ACTIVE if active_box is box else COLOR_INACTIVE, box, 2)
+        win.blit(input_font.render(value, True, WHITE), (box.x + 10, box.y + 10))
+    pygame.draw.rect(win, GREEN_BTN, OK_BUTTON, border_radius=10)
+    ok_text = small_font.render("OK", True, WHITE)
+    win.blit(ok_text, ok_text.get_rect(center=OK_BUTTON.center))
+    full_button(win, WATCH_BUTTON, "Watch", (0, 100, 150))
+    pygame.display.flip()
+
+def full_message(win, message):
+    win.fill(BLACK)
+    text = small_font.render(message, True, WHITE)
+    win.blit(text, text.get_rect(center=(WIDTH/2, HEIGHT/2)))
+    pygame.display.flip()
+
+def full_window(win, paddles_x, ball_pos, winner, players_online, countdown_val, voted, opponent_name, no_opponent,
+                player_id):
+    p1 = pygame.Rect(paddles_x[0], HEIGHT - 20 - PADDLE_HEIGHT, PADDLE_WIDTH, PADDLE_HEIGHT)
+    p2 = pygame.Rect(paddles_x[1], 20, PADDLE_WIDTH, PADDLE_HEIGHT)
+    ball = pygame.Rect(*ball_pos, BALL_RADIUS * 2, BALL_RADIUS * 2)
+    win.fill(BLACK)
+    if no_opponent:
+        text = small_font.render("Your opponent has disconnected.", True, WHITE)
+        win.blit(text, text.get_rect(center=(WIDTH/2, HEIGHT/2)))
+        full_button(win, NEW_OPPONENT_BUTTON, "New opponent", (0, 100, 150))
+    elif players_online < 2:
+        text = small_font.render("Waiting for opponent...", True, WHITE)
+        win.blit(text, text.get_rect(center=(WIDTH/2, HEIGHT/2)))
+    elif countdown_val > 0:
+        if opponent_name:
+            opponent_text = small_font.render(f"Opponent: {opponent_name}", True, WHITE)
+            win.blit(opponent_text, opponent_text.get_rect(center=(WIDTH/2, HEIGHT/2 + 150)))
+        countdown_text = countdown_font.render(str(countdown_val), True, WHITE)
+        win.blit(countdown_text, countdown_text.get_rect(center=(WIDTH/2, HEIGHT/2)))
+    elif countdown_val == 0 and not winner:
+        if player_id == 0:
+            pygame.draw.rect(win, BLUE, p1)
+            pygame.draw.rect(win, RED, p2)
+            pygame.draw.ellipse(win, WHITE, ball)
+        else:
+            pygame.draw.rect(win, RED, pygame.Rect(p2.x, HEIGHT - 20 - PADDLE_HEIGHT, p2.width, p2.height))
+            pygame.draw.rect(win, BLUE, pygame.Rect(p1.x, 20, p1.width, p1.height))
+            pygame.draw.ellipse(win, WHITE, pygame.Rect(ball.x, HEIGHT - ball.y - ball.height, ball.width, ball.height))
+    if winner and not no_opponent:
+        winner_text = font.render(winner, True, WHITE)
+        win.blit(winner_text, winner_text.get_rect(center=(WIDTH/2, HEIGHT/2 - 50)))
+        full_button(win, PLAY_AGAIN_BUTTON, "Waiting..." if voted else "Revenge",
+                    (150, 150, 0) if voted else (0, 150, 0))
+        full_button(win, NEW_OPPONENT_BUTTON, "New opponent", (0, 100, 150))
+    pygame.display.flip()
+
+def session(player_id: int, rally: int):
+    """The frames of a scripted session, as ("name" | "message" | "game", arguments)"""
+    name = "kiosk"
+    for i in range(len(name) * 10):
+        yield "name", (name[:i // 10], "", INPUT_BOX)
+    for i in range(30):
+        yield "name", (name, "", ROOM_BOX)
+    for _ in range(60):
+        yield "message", ("Looking for an opponent...",)
+    center = (WIDTH / 2 - PADDLE_WIDTH / 2, WIDTH / 2 - PADDLE_WIDTH / 2)
+    start = (WIDTH / 2 - BALL_RADIUS, HEIGHT / 2 - BALL_RADIUS)
+    for _ in range(60):
+        yield "game", (center, start, None, 1, 3, False, "", False)
+    for countdown in (3, 2, 1):
+        for _ in range(60):
+            yield "game", (center, start, None, 2, countdown, False, "rival", False)
+    # A rally: the ball bounces off the walls, the rackets follow it
+    x, y, speed_x, speed_y = start[0], start[1], 5.3, 7.1
+    for _ in range(rally):
+        x += speed_x
+        y += speed_y
+        if not 0 <= x <= WIDTH - BALL_RADIUS * 2:
+            speed_x = -speed_x
+        if not 30 <= y <= HEIGHT - 30 - BALL_RADIUS * 2:
+            speed_y = -speed_y
+        paddle_x = max(0, min(x + BALL_RADIUS - PADDLE_WIDTH / 2, WIDTH - PADDLE_WIDTH))
+        wobble = 40 * math.sin(y / 50)
+        yield "game", ((paddle_x, max(0, min(paddle_x + wobble, WIDTH - PADDLE_WIDTH))), (x, y), None, 2, 0, False,
+                       "rival", False)
+    winner = client.get_winner_text(1, player_id)
+    for voted in (False, True):
+        for _ in range(60):
+            yield "game", (center, (x, y), winner, 2, 0, voted, "rival", False)
+
+def draw_full(win, player_id: int, kind: str, args):
+    if kind == "name":
+        full_name_input_screen(win, *args)
+    elif kind == "message":
+        full_message(win, *args)
+    else:
+        full_window(win, *args, player_id)
+
+def draw_canvas(canvas: Canvas, view, kind: str, args):
+    if kind == "name":
+        client.draw_name_input_screen(canvas, args[0], args[1], INPUT_BOX, ROOM_BOX, OK_BUTTON, WATCH_BUTTON, args[2])
+    elif kind == "message":
+        client.draw_message(canvas, *args)
+    else:
+        paddles_x, ball_pos, winner, players_online, countdown, voted, opponent_name, no_opponent = args
+        view.place(paddles_x, ball_pos)
+        client.redraw_window(canvas, view, winner, players_online, countdown, PLAY_AGAIN_BUTTON, voted, opponent_name,
+                             no_opponent, NEW_OPPONENT_BUTTON)
+
+def time_frames(draw, frames) -> list:
+    """Seconds each frame took to draw"""
+    times = []
+    for kind, args in frames:
+        start = time.perf_counter()
+        draw(kind, args)
+        times.append(time.perf_counter() - start)
+    return times
+
+def compare(player_id: int, frames) -> int:
+    """Frames whose pixels differ between the two ways of drawing"""
+    full = pygame.Surface((WIDTH, HEIGHT))
+    canvas = Canvas(pygame.Surface((WIDTH, HEIGHT)), BLACK, update=lambda rects: None)
+    view = client.new_view(player_id)
+    flip = pygame.display.flip
+    pygame.display.flip = lambda: None
+    try:
+        differ = 0
+        for kind, args in frames:
+            draw_full(full, player_id, kind, args)
+            draw_canvas(canvas, view, kind, args)
+            if pygame.image.tobytes(full, "RGB") != pygame.image.tobytes(canvas.surface, "RGB"):
+                differ += 1
+    finally:
+        pygame.display.flip = flip
+    return differ
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rally", type=int, default=600, help="frames of ball in play")
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+
+    ok = True
+    print(f"{'player':>7} {'frames':>7} {'full ms/frame':>14} {'p99':>7} {'canvas ms/frame':>16} {'p99':>7} "
+          f"{'speedup':>8} {'differ':>7}")
+    for player_id in (0, 1):
+        frames = list(session(player_id, args.rally))
+        full, drawn = [], []
+        for _ in range(args.runs):
+            full += time_frames(lambda kind, frame: draw_full(client.screen, player_id, kind, frame), frames)
+            canvas = Canvas(client.screen, BLACK)
+            view = client.new_view(player_id)
+            drawn += time_frames(lambda kind, frame: draw_canvas(canvas, view, kind, frame), frames)
+        differ = compare(player_id, frames)
+        ok = ok and not differ
+        full_p99 = statistics.quantiles(full, n=100)[98]
+        drawn_p99 = statistics.quantiles(drawn, n=100)[98]
+        print(f"{player_id + 1:>7} {len(frames):>7} {statistics.mean(full) * 1000:>14.3f} {full_p99 * 1000:>7.3f} "
+              f"{statistics.mean(drawn) * 1000:>16.3f} {drawn_p99 * 1000:>7.3f} "
+              f"{statistics.mean(full) / statistics.mean(drawn):>7.1f}x {differ:>7}")
+    sys.exit(0 if ok else 1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+"""
+Property check of swept collision detection (server.advance_ball_swept).
+
+Random rallies (ball anywhere, any direction, speeds up to twice MAX_SPEED,
+rackets moving at random between ticks) are played at several tick rates
+with swept collision. Every tick is checked against a reference that
+moves the ball from the same place in --substeps tiny steps, testing the
+rackets and walls after each one with the same bounce rules: the ball
+must end within --tolerance pixels of it, with the same winner unless it
+is that close to a goal line. Whole rallies are not compared, a corner
+hit turns the reference's tiny overlap into an angle that grows with
+every bounce after it. After every tick the ball must also be inside the
+side walls and must not overlap a racket it is moving towards.
+
+Also counts, at each rate, the racket hits the discrete test
+(server.advance_ball) misses: ticks where swept collision sends the ball
+back off a racket and the discrete test lets it through to the far side
+of the racket, i.e. tunnel.
+
+Exits with status 1 if any property fails.
+
+Usage (from the repository root):
+    python -m benchmarks.collision --rallies 300 --tick-rates 60 30 20
+"""
+
+import argparse
+import math
+import random
+import sys
+import time
+
+from geometry import Rect
+from server import (WIDTH, HEIGHT, PADDLE_WIDTH, PADDLE_HEIGHT, PADDLE_SPEED, BALL_RADIUS, MAX_SPEED,
+                    SPEED_INCREASE_PER_FRAME, MAX_BOUNCE_ANGLE, BASE_TICK_RATE, advance_ball, advance_ball_swept,
+                    move_racket)
+
+# Top edge of each player's racket
+PADDLE_Y = (HEIGHT - 20 - PADDLE_HEIGHT, 20)
+
+def reference_step(ball_pos, ball_speed, paddles, frames: float, substeps: int):
+    """One tick, moving the ball in `substeps` steps and bouncing it when it overlaps something"""
+    speed_x, speed_y = ball_speed
+    if abs(speed_y) < MAX_SPEED:
+        speed_y = math.copysign(abs(speed_y) + SPEED_INCREASE_PER_FRAME * frames, speed_y)
+    if abs(speed_x) < MAX_SPEED:
+        speed_x = math.copysign(abs(speed_x) + SPEED_INCREASE_PER_FRAME * frames, speed_x)
+    x, y = ball_pos[0] + BALL_RADIUS, ball_pos[1] + BALL_RADIUS
+    dt = frames / substeps
+    for _ in range(substeps):
+        x += speed_x * dt
+        y += speed_y * dt
+        if (x < BALL_RADIUS and speed_x < 0) or (x > WIDTH - BALL_RADIUS and speed_x > 0):
+            speed_x = -speed_x
+        paddle = paddles[0] if speed_y > 0 else paddles[1]
+        closest_x = min(max(x, paddle.left), paddle.right)
+        closest_y = min(max(y, paddle.top), paddle.bottom)
+        dx, dy = x - closest_x, y - closest_y
+        distance = math.hypot(dx, dy)
+        if distance >= BALL_RADIUS:
+            continue
+        if distance:
+            normal_x, normal_y = dx / distance, dy / distance
+        else:
+            # Centre inside the racket (it moved onto the ball), back the way it came
+            normal_x, normal_y = 0.0, -math.copysign(1.0, speed_y)
+        dot = speed_x * normal_x + speed_y * normal_y
+        if dot >= 0:
+            continue
+        if normal_x == 0:
+            # Flat of the racket
+            half = paddle.width / 2
+            angle = max(-1.0, min((x - paddle.x - half) / half, 1.0)) * MAX_BOUNCE_ANGLE
+            speed = math.hypot(speed_x, speed_y)
+            speed_x, speed_y = speed * math.sin(angle), math.copysign(speed * math.cos(angle), normal_y)
+        else:
+            speed_x -= 2 * dot * normal_x
+            speed_y -= 2 * dot * normal_y
+    ball_pos = [x - BALL_RADIUS, y - BALL_RADIUS]
+    winner_id = 0 if ball_pos[1] <= 0 else (1 if ball_pos[1] >= HEIGHT - BALL_RADIUS * 2 else None)
+    return ball_pos, [speed_x, speed_y], winner_id
+
+def random_rally(rng: random.Random):
+    """Ball position and speed, and racket positions, with the ball clear of the rackets"""
+    while True:
+        paddles = [Rect(rng.randrange(WIDTH - PADDLE_WIDTH + 1), PADDLE_Y[i], PADDLE_WIDTH, PADDLE_HEIGHT)
+                   for i in (0, 1)]
+        ball = Rect(0, 0, BALL_RADIUS * 2, BALL_RADIUS * 2)
+        ball.center = (rng.uniform(BALL_RADIUS, WIDTH - BALL_RADIUS), rng.uniform(PADDLE_Y[1] + 30, PADDLE_Y[0] - 20))
+        if not any(ball.colliderect(paddle) for paddle in paddles):
+            break
+    speed = rng.uniform(4, 2 * MAX_SPEED)
+    angle = rng.uniform(-MAX_BOUNCE_ANGLE, MAX_BOUNCE_ANGLE) + rng.choice((0, math.pi))
+    return [float(ball.x), float(ball.y)], [speed * math.sin(angle), speed * math.cos(angle)], paddles
+
+def overlaps_approaching(ball_pos, ball_speed, paddles) -> bool:
+    """The ball overlaps the racket it is moving towards"""
+    paddle = paddles[0] if ball_speed[1] > 0 else paddles[1]
+    x, y = ball_pos[0] + BALL_RADIUS, ball_pos[1] + BALL_RADIUS
+    dx = x - min(max(x, paddle.left), paddle.right)
+    dy = y - min(max(y, paddle.top), paddle.bottom)
+    return dx * dx + dy * dy < (BALL_RADIUS - 1e-6) ** 2 and ball_speed[0] * dx + ball_speed[1] * dy < 0
+
+def play(seed: int, tick_rate: int, ticks: int, substeps: int, tolerance: float):
+    """Plays one rally, returns a list of property violations"""
+    rng = random.Random(seed)
+    ball_pos, ball_speed, paddles = random_rally(rng)
+    frames = 1 / tick_rate * BASE_TICK_RATE
+    problems = []
+    for tick in range(1, ticks + 1):
+        ref_pos, ref_speed, ref_winner = reference_step(ball_pos, ball_speed, paddles, frames, substeps)
+        ball_pos, ball_speed, winner_id = advance_ball_swept(ball_pos, ball_speed, paddles, frames)
+        error = math.dist(ball_pos, ref_pos)
+        if error > tolerance:
+            problems.append(f"tick {tick}: {error:.3f} px from the reference")
+        goal_distance = min(abs(ball_pos[1]), abs(ball_pos[1] - (HEIGHT - BALL_RADIUS * 2)))
+        if winner_id != ref_winner and goal_distance > tolerance:
+            problems.append(f"tick {tick}: winner {winner_id}, reference {ref_winner}")
+        if not -1e-6 <= ball_pos[0] <= WIDTH - BALL_RADIUS * 2 + 1e-6:
+            problems.append(f"tick {tick}: ball at x {ball_pos[0]:.3f}, outside the walls")
+        if overlaps_approaching(ball_pos, ball_speed, paddles):
+            problems.append(f"tick {tick}: ball inside a racket at {ball_pos}")
+        if winner_id is not None or problems:
+            break
+        for paddle in paddles:
+            paddle.x = move_racket(paddle.x, rng.choice((-1, 0, 1)))
+    return problems
+
+def discrete_misses(rng: random.Random, tick_rate: int, trials: int):
+    """(racket hits, hits missed by the discrete test) over single ticks aimed at a racket"""
+    frames = 1 / tick_rate * BASE_TICK_RATE
+    hits = missed = 0
+    for _ in range(trials):
+        player_id = rng.randrange(2)
+        paddles = [Rect(rng.randrange(WIDTH - PADDLE_WIDTH + 1), PADDLE_Y[i], PADDLE_WIDTH, PADDLE_HEIGHT)
+                   for i in (0, 1)]
+        paddle = paddles[player_id]
+        speed_y = rng.uniform(4, MAX_SPEED) * (1 if player_id == 0 else -1)
+        speed_x = rng.uniform(-MAX_SPEED, MAX_SPEED)
+        # Anywhere from which the racket is within one tick
+        center_x = paddle.centerx + rng.uniform(-PADDLE_WIDTH, PADDLE_WIDTH) / 2
+        edge = paddle.top - BALL_RADIUS if player_id == 0 else paddle.bottom + BALL_RADIUS
+        center_y = edge - math.copysign(rng.uniform(0, abs(speed_y) * frames), speed_y)
+        ball_pos = [center_x - BALL_RADIUS, center_y - BALL_RADIUS]
+        _, (_, swept_speed_y), _ = advance_ball_swept(ball_pos, [speed_x, speed_y], paddles, frames)
+        if math.copysign(1, swept_speed_y) == math.copysign(1, speed_y):
+            continue
+        hits += 1
+        # The discrete test may only see the overlap a tick or two later
+        position, speed = ball_pos, [speed_x, speed_y]
+        while math.copysign(1, speed[1]) == math.copysign(1, speed_y):
+            position, speed, winner_id = advance_ball(position, speed, paddles, frames)
+            past = position[1] > paddle.bottom if player_id == 0 else position[1] + BALL_RADIUS * 2 < paddle.top
+            if past or winner_id is not None:
+                missed += 1
+                break
+    return hits, missed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rallies", type=int, default=300)
+    parser.add_argument("--ticks", type=int, default=240, help="longest rally, in ticks")
+    parser.add_argument("--tick-rates", type=int, nargs="+", default=[120, 60, 30, 20])
+    parser.add_argument("--substeps", type=int, default=2000, help="reference steps per tick")
+    parser.add_argument("--tolerance", type=float, default=0.5, help="pixels per tick")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    ok = True
+    print(f"{'rate':>5} {'rallies':>8} {'failed':>7} {'swept us/tick':>14} {'discrete misses':>16}")
+    for tick_rate in args.tick_rates:
+        failures = []
+        for rally in range(args.rallies):
+            problems = play(args.seed * 1_000_003 + rally, tick_rate, args.ticks, args.substeps, args.tolerance)
+            if problems:
+                failures.append((rally, problems))
+        ok = ok and not failures
+
+        # Cost of one swept tick against the discrete one, on a plain rally
+        ball_pos, ball_speed, paddles = random_rally(random.Random(args.seed))
+        frames = 1 / tick_rate * BASE_TICK_RATE
+        start = time.perf_counter()
+        for _ in range(20000):
+            advance_ball_swept(ball_pos, ball_speed, paddles, frames)
+        swept = (time.perf_counter() - start) / 20000
+
+        hits, missed = discrete_misses(random.Random(args.seed), tick_rate, args.rallies * 5)
+        print(f"{tick_rate:>5} {args.rallies:>8} {len(failures):>7} {swept * 1e6:>14.1f} "
+              f"{missed:>7}/{hits:<8}")
+        for rally, problems in failures[:5]:
+            print(f"      rally {rally}: {'; '.join(problems)}")
+    sys.exit(0 if ok else 1)
+
+if __name__ == "__main__":
+    main()
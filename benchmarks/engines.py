@@ -0,0 +1,147 @@
+"""
+Compare matches-per-core of the threaded and asyncio server engines.
+
+For every engine and match count, starts `server.py --engine <engine>` on a
+free local port, connects two bot clients per match from a pool of bot
+processes and measures the CPU time the server spends while serving them
+(its worker processes included with --workers).
+`upd/s/client` shows whether the server still keeps up with the 60 fps
+clients; `matches/core` is only meaningful while it does.
+
+Usage (from the repository root):
+    python -m benchmarks.engines --matches 25 50 100 --duration 10
+    python -m benchmarks.engines --matches 100 200 --workers 4
+"""
+
+import argparse
+import asyncio
+import multiprocessing
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import psutil
+
+import bot
+from bot import BotStats
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def start_server(engine: str, port: int, workers: int = 0, extra_args: list = ()) -> subprocess.Popen:
+    env = dict(os.environ, SERVER_IP="127.0.0.1", SERVER_PORT=str(port))
+    proc = subprocess.Popen([sys.executable, "server.py", "--engine", engine, "--workers", str(workers), *extra_args],
+                            cwd=ROOT, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    # Wait until the server accepts connections
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+            break
+        except OSError:
+            time.sleep(0.05)
+    return proc
+
+async def run_bots(port: int, count: int, start_at: float, end_at: float) -> int:
+    """Run `count` bots and return how many state updates they got between start_at and end_at"""
+    stats = BotStats()
+    stop = asyncio.Event()
+    bots = asyncio.create_task(bot.run_bots("127.0.0.1", port, count, stats, stop))
+    await asyncio.sleep(max(0, start_at - time.time()))
+    updates_before = stats.updates
+    await asyncio.sleep(max(0, end_at - time.time()))
+    updates_delivered = stats.updates - updates_before
+    stop.set()
+    await bots
+    return updates_delivered
+
+def bot_process(port: int, count: int, start_at: float, end_at: float, results):
+    results.put(asyncio.run(run_bots(port, count, start_at, end_at)))
+
+def server_cpu(server: psutil.Process) -> float:
+    """User + system CPU seconds of the server and its workers"""
+    total = 0.0
+    for p in [server] + server.children(recursive=True):
+        try:
+            total += sum(p.cpu_times()[:2])
+        except psutil.NoSuchProcess:
+            pass
+    return total
+
+def server_threads(server: psutil.Process) -> int:
+    return sum(p.num_threads() for p in [server] + server.children(recursive=True))
+
+def measure(engine: str, matches: int, duration: float, warmup: float, bot_procs: int, workers: int = 0) -> dict:
+    port = free_port()
+    proc = start_server(engine, port, workers)
+    server = psutil.Process(proc.pid)
+
+    # Bots are spread over several processes so the load generator is not the bottleneck
+    start_at = time.time() + warmup + matches * 2 * 0.002
+    end_at = start_at + duration
+    results = multiprocessing.Queue()
+    workers = []
+    players = matches * 2
+    for i in range(bot_procs):
+        count = players // bot_procs + (1 if i < players % bot_procs else 0)
+        w = multiprocessing.Process(target=bot_process, args=(port, count, start_at, end_at, results))
+        w.start()
+        workers.append(w)
+    try:
+        time.sleep(max(0, start_at - time.time()))
+        cpu_before = server_cpu(server)
+        time.sleep(max(0, end_at - time.time()))
+        cpu = server_cpu(server) - cpu_before
+        threads = server_threads(server)
+        frames_delivered = sum(results.get() for _ in workers)
+    finally:
+        # The server and its worker processes, which do not exit with it
+        children = server.children(recursive=True)
+        proc.kill()
+        proc.wait()
+        for child in children:
+            try:
+                child.kill()
+            except psutil.NoSuchProcess:
+                pass
+        for w in workers:
+            w.join()
+
+    cores_used = cpu / duration
+    return {
+        "engine": engine,
+        "matches": matches,
+        "threads": threads,
+        "cpu_cores": cores_used,
+        "updates_per_client": frames_delivered / duration / players,
+        "matches_per_core": matches / cores_used if cores_used else float("inf"),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--engines", nargs="+", default=["threaded", "asyncio"])
+    parser.add_argument("--matches", nargs="+", type=int, default=[10, 50, 100])
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--warmup", type=float, default=3.0)
+    parser.add_argument("--bot-procs", type=int, default=max(1, (os.cpu_count() or 2) - 1),
+                        help="number of processes running the bot clients")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="server worker processes (0: single-process server)")
+    args = parser.parse_args()
+
+    print(f"{'engine':>9} {'matches':>8} {'threads':>8} {'cpu cores':>10} {'upd/s/client':>13} {'matches/core':>13}")
+    for matches in args.matches:
+        for engine in args.engines:
+            r = measure(engine, matches, args.duration, args.warmup, args.bot_procs, args.workers)
+            print(f"{r['engine']:>9} {r['matches']:>8} {r['threads']:>8} {r['cpu_cores']:>10.2f} "
+                  f"{r['updates_per_client']:>13.1f} {r['matches_per_core']:>13.1f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""
+Stress check of the stream framing (protocol.FrameReader).
+
+A writer thread sends thousands of frames of every kind, from empty ones
+to ones larger than the reader's initial buffer, as one byte stream cut
+at random points: headers and payloads get split across writes, and many
+frames get coalesced into one. The reader checks every frame it decodes
+against what was sent. Runs over a Unix socket pair and over TCP loopback,
+then compares the throughput of FrameReader and the unbuffered recv_frame
+on an already coalesced stream.
+
+Exits with status 1 if any frame came out wrong.
+
+Usage (from the repository root):
+    python -m benchmarks.framing_stress --frames 20000 --seed 1
+"""
+
+import argparse
+import random
+import socket
+import sys
+import threading
+import time
+
+import protocol
+
+def random_frame(rng: random.Random) -> bytes:
+    kind = rng.random()
+    if kind < 0.4:
+        fields = ((rng.randrange(-500, 1000), rng.randrange(-500, 700)), rng.randrange(0, 840),
+                  rng.randrange(0, 840), (rng.randrange(4), rng.randrange(-1, 2), rng.randrange(3), 0, 3),
+                  ("".join(chr(rng.randrange(32, 0x3000)) for _ in range(rng.randrange(16))), "Bob"))
+        return protocol.pack_snapshot(rng.randrange(1, 0xFFFF), rng.randrange(0xFFFF), 7, fields)
+    if kind < 0.7:
+        return protocol.pack_input(rng.randrange(1, 0xFFFF), rng.choice((-1, 0, 1)), rng.randrange(0xFFFF))
+    if kind < 0.8:
+        return protocol.pack_play_again()
+    if kind < 0.99:
+        return protocol.pack_frame(rng.randrange(256), rng.randbytes(rng.randrange(200)))
+    # Larger than the reader's initial buffer, up to the largest frame
+    return protocol.pack_frame(rng.randrange(256), rng.randbytes(rng.randrange(protocol.RECV_BUFFER_SIZE, 0xFFFF)))
+
+def writer(sock: socket.socket, stream: bytes, rng: random.Random):
+    """Sends the stream in random cuts, pausing now and then so reads see partial data"""
+    pos = 0
+    while pos < len(stream):
+        size = rng.choice((1, 2, 3, rng.randrange(1, 64), rng.randrange(1, 4096), rng.randrange(1, 70000)))
+        sock.sendall(stream[pos:pos + size])
+        pos += size
+        # Let the reader catch up, always after a tiny cut so it often sees a split header
+        if size <= 3 or rng.random() < 0.01:
+            time.sleep(0.0002)
+    sock.shutdown(socket.SHUT_WR)
+
+def check(name: str, a: socket.socket, b: socket.socket, frames: list, seed: int) -> bool:
+    stream = b"".join(frames)
+    thread = threading.Thread(target=writer, args=(a, stream, random.Random(seed)))
+    start = time.perf_counter()
+    thread.start()
+
+    reader = protocol.FrameReader(b)
+    errors = 0
+    for i, frame in enumerate(frames):
+        msg_type, payload = reader.read_frame()
+        expected_type, expected_payload = protocol.parse_frame(frame)
+        if msg_type != expected_type or payload != expected_payload:
+            errors += 1
+            if errors <= 5:
+                print(f"{name}: frame {i} differs (type {msg_type}, {len(payload)} bytes)")
+    try:
+        reader.read_frame()
+        print(f"{name}: data after the last frame")
+        errors += 1
+    except ConnectionError:
+        pass
+    thread.join()
+    elapsed = time.perf_counter() - start
+    a.close()
+    b.close()
+
+    print(f"{name:>12}: {len(frames)} frames, {len(stream) / 1024:.0f} KiB, "
+          f"{'OK' if not errors else f'{errors} ERRORS'} ({elapsed:.2f} s)")
+    return not errors
+
+def tcp_pair():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as listener:
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(1)
+        a = socket.create_connection(listener.getsockname())
+        b, _ = listener.accept()
+    # Without Nagle every cut goes out as its own segment
+    a.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return a, b
+
+def throughput(frames: list):
+    """Frames per second read from a stream of small frames sent in one go"""
+    stream = b"".join(frames)
+    results = {}
+    for name, read in (("recv_frame", lambda sock: (lambda: protocol.recv_frame(sock))),
+                       ("FrameReader", lambda sock: protocol.FrameReader(sock).read_frame)):
+        a, b = socket.socketpair()
+        thread = threading.Thread(target=lambda: (a.sendall(stream), a.shutdown(socket.SHUT_WR)))
+        thread.start()
+        next_frame = read(b)
+        start = time.perf_counter()
+        for _ in frames:
+            next_frame()
+        results[name] = len(frames) / (time.perf_counter() - start)
+        thread.join()
+        a.close()
+        b.close()
+    print(f"\nthroughput on a coalesced stream of {len(frames)} small frames:")
+    for name, rate in results.items():
+        print(f"{name:>12}: {rate:>10,.0f} frames/s")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--frames", type=int, default=20000)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    frames = [random_frame(rng) for _ in range(args.frames)]
+    ok = check("socketpair", *socket.socketpair(), frames, args.seed)
+    ok = check("tcp", *tcp_pair(), frames, args.seed + 1) and ok
+
+    small = [protocol.pack_input(i % 0xFFFF + 1, 1, 1) for i in range(args.frames * 5)]
+    throughput(small)
+    sys.exit(0 if ok else 1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,292 @@
+"""
+Load test: thousands of headless bots (bot.py) against a local server.
+
+For every client count, starts `server.py` on a free local port, connects
+the bots from a pool of bot processes (they play, vote for rematches,
+leave at random and queue again) and reports, over the measurement window:
+
+  matches      matches sustained: pairs of bots getting at least
+               SUSTAINED_FRACTION of the send rate
+  upd/s        state updates per second per client
+  lat p50/p99  input to acknowledging state update, in milliseconds
+  jitter       standard deviation of the snapshot arrival times against
+               the server ticks they carry, in milliseconds
+  joins/leaves matches joined and left at random during the window
+  KB/s in/out  bandwidth seen by the clients (server to clients / back)
+  cpu, rss     server CPU (cores) and resident memory, workers included
+
+With --slow, --stall, --silent or --flood, that share of the bots misbehaves
+(see bot.py) and the figures above are of the well-behaved ones only, so
+they show what the others cost them. What the server did about the
+misbehaving bots is read from its metrics (see backpressure.py):
+
+  evicted      clients hung up on, for falling behind or going silent
+  skipped      snapshots not sent to clients too far behind
+  throttled    messages delayed or dropped for going over the message rate
+
+Results are also plotted to --plot with matplotlib.
+
+Usage (from the repository root):
+    python -m benchmarks.load --clients 200 1000 2000 --duration 20
+    python -m benchmarks.load --clients 2000 --engine asyncio --workers 4 --plot load.png
+    python -m benchmarks.load --clients 1000 --slow 0.05 --stall 0.05 --flood 0.05 --read-timeout 5
+"""
+
+import argparse
+import asyncio
+import multiprocessing
+import os
+import random
+import threading
+import time
+import urllib.request
+
+import numpy as np
+import psutil
+
+import backpressure
+import bot
+from bot import BotStats
+from benchmarks.engines import free_port, start_server, server_cpu
+from server import SEND_RATE
+
+# Share of the send rate a client must get for its match to count as sustained
+SUSTAINED_FRACTION = 0.9
+# Seconds between two samples of the server's CPU and memory
+SAMPLE_INTERVAL = 0.5
+# Server counters of what was done about misbehaving clients
+MISBEHAVIOUR_METRICS = {"evicted": "pong_clients_evicted_total", "skipped": "pong_snapshots_skipped_total",
+                        "throttled": "pong_messages_throttled_total"}
+
+def bot_process(port: int, behaviours: list, start_at: float, end_at: float, vote_rate: float,
+                disconnect_rate: float, seed: int, results):
+    """
+    Runs a bot per behaviour, each with its own stats, and sends back what
+    the well-behaved ones measured
+    """
+    stats = [BotStats(recording=False) for _ in behaviours]
+
+    async def run():
+        stop = asyncio.Event()
+        bots = []
+        for i, s in enumerate(stats):
+            bots.append(asyncio.create_task(
+                bot.run_bot("127.0.0.1", port, f"bot{seed + i}", s, stop, vote_rate, disconnect_rate, seed + i,
+                            behaviours[i])))
+            await asyncio.sleep(0.002)
+        await asyncio.sleep(max(0, start_at - time.time()))
+        for s in stats:
+            s.reset()
+        await asyncio.sleep(max(0, end_at - time.time()))
+        for s in stats:
+            s.recording = False
+        stop.set()
+        await asyncio.gather(*bots, return_exceptions=True)
+
+    asyncio.run(run())
+    stats = [s for s, behaviour in zip(stats, behaviours) if behaviour == "normal"]
+    results.put({
+        "updates": [s.updates for s in stats],
+        "bytes_received": sum(s.bytes_received for s in stats),
+        "bytes_sent": sum(s.bytes_sent for s in stats),
+        "sessions": sum(s.sessions for s in stats),
+        "disconnects": sum(s.disconnects for s in stats),
+        "errors": sum(s.errors for s in stats),
+        "latencies": [latency for s in stats for latency in s.latencies],
+        "jitter": [jitter for s in stats for jitter in s.jitter],
+    })
+
+def server_rss(server: psutil.Process) -> int:
+    """Resident memory in bytes of the server and its workers"""
+    total = 0
+    for p in [server] + server.children(recursive=True):
+        try:
+            total += p.memory_info().rss
+        except psutil.NoSuchProcess:
+            pass
+    return total
+
+def sample_server(server: psutil.Process, samples: list, stop: threading.Event):
+    """Appends (time, cpu cores, rss bytes) every SAMPLE_INTERVAL until stopped"""
+    last_time, last_cpu = time.time(), server_cpu(server)
+    while not stop.wait(SAMPLE_INTERVAL):
+        now, cpu = time.time(), server_cpu(server)
+        samples.append((now, (cpu - last_cpu) / (now - last_time), server_rss(server)))
+        last_time, last_cpu = now, cpu
+
+def scrape(port: int, workers: int) -> dict:
+    """MISBEHAVIOUR_METRICS of the server with metrics on `port`, summed over its workers"""
+    totals = dict.fromkeys(MISBEHAVIOUR_METRICS, 0)
+    # The front end of a sharded server on `port`, worker i on port + 1 + i
+    for metrics_port in range(port, port + 1 + workers):
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{metrics_port}/metrics", timeout=2) as response:
+                lines = response.read().decode().splitlines()
+        except OSError:
+            continue
+        for key, name in MISBEHAVIOUR_METRICS.items():
+            totals[key] += sum(int(float(line.split()[1])) for line in lines if line.startswith(name + " "))
+    return totals
+
+def behaviours(clients: int, args) -> list:
+    """What each bot does: the shares asked for misbehave, at random places in the pairing"""
+    kinds = []
+    for behaviour in ("slow", "stall", "silent", "flood"):
+        kinds += [behaviour] * round(clients * getattr(args, behaviour))
+    kinds = (kinds + ["normal"] * clients)[:clients]
+    random.Random(clients).shuffle(kinds)
+    return kinds
+
+def measure(clients: int, args) -> dict:
+    port = free_port()
+    metrics_port = free_port()
+    proc = start_server(args.engine, port, args.workers,
+                        ["--physics", args.physics, "--send-rate", str(args.send_rate),
+                         "--metrics-port", str(metrics_port), "--read-timeout", str(args.read_timeout),
+                         "--write-timeout", str(args.write_timeout), "--message-rate", str(args.message_rate)])
+    server = psutil.Process(proc.pid)
+    kinds = behaviours(clients, args)
+
+    ramp = clients * 0.002 / args.bot_procs
+    start_at = time.time() + args.warmup + ramp
+    end_at = start_at + args.duration
+    results = multiprocessing.Queue()
+    procs = []
+    seed = 0
+    for i in range(args.bot_procs):
+        count = clients // args.bot_procs + (1 if i < clients % args.bot_procs else 0)
+        p = multiprocessing.Process(target=bot_process,
+                                    args=(port, kinds[seed:seed + count], start_at, end_at, args.vote_rate,
+                                          args.disconnect_rate, seed, results))
+        p.start()
+        procs.append(p)
+        seed += count
+
+    samples = []
+    stop = threading.Event()
+    sampler = threading.Thread(target=sample_server, args=(server, samples, stop))
+    sampler.start()
+    try:
+        time.sleep(max(0, start_at - time.time()))
+        cpu_before = server_cpu(server)
+        time.sleep(max(0, end_at - time.time()))
+        cpu = server_cpu(server) - cpu_before
+        rss = server_rss(server)
+        parts = [results.get() for _ in procs]
+        misbehaviour = scrape(metrics_port, args.workers)
+    finally:
+        stop.set()
+        sampler.join()
+        # The server and its worker processes, which do not exit with it
+        children = server.children(recursive=True)
+        proc.kill()
+        proc.wait()
+        for child in children:
+            try:
+                child.kill()
+            except psutil.NoSuchProcess:
+                pass
+        for p in procs:
+            p.join()
+
+    duration = args.duration
+    rates = np.array([u for part in parts for u in part["updates"]]) / duration
+    latencies = np.array([l for part in parts for l in part["latencies"]]) * 1e3
+    jitter = np.array([j for part in parts for j in part["jitter"]]) * 1e3
+    return {
+        "clients": clients,
+        "misbehaving": sum(kind != "normal" for kind in kinds),
+        "matches": int((rates >= SUSTAINED_FRACTION * args.send_rate).sum()) // 2,
+        "updates_per_client": rates.mean(),
+        "latency_p50": np.percentile(latencies, 50) if latencies.size else float("nan"),
+        "latency_p99": np.percentile(latencies, 99) if latencies.size else float("nan"),
+        "latencies": latencies,
+        "jitter": jitter.std() if jitter.size else float("nan"),
+        "kb_in": sum(part["bytes_received"] for part in parts) / duration / 1024,
+        "kb_out": sum(part["bytes_sent"] for part in parts) / duration / 1024,
+        "cpu_cores": cpu / duration,
+        "rss_mb": rss / 2**20,
+        "joins": sum(part["sessions"] for part in parts),
+        "leaves": sum(part["disconnects"] for part in parts),
+        "errors": sum(part["errors"] for part in parts),
+        "samples": [(t - start_at, c, r / 2**20) for t, c, r in samples],
+        **misbehaviour,
+    }
+
+def plot(results: list, path: str):
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    fig, axes = plt.subplots(2, 2, figsize=(12, 8))
+    clients = [r["clients"] for r in results]
+
+    ax = axes[0][0]
+    ax.plot(clients, [r["matches"] for r in results], "o-", label="sustained")
+    ax.plot(clients, [r["clients"] // 2 for r in results], "--", color="gray", label="offered")
+    ax.set(title="Matches sustained", xlabel="clients", ylabel="matches")
+    ax.legend()
+
+    ax = axes[0][1]
+    for r in results:
+        if r["latencies"].size:
+            ax.plot(np.sort(r["latencies"]), np.linspace(0, 1, r["latencies"].size), label=f"{r['clients']} clients")
+    ax.set(title="Input to state update latency", xlabel="ms", ylabel="CDF", xscale="log")
+    ax.legend()
+
+    ax = axes[1][0]
+    for r in results:
+        ax.plot([s[0] for s in r["samples"]], [s[1] for s in r["samples"]], label=f"{r['clients']} clients")
+    ax.set(title="Server CPU", xlabel="s since measurement start", ylabel="cores")
+    ax.legend()
+
+    ax = axes[1][1]
+    for r in results:
+        ax.plot([s[0] for s in r["samples"]], [s[2] for s in r["samples"]], label=f"{r['clients']} clients")
+    ax.set(title="Server RSS", xlabel="s since measurement start", ylabel="MiB")
+    ax.legend()
+
+    fig.tight_layout()
+    fig.savefig(path)
+    print(f"Plot saved to {path}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--clients", nargs="+", type=int, default=[100, 500, 1000])
+    parser.add_argument("--engine", choices=("threaded", "asyncio"), default="asyncio")
+    parser.add_argument("--workers", type=int, default=0)
+    parser.add_argument("--physics", choices=("per-game", "batch"), default="per-game")
+    parser.add_argument("--send-rate", type=int, default=SEND_RATE)
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--warmup", type=float, default=3.0)
+    parser.add_argument("--vote-rate", type=float, default=0.9,
+                        help="probability a bot votes for a rematch instead of leaving")
+    parser.add_argument("--disconnect-rate", type=float, default=0.01,
+                        help="probability per second that a bot leaves its match")
+    parser.add_argument("--bot-procs", type=int, default=max(1, (os.cpu_count() or 2) - 1),
+                        help="number of processes running the bots")
+    parser.add_argument("--plot", default="load.png", help="output image ('' to skip)")
+    for behaviour in ("slow", "stall", "silent", "flood"):
+        parser.add_argument(f"--{behaviour}", type=float, default=0.0, metavar="FRACTION",
+                            help=f"share of the bots that are {behaviour} (see bot.py)")
+    parser.add_argument("--read-timeout", type=float, default=backpressure.READ_TIMEOUT)
+    parser.add_argument("--write-timeout", type=float, default=backpressure.WRITE_TIMEOUT)
+    parser.add_argument("--message-rate", type=int, default=backpressure.MESSAGE_RATE)
+    args = parser.parse_args()
+
+    results = []
+    print(f"{'clients':>8} {'matches':>8} {'upd/s':>6} {'lat p50':>8} {'lat p99':>8} {'jitter':>7} "
+          f"{'KB/s in':>8} {'KB/s out':>9} {'cpu':>5} {'rss MB':>7} {'joins':>6} {'leaves':>7} {'errors':>7} "
+          f"{'misbehaving':>12} {'evicted':>8} {'skipped':>8} {'throttled':>10}")
+    for clients in args.clients:
+        r = measure(clients, args)
+        results.append(r)
+        print(f"{r['clients']:>8} {r['matches']:>8} {r['updates_per_client']:>6.1f} {r['latency_p50']:>8.1f} "
+              f"{r['latency_p99']:>8.1f} {r['jitter']:>7.2f} {r['kb_in']:>8.1f} {r['kb_out']:>9.1f} "
+              f"{r['cpu_cores']:>5.2f} {r['rss_mb']:>7.1f} {r['joins']:>6} {r['leaves']:>7} {r['errors']:>7} "
+              f"{r['misbehaving']:>12} {r['evicted']:>8} {r['skipped']:>8} {r['throttled']:>10}")
+    if args.plot:
+        plot(results, args.plot)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+"""
+Proxy that emulates a bad network between clients and the server.
+
+Listens on one port for both TCP and UDP and forwards everything to the
+server. Datagrams are dropped with the given probability and every packet,
+TCP chunks included, is held for the given latency plus random jitter, in
+each direction. TCP is never dropped (the kernel would retransmit anyway),
+so the difference between `--udp` and TCP-only play shows up as stalls.
+
+Usage (from the repository root):
+    python server.py --udp
+    python -m benchmarks.lossy_proxy --port 5556 --loss 0.05 --latency 60 --jitter 20
+    SERVER_PORT=5556 python client.py
+"""
+
+import argparse
+import asyncio
+import os
+import random
+
+from dotenv import load_dotenv
+
+class Impairment:
+    def __init__(self, loss: float, latency: float, jitter: float):
+        self.loss = loss
+        self.latency = latency
+        self.jitter = jitter
+        self.forwarded = 0
+        self.dropped = 0
+
+    def delay(self) -> float:
+        return max(0.0, self.latency + random.uniform(-self.jitter, self.jitter))
+
+    def drop(self) -> bool:
+        if random.random() < self.loss:
+            self.dropped += 1
+            return True
+        self.forwarded += 1
+        return False
+
+async def pipe(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, impairment: Impairment):
+    loop = asyncio.get_running_loop()
+    # Chunks keep their order: each is released no earlier than the previous one
+    release = 0.0
+    try:
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                break
+            release = max(release, loop.time() + impairment.delay())
+            loop.call_at(release, writer.write, data)
+    except ConnectionError:
+        pass
+    finally:
+        loop.call_at(release, writer.close)
+
+class UpstreamProtocol(asyncio.DatagramProtocol):
+    """One per client address, so the server sees a distinct peer per client"""
+    def __init__(self, downstream: asyncio.DatagramTransport, client_addr, impairment: Impairment):
+        self.downstream = downstream
+        self.client_addr = client_addr
+        self.impairment = impairment
+
+    def datagram_received(self, data: bytes, addr):
+        if not self.impairment.drop():
+            loop = asyncio.get_running_loop()
+            loop.call_later(self.impairment.delay(), self.downstream.sendto, data, self.client_addr)
+
+class DownstreamProtocol(asyncio.DatagramProtocol):
+    def __init__(self, server_addr, impairment: Impairment):
+        self.server_addr = server_addr
+        self.impairment = impairment
+        self.transport = None
+        self.upstreams = {}
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, addr):
+        if self.impairment.drop():
+            return
+        asyncio.get_running_loop().create_task(self.forward(data, addr))
+
+    async def forward(self, data: bytes, addr):
+        loop = asyncio.get_running_loop()
+        upstream = self.upstreams.get(addr)
+        if upstream is None:
+            upstream, _ = await loop.create_datagram_endpoint(
+                lambda: UpstreamProtocol(self.transport, addr, self.impairment),
+                remote_addr=self.server_addr)
+            self.upstreams[addr] = upstream
+        loop.call_later(self.impairment.delay(), upstream.sendto, data)
+
+async def report(impairment: Impairment):
+    while True:
+        await asyncio.sleep(5)
+        total = impairment.forwarded + impairment.dropped
+        if total:
+            print(f"datagrams: {impairment.forwarded} forwarded, {impairment.dropped} dropped "
+                  f"({impairment.dropped / total:.1%})")
+
+async def run(args):
+    impairment = Impairment(args.loss, args.latency / 1000, args.jitter / 1000)
+    server_addr = (args.server_ip, args.server_port)
+
+    async def on_connect(client_reader, client_writer):
+        try:
+            server_reader, server_writer = await asyncio.open_connection(*server_addr)
+        except OSError as e:
+            print(f"Cannot reach server: {e}")
+            client_writer.close()
+            return
+        await asyncio.gather(pipe(client_reader, server_writer, impairment),
+                             pipe(server_reader, client_writer, impairment))
+
+    loop = asyncio.get_running_loop()
+    await loop.create_datagram_endpoint(lambda: DownstreamProtocol(server_addr, impairment),
+                                        local_addr=(args.ip, args.port))
+    server = await asyncio.start_server(on_connect, args.ip, args.port)
+    print(f"Proxy {args.ip}:{args.port} -> {server_addr[0]}:{server_addr[1]} "
+          f"(loss {args.loss:.0%}, latency {args.latency:.0f} ms +/- {args.jitter:.0f} ms)")
+    asyncio.get_running_loop().create_task(report(impairment))
+    async with server:
+        await server.serve_forever()
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--ip", default="127.0.0.1")
+    parser.add_argument("--port", type=int, required=True)
+    parser.add_argument("--server-ip", default=os.getenv("SERVER_IP", "127.0.0.1"))
+    parser.add_argument("--server-port", type=int, default=int(os.getenv("SERVER_PORT", "5555")))
+    parser.add_argument("--loss", type=float, default=0.0, help="probability of dropping a datagram")
+    parser.add_argument("--latency", type=float, default=0.0, help="one-way delay in ms")
+    parser.add_argument("--jitter", type=float, default=0.0, help="random +/- ms added to the delay")
+    args = parser.parse_args()
+    try:
+        asyncio.run(run(args))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""
+Matches formed per second by the Matchmaker under a burst of joins.
+
+`--joins` players join at once from `--threads` threads. A fraction of the
+games left waiting is cancelled, like a player quitting before an opponent
+came, and the rest are paired by the players that follow. Scenarios:
+  public   every player in one rating bucket
+  ratings  ratings spread over --buckets buckets (neighbours pair too)
+  rooms    pairs of players sharing a room code
+
+Usage (from the repository root):
+    python -m benchmarks.matchmaking --joins 10000 --cancel 0.1 --threads 1 4
+"""
+
+import argparse
+import random
+import threading
+import time
+
+from matchmaking import Matchmaker, INITIAL_RATING, RATING_BUCKET_WIDTH
+
+def make_players(scenario: str, joins: int, buckets: int, rng: random.Random):
+    """(rating, room) of each player, in join order"""
+    if scenario == "rooms":
+        codes = [f"r{i}" for i in range(joins // 2)] * 2
+        rng.shuffle(codes)
+        return [(INITIAL_RATING, code) for code in codes]
+    if scenario == "ratings":
+        return [(rng.randrange(buckets * RATING_BUCKET_WIDTH), "") for _ in range(joins)]
+    return [(INITIAL_RATING, "")] * joins
+
+def run(queue, players: list, cancel: float, threads: int, seed: int):
+    """Returns (seconds, matches formed, games cancelled)"""
+    counter = iter(range(len(players)))
+    results = [None] * threads
+    start_barrier = threading.Barrier(threads + 1)
+
+    def worker(index: int, part: list):
+        rng = random.Random(seed + index)
+        matched = cancelled = 0
+        start_barrier.wait()
+        for rating, room in part:
+            entry, player_id = queue.join(lambda: next(counter), rating, room)
+            if player_id == 1:
+                matched += 1
+            elif rng.random() < cancel and queue.cancel(entry):
+                cancelled += 1
+        results[index] = (matched, cancelled)
+
+    workers = [threading.Thread(target=worker, args=(i, players[i::threads])) for i in range(threads)]
+    for thread in workers:
+        thread.start()
+    start_barrier.wait()
+    start = time.perf_counter()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    return elapsed, sum(r[0] for r in results), sum(r[1] for r in results)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--joins", type=int, default=10000)
+    parser.add_argument("--cancel", type=float, default=0.1,
+                        help="fraction of waiting games cancelled right after being queued")
+    parser.add_argument("--buckets", type=int, default=20, help="rating buckets of the ratings scenario")
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    print(f"{args.joins} joins, {args.cancel:.0%} of waiting games cancelled")
+    print(f"{'scenario':>9} {'threads':>8} {'matches':>8} {'cancelled':>10} {'ms':>8} {'matches/s':>11}")
+    for scenario in ("public", "ratings", "rooms"):
+        players = make_players(scenario, args.joins, args.buckets, random.Random(args.seed))
+        for threads in args.threads:
+            elapsed, matched, cancelled = run(Matchmaker(), players, args.cancel, threads, args.seed)
+            print(f"{scenario:>9} {threads:>8} {matched:>8} {cancelled:>10} "
+                  f"{elapsed * 1000:>8.1f} {matched / elapsed:>11.0f}")
+
+if __name__ == "__main__":
+    main()
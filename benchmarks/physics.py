@@ -0,0 +1,126 @@
+"""
+Compare ticks per second of the per-game and batch physics engines.
+
+For every match count, creates that many matches in play and times how long
+each engine takes to advance all of them by one tick: server.update_game
+called once per match, or one BatchPhysics.step for the whole batch. With
+batch physics the ball has to be read out of the arrays whenever a
+snapshot is encoded; `batch+read` adds one such Game.get_state() per match
+and tick (two players at the default 30 Hz send rate). Bots (outside the timed
+section) steer the rackets towards the ball and restart finished matches
+so the load stays constant.
+
+Before timing, both engines run the same randomized matches side by side
+and every tick's state is compared, so the numbers are for identical work.
+
+Usage (from the repository root):
+    python -m benchmarks.physics --matches 10 100 1000 5000 --ticks 300
+"""
+
+import argparse
+import random
+import time
+
+from batch_physics import BatchPhysics
+from server import Game, update_game, BALL_RADIUS, PADDLE_WIDTH, PADDLE_SPEED, TICK_RATE
+
+DT = 1 / TICK_RATE
+
+def new_match(i: int) -> Game:
+    game = Game(str(i))
+    with game.lock:
+        game.state.countdown = 0
+        game.state.game_started = True
+        game.publish()
+    return game
+
+def play(games: list, rng: random.Random, skill: float):
+    """
+    Moves each racket towards the ball, missing now and then so matches end,
+    and restarts finished matches.
+    """
+    for game in games:
+        state = game.get_state()
+        if state.winner_id is not None:
+            game.reset_game()
+            with game.lock:
+                game.state.countdown = 0
+                game.state.ball_speed = [rng.choice((-4, 4)), rng.choice((-4, 4))]
+                game.push_physics(ball=True)
+                game.publish()
+            continue
+        ball_x = state.ball[0]
+        for player_id, paddle_x in enumerate(state.paddles_x):
+            offset = ball_x + BALL_RADIUS - (paddle_x + PADDLE_WIDTH // 2)
+            if abs(offset) >= PADDLE_SPEED and rng.random() < skill:
+                game.move_paddle(player_id, 1 if offset > 0 else -1)
+
+def state_of(game: Game) -> tuple:
+    state = game.get_state()
+    return (state.tick, state.ball_pos, state.ball, state.ball_speed, state.paddles_x, state.winner_id)
+
+def check_parity(matches: int, ticks: int):
+    """Plays the same matches on both engines and compares every tick"""
+    per_game = [new_match(i) for i in range(matches)]
+    batched = [new_match(i) for i in range(matches)]
+    physics = BatchPhysics()
+    for game in batched:
+        physics.add(game)
+    rng_a, rng_b = random.Random(1), random.Random(1)
+    winners = 0
+    for tick in range(ticks):
+        play(per_game, rng_a, 0.9)
+        play(batched, rng_b, 0.9)
+        for game in per_game:
+            update_game(game, DT)
+        physics.step(DT)
+        for a, b in zip(per_game, batched):
+            if state_of(a) != state_of(b):
+                raise AssertionError(f"Engines diverged at tick {tick} in match {a.game_id}: "
+                                     f"{state_of(a)} != {state_of(b)}")
+        winners += sum(game.get_state().winner_id is not None for game in per_game)
+    print(f"parity: {matches} matches x {ticks} ticks identical ({winners} match ends)")
+
+def measure(matches: int, ticks: int, batch: bool, read: bool = False) -> float:
+    """Returns ticks per second over all matches"""
+    games = [new_match(i) for i in range(matches)]
+    rng = random.Random(2)
+    physics = BatchPhysics()
+    for game in games:
+        physics.add(game)
+    elapsed = 0.0
+    for _ in range(ticks):
+        play(games, rng, 0.98)
+        start = time.perf_counter()
+        if batch:
+            physics.step(DT)
+            if read:
+                for game in games:
+                    game.get_state()
+        else:
+            for game in games:
+                update_game(game, DT)
+        elapsed += time.perf_counter() - start
+    return ticks / elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--matches", nargs="+", type=int, default=[10, 100, 1000, 5000])
+    parser.add_argument("--ticks", type=int, default=300)
+    parser.add_argument("--parity-matches", type=int, default=200)
+    parser.add_argument("--parity-ticks", type=int, default=3000)
+    args = parser.parse_args()
+
+    check_parity(args.parity_matches, args.parity_ticks)
+
+    print(f"{'matches':>8} {'per-game':>10} {'batch':>10} {'batch+read':>11}  (ticks/s over all matches)")
+    for matches in args.matches:
+        scalar = measure(matches, args.ticks, False)
+        batch = measure(matches, args.ticks, True)
+        read = measure(matches, args.ticks, True, read=True)
+        print(f"{matches:>8} {scalar:>10.1f} {batch:>10.1f} {read:>11.1f}  "
+              f"speedup {batch / scalar:.1f}x / {read / scalar:.1f}x")
+    print(f"A server keeps up with a match count while ticks/s stays above {TICK_RATE}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""
+Snapshot staleness on constrained links, fixed against adaptive send rates.
+
+One client's link is simulated in steps of --step seconds: what the server
+sends waits in a queue drained at the link's bandwidth (each frame costing
+--overhead bytes of TCP/IP headers on top of its own), then takes --delay
+seconds to arrive, and a PONG as long to come back. The server side is the
+real one: qos.Link measures the link from the PINGs and the bytes still
+queued, as server.py's sender does with the socket's send buffer, and
+snapshots are skipped while more than backpressure.SEND_BACKLOG bytes are
+queued. qos.py reads the simulated clock instead of the real one.
+
+For each bandwidth, a client sent the server's --send-rate throughout
+(server.py --fixed-send-rate) is compared to one whose rate adapts:
+snapshots delivered per second, how old they are when they arrive (queueing
+plus delay), and the round-trip time the pings measured.
+
+The benchmark fails if adapting lowers the rate of a link that can carry
+it (the first bandwidth).
+
+Usage (from the repository root):
+    python -m benchmarks.qos --bandwidths 100000,3000,1500,800
+"""
+
+import argparse
+import collections
+import statistics
+import sys
+
+import backpressure
+import protocol
+import qos
+
+class SimulatedTime:
+    """Stands in for the time module in qos.py"""
+    def __init__(self):
+        self.now = 0.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+def simulate(bandwidth: float, delay: float, send_rate: int, seconds: float, step: float, snapshot_bytes: int,
+             overhead: int, adaptive: bool) -> dict:
+    clock = SimulatedTime()
+    qos.time = clock
+    qos.adaptive = adaptive
+    link = qos.Link(send_rate)
+    # Frames waiting for the link: [wire bytes left, payload bytes, "snapshot" | PING stamp, sent at]
+    queue = collections.deque()
+    pongs = []
+    unsent = bytes_sent = skipped = 0
+    ages, rates = [], []
+    next_send = 0.0
+    while clock.now < seconds:
+        clock.now += step
+        budget = bandwidth * step
+        while queue and budget > 0:
+            frame = queue[0]
+            taken = min(budget, frame[0])
+            frame[0] -= taken
+            budget -= taken
+            if frame[0] > 0:
+                break
+            queue.popleft()
+            unsent -= frame[1]
+            if frame[2] == "snapshot":
+                ages.append(clock.now + delay - frame[3])
+            else:
+                pongs.append((clock.now + 2 * delay, frame[2]))
+        for arrival, stamp in [pong for pong in pongs if pong[0] <= clock.now]:
+            pongs.remove((arrival, stamp))
+            link.pong(stamp)
+        if link.due():
+            ping = link.ping(bytes_sent, unsent)
+            queue.append([len(ping) + overhead, len(ping), protocol.unpack_ping(ping[protocol.HEADER.size:])[0],
+                          clock.now])
+            unsent += len(ping)
+            bytes_sent += len(ping)
+            rates.append(link.send_rate)
+        if clock.now >= next_send:
+            if unsent > backpressure.SEND_BACKLOG:
+                skipped += 1
+            else:
+                queue.append([snapshot_bytes + overhead, snapshot_bytes, "snapshot", clock.now])
+                unsent += snapshot_bytes
+                bytes_sent += snapshot_bytes
+            next_send += 1 / link.send_rate
+    # The first seconds are the link filling up or the rate settling
+    settled = ages[len(ages) // 4:]
+    return {
+        "delivered": len(ages) / seconds,
+        "skipped": skipped / seconds,
+        "age": statistics.mean(settled) if settled else 0.0,
+        "age_p99": statistics.quantiles(settled, n=100)[98] if len(settled) > 1 else 0.0,
+        "rtt": link.rtt or 0.0,
+        "rate": statistics.mean(rates[len(rates) // 4:]),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--bandwidths", default="100000,3000,1500,800", help="bytes per second, comma separated")
+    parser.add_argument("--delay", type=float, default=0.03, help="one-way seconds")
+    parser.add_argument("--send-rate", type=int, default=60)
+    parser.add_argument("--seconds", type=float, default=60)
+    parser.add_argument("--step", type=float, default=0.001)
+    parser.add_argument("--snapshot-bytes", type=int, default=18, help="a delta with the ball and a paddle moved")
+    parser.add_argument("--overhead", type=int, default=52, help="TCP/IP header bytes per frame")
+    args = parser.parse_args()
+
+    bandwidths = [float(bandwidth) for bandwidth in args.bandwidths.split(",")]
+    print(f"{'bytes/s':>8} {'rate':>9} {'sent/s':>7} {'delivered/s':>12} {'skipped/s':>10} {'age ms':>7} "
+          f"{'p99':>7} {'rtt ms':>7}")
+    results = {}
+    for bandwidth in bandwidths:
+        for adaptive in (False, True):
+            result = simulate(bandwidth, args.delay, args.send_rate, args.seconds, args.step, args.snapshot_bytes,
+                              args.overhead, adaptive)
+            results[bandwidth, adaptive] = result
+            print(f"{bandwidth:>8.0f} {'adaptive' if adaptive else 'fixed':>9} {result['rate']:>7.1f} "
+                  f"{result['delivered']:>12.1f} {result['skipped']:>10.1f} {result['age'] * 1000:>7.0f} "
+                  f"{result['age_p99'] * 1000:>7.0f} {result['rtt'] * 1000:>7.0f}")
+
+    ok = results[bandwidths[0], True]["delivered"] >= 0.95 * results[bandwidths[0], False]["delivered"]
+    if not ok:
+        print(f"  adapting lowered the rate of a {bandwidths[0]:.0f} bytes/s link")
+    sys.exit(0 if ok else 1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+"""
+Throughput of the ratings store, and check of what it writes.
+
+--results match results between --players players (picked at random, the
+better rated one winning more often) are recorded two ways:
+  write-behind   ratings.Ratings.record(), as the server does: the caller
+                 only updates memory, a writer thread batches the rows
+  write-through  each result written and committed before the next one,
+                 as a store without the writer thread would
+For write-behind, both what the caller waits per result and the time until
+everything is on disk (flush()) are timed.
+
+Then leaderboard() is timed as the server serves it, cached between
+results that do not change it, against ranking every player each call, with
+a result recorded every --lookups-per-result lookups.
+
+The benchmark fails if the database, opened again, does not hold every
+match and exactly the ratings and records held in memory.
+
+Usage (from the repository root):
+    python -m benchmarks.ratings --results 20000 --players 1000
+"""
+
+import argparse
+import heapq
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+import ratings
+from ratings import Ratings, SCHEMA
+
+def pairings(results: int, players: int, seed: int) -> list:
+    """(winner, loser) names: lower numbered players are stronger"""
+    rng = random.Random(seed)
+    pairs = []
+    for _ in range(results):
+        a, b = rng.sample(range(players), 2)
+        stronger, weaker = min(a, b), max(a, b)
+        won = rng.random() < 0.5 + (weaker - stronger) / players / 2
+        pairs.append((f"player{stronger}", f"player{weaker}") if won else (f"player{weaker}", f"player{stronger}"))
+    return pairs
+
+def write_behind(path: str, pairs: list):
+    """Returns (store, seconds per record() call, until flushed)"""
+    store = Ratings(path)
+    calls = []
+    start = time.perf_counter()
+    for winner, loser in pairs:
+        call = time.perf_counter()
+        store.record(winner, loser)
+        calls.append(time.perf_counter() - call)
+    store.flush()
+    return store, calls, time.perf_counter() - start
+
+def write_through(path: str, pairs: list) -> float:
+    """Seconds to write and commit each result in turn, ratings computed the same way"""
+    db = sqlite3.connect(path)
+    db.executescript(SCHEMA)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    memory = Ratings(":memory:")
+    start = time.perf_counter()
+    for winner, loser in pairs:
+        with memory.lock:
+            won = memory.players.setdefault(winner, ratings.Rating(winner))
+            lost = memory.players.setdefault(loser, ratings.Rating(loser))
+            change = memory.k_factor * (1 - ratings.expected_score(won.rating, lost.rating))
+            won.rating += change
+            lost.rating -= change
+            won.wins += 1
+            lost.losses += 1
+        with db:
+            db.execute("INSERT INTO matches (played_at, winner, loser, winner_rating, loser_rating) "
+                       "VALUES (?, ?, ?, ?, ?)", (time.time(), winner, loser, won.rating, lost.rating))
+            db.executemany("INSERT OR REPLACE INTO players (name, rating, wins, losses) VALUES (?, ?, ?, ?)",
+                           (won.row(), lost.row()))
+    elapsed = time.perf_counter() - start
+    db.close()
+    return elapsed
+
+def time_leaderboard(store: Ratings, pairs: list, lookups_per_result: int, cached: bool) -> float:
+    """Seconds per leaderboard lookup, recording a result between every `lookups_per_result`"""
+    lookups = 0
+    elapsed = 0.0
+    for winner, loser in pairs:
+        store.record(winner, loser)
+        start = time.perf_counter()
+        for _ in range(lookups_per_result):
+            if cached:
+                store.leaderboard()
+            else:
+                with store.lock:
+                    [player.row() for player in heapq.nlargest(ratings.LEADERBOARD_SIZE, store.players.values(),
+                                                               key=lambda player: player.rating)]
+        elapsed += time.perf_counter() - start
+        lookups += lookups_per_result
+    return elapsed / lookups
+
+def check(store: Ratings, path: str, results: int) -> list:
+    """What the database holds that differs from memory"""
+    problems = []
+    reopened = Ratings(path)
+    if {name: player.row() for name, player in reopened.players.items()} != \
+            {name: player.row() for name, player in store.players.items()}:
+        problems.append("ratings on disk differ from the ones in memory")
+    db = sqlite3.connect(path)
+    matches = db.execute("SELECT COUNT(*) FROM matches").fetchone()[0]
+    db.close()
+    if matches != results:
+        problems.append(f"{matches} matches on disk, {results} recorded")
+    if store.leaderboard() != reopened.leaderboard():
+        problems.append("leaderboard differs once reloaded")
+    return problems
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--results", type=int, default=20000)
+    parser.add_argument("--players", type=int, default=1000)
+    parser.add_argument("--lookups-per-result", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    pairs = pairings(args.results, args.players, args.seed)
+    with tempfile.TemporaryDirectory() as directory:
+        behind_path = os.path.join(directory, "behind.db")
+        store, calls, behind = write_behind(behind_path, pairs)
+        through = write_through(os.path.join(directory, "through.db"), pairs)
+        problems = check(store, behind_path, args.results)
+
+        print(f"{'store':>14} {'results/s':>10} {'caller us/result':>17} {'p99':>7}")
+        print(f"{'write-behind':>14} {args.results / behind:>10.0f} {statistics.mean(calls) * 1e6:>17.1f} "
+              f"{statistics.quantiles(calls, n=100)[98] * 1e6:>7.1f}")
+        print(f"{'write-through':>14} {args.results / through:>10.0f} {through / args.results * 1e6:>17.1f} {'':>7}")
+
+        lookups = pairs[:max(1, args.results // 10)]
+        cached = time_leaderboard(store, lookups, args.lookups_per_result, cached=True)
+        ranked = time_leaderboard(store, lookups, args.lookups_per_result, cached=False)
+        print(f"leaderboard of {len(store.players)} players: {cached * 1e6:.2f} us cached, "
+              f"{ranked * 1e6:.1f} us ranking every call ({ranked / cached:.0f}x)")
+        store.flush()
+
+    for problem in problems:
+        print(f"  {problem}")
+    sys.exit(1 if problems else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""
+Replay throughput, in ball steps per second, of replay.py.
+
+Recordings are made in memory by playing matches through the server's own
+Game and update_game, with two rackets that follow the ball but sometimes
+move the wrong way (`--skill`), so rallies end and matches get winners.
+Then every recording is replayed with 1 and more processes, and checked:
+the benchmark fails if a replay does not reach the recorded winners.
+
+Usage (from the repository root):
+    python -m benchmarks.replay --recordings 200 --matches 3 --jobs 1 4
+"""
+
+import argparse
+import random
+import sys
+import time
+from multiprocessing import Pool
+
+import recording
+from replay import replay
+from server import Game, BALL_RADIUS, PADDLE_WIDTH, COUNTDOWN, TICK_RATE, update_game
+
+def record_game(index: int, matches: int, skill: float, tick_rate: int, seed: int) -> bytes:
+    """Plays `matches` matches in one game and returns its recording"""
+    rng = random.Random(seed + index)
+    chunks = []
+    game = Game(str(index), tick_rate)
+    game.recorder = recording.Recorder(game.game_id, tick_rate, lambda data, close: chunks.append(data))
+    game.set_player_name(0, "bot0")
+    game.set_player_name(1, "bot1")
+    for match in range(matches):
+        if match:
+            game.reset_game()
+        for _ in range(COUNTDOWN):
+            game.decrement_countdown(game.countdown_run)
+        while game.get_state().winner_id is None:
+            state = game.get_state()
+            for player_id in (0, 1):
+                offset = state.ball[0] + BALL_RADIUS - (state.paddles_x[player_id] + PADDLE_WIDTH // 2)
+                direction = 1 if offset > 0 else -1
+                if rng.random() > skill:
+                    direction = -direction
+                game.move_paddle(player_id, direction)
+            update_game(game, 1 / tick_rate)
+    game.deactivate()
+    return b"".join(chunks)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--recordings", type=int, default=200)
+    parser.add_argument("--matches", type=int, default=3, help="matches (rematches) per recording")
+    parser.add_argument("--skill", type=float, default=0.8,
+                        help="probability that a racket moves towards the ball on a tick")
+    parser.add_argument("--tick-rate", type=int, default=TICK_RATE)
+    parser.add_argument("--jobs", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    logs = [record_game(i, args.matches, args.skill, args.tick_rate, args.seed) for i in range(args.recordings)]
+    elapsed = time.perf_counter() - start
+    size = sum(len(log) for log in logs)
+    print(f"{args.recordings} recordings of {args.matches} matches made in {elapsed:.1f}s, "
+          f"{size / len(logs):.0f} bytes each on average")
+
+    print(f"{'jobs':>5} {'steps':>10} {'ms':>9} {'steps/s':>11} {'recordings/s':>13} {'failed':>7}")
+    failed = 0
+    for jobs in args.jobs:
+        start = time.perf_counter()
+        if jobs > 1:
+            with Pool(jobs) as pool:
+                results = pool.map(replay, logs, chunksize=max(1, len(logs) // (jobs * 4)))
+        else:
+            results = [replay(log) for log in logs]
+        elapsed = time.perf_counter() - start
+        steps = sum(result.steps for result in results)
+        bad = sum(not result.verified for result in results)
+        failed += bad
+        print(f"{jobs:>5} {steps:>10} {elapsed * 1000:>9.1f} {steps / elapsed:>11.0f} "
+              f"{len(logs) / elapsed:>13.0f} {bad:>7}")
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+"""
+Cost of streaming a match to many spectators, and check of their streams.
+
+A match is played in memory through the server's own Game and update_game,
+with rackets that follow the ball but sometimes move the wrong way. Every
+tick, --viewers spectators get the latest snapshot two ways, each timed:
+  broadcast   spectators.Broadcast.publish(), which encodes it once for all
+  per viewer  Player.encode_snapshot() for each viewer, as players get it
+One spectator is slow: it is only drained every --slow-every ticks, so its
+queue keeps overflowing.
+
+Every spectator's stream is decoded with protocol.unpack_snapshot. The
+benchmark fails if a frame does not decode, a stream does not end on the
+game's final state, or the slow spectator ever holds more than
+spectators.SPECTATOR_QUEUE frames.
+
+Usage (from the repository root):
+    python -m benchmarks.spectators --viewers 1 10 100 500 --ticks 2000
+"""
+
+import argparse
+import random
+import sys
+import time
+
+import protocol
+from server import Game, Player, BALL_RADIUS, PADDLE_WIDTH, COUNTDOWN, TICK_RATE, update_game
+from spectators import Broadcast, Spectator, SPECTATOR_QUEUE
+
+class Viewer:
+    """Client side of a spectator: decodes what it is sent"""
+    def __init__(self):
+        self.history = {}
+        self.fields = None
+        self.frames = 0
+        self.bytes = 0
+        self.errors = []
+
+    def receive(self, frames: list):
+        for frame in frames:
+            self.frames += 1
+            self.bytes += len(frame)
+            try:
+                msg_type, payload = protocol.parse_frame(frame)
+                if msg_type != protocol.MSG_SNAPSHOT:
+                    raise protocol.ProtocolError(f"Unexpected message {msg_type}")
+                seq, _, _, fields = protocol.unpack_snapshot(payload, self.history)
+            except protocol.ProtocolError as e:
+                self.errors.append(str(e))
+                continue
+            self.history[seq] = fields
+            self.fields = fields
+
+def move_rackets(game: Game, rng: random.Random, skill: float):
+    state = game.get_state()
+    for player_id in (0, 1):
+        offset = state.ball[0] + BALL_RADIUS - (state.paddles_x[player_id] + PADDLE_WIDTH // 2)
+        direction = 1 if offset > 0 else -1
+        if rng.random() > skill:
+            direction = -direction
+        game.move_paddle(player_id, direction)
+
+def run(viewers: int, ticks: int, slow_every: int, skill: float, seed: int):
+    """Plays `ticks` ticks to `viewers` spectators. Returns (stats, problems)"""
+    rng = random.Random(seed)
+    game = Game("bench")
+    game.set_player_name(0, "bot0")
+    game.set_player_name(1, "bot1")
+    game.update_connected_players(2)
+    for _ in range(COUNTDOWN):
+        game.decrement_countdown(game.countdown_run)
+
+    broadcast = Broadcast(game)
+    spectators = [Spectator(lambda: None) for _ in range(viewers)]
+    clients = [Viewer() for _ in spectators]
+    for spectator in spectators:
+        broadcast.add(spectator)
+    players = []
+    for _ in range(viewers):
+        player = Player()
+        player.join(game, 0)
+        players.append(player)
+
+    broadcast_time = per_viewer_time = 0.0
+    per_viewer_bytes = 0
+    longest_queue = 0
+    for tick in range(ticks):
+        move_rackets(game, rng, skill)
+        update_game(game, 1 / TICK_RATE)
+        if game.get_state().winner_id is not None:
+            game.reset_game()
+            for _ in range(COUNTDOWN):
+                game.decrement_countdown(game.countdown_run)
+
+        start = time.perf_counter()
+        broadcast.publish()
+        # The last spectator is the slow one
+        drained = len(spectators) - 1 if tick % slow_every else len(spectators)
+        taken = [spectator.take() for spectator in spectators[:drained]]
+        broadcast_time += time.perf_counter() - start
+        longest_queue = max(longest_queue, len(spectators[-1].frames))
+        for client, frames in zip(clients, taken):
+            client.receive(frames)
+
+        start = time.perf_counter()
+        for player in players:
+            per_viewer_bytes += len(player.encode_snapshot())
+            # Acknowledged at once, as by a client on a fast link
+            player.acked_seq = game.snapshots[-1][0]
+        per_viewer_time += time.perf_counter() - start
+
+    game.deactivate()
+    broadcast.finished()
+    for client, spectator in zip(clients, spectators):
+        client.receive(spectator.take())
+
+    final = protocol.snapshot_fields(game.get_state())
+    problems = []
+    for index, (client, spectator) in enumerate(zip(clients, spectators)):
+        if client.errors:
+            problems.append(f"spectator {index}: {client.errors[0]}")
+        if client.fields != final:
+            problems.append(f"spectator {index}: stream does not end on the final state")
+        if not spectator.closed:
+            problems.append(f"spectator {index}: not closed")
+    if longest_queue > SPECTATOR_QUEUE:
+        problems.append(f"slow spectator queued {longest_queue} frames")
+    drained = clients[:-1] or clients
+    stats = (broadcast_time / ticks, per_viewer_time / ticks, sum(client.bytes for client in drained) / len(drained) / ticks,
+             per_viewer_bytes / viewers / ticks, clients[-1].frames)
+    return stats, problems
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--viewers", type=int, nargs="+", default=[1, 10, 100, 500])
+    parser.add_argument("--ticks", type=int, default=2000)
+    parser.add_argument("--slow-every", type=int, default=SPECTATOR_QUEUE * 3,
+                        help="ticks between drains of the slow spectator")
+    parser.add_argument("--skill", type=float, default=0.8,
+                        help="probability that a racket moves towards the ball on a tick")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    ok = True
+    print(f"{'viewers':>8} {'broadcast us/tick':>18} {'per viewer us/tick':>19} {'speedup':>8} "
+          f"{'B/tick/viewer':>14} {'slow frames':>12}")
+    for viewers in args.viewers:
+        (broadcast, per_viewer, size, per_viewer_size, slow_frames), problems = run(
+            viewers, args.ticks, args.slow_every, args.skill, args.seed)
+        ok = ok and not problems
+        print(f"{viewers:>8} {broadcast * 1e6:>18.1f} {per_viewer * 1e6:>19.1f} {per_viewer / broadcast:>7.1f}x "
+              f"{size:>6.1f} / {per_viewer_size:<5.1f} {slow_frames:>12}")
+        for problem in problems[:5]:
+            print(f"      {problem}")
+    sys.exit(0 if ok else 1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+"""
+Startup time and memory of a server process, with and without pygame.
+
+Each variant runs in a fresh interpreter --runs times and reports the
+median wall time until it exits and its peak RSS: a bare interpreter,
+`import server` as it is now (geometry.Rect, no SDL), and the same with
+`import pygame; pygame.init()` first, which is what importing the server
+did before. Every sharded worker and every replay process pays the
+difference in RSS.
+
+Usage (from the repository root):
+    python -m benchmarks.startup --runs 20
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+VARIANTS = (
+    ("python", "pass"),
+    ("server", "import server"),
+    ("server + pygame.init", "import pygame; pygame.init(); import server"),
+)
+
+def run(code: str):
+    """(seconds until exit, peak RSS in MB, modules loaded) of one fresh interpreter running `code`"""
+    env = dict(os.environ, PYGAME_HIDE_SUPPORT_PROMPT="1")
+    start = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, "-c", code + "; import sys; print(len(sys.modules))"],
+                            cwd=ROOT, env=env, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    output = proc.stdout.read()
+    _, status, usage = os.wait4(proc.pid, 0)
+    elapsed = time.perf_counter() - start
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    proc.stdout.close()
+    if proc.returncode:
+        raise RuntimeError(f"{code!r} exited with status {proc.returncode}")
+    # ru_maxrss is in kilobytes on Linux
+    return elapsed, usage.ru_maxrss / 1024, int(output)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=20)
+    args = parser.parse_args()
+
+    print(f"{'variant':>22} {'startup ms':>11} {'peak RSS MB':>12} {'modules':>8}")
+    for label, code in VARIANTS:
+        results = [run(code) for _ in range(args.runs)]
+        startup = statistics.median(elapsed for elapsed, _, _ in results)
+        rss = statistics.median(rss for _, rss, _ in results)
+        print(f"{label:>22} {startup * 1000:>11.1f} {rss:>12.1f} {results[0][2]:>8}")
+
+if __name__ == "__main__":
+    main()
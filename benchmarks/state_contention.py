@@ -0,0 +1,134 @@
+"""
+Measure how long the game lock is held, and by whom, while a match runs.
+
+One thread runs the simulation of a match in play at its tick rate, two
+threads feed it inputs like clients at 60 fps, and `--readers` threads
+each encode `--read-rate` snapshots per second (a stand-in for many
+snapshot senders and spectators). The game lock is instrumented to record,
+per role, how often it is taken, how long it is held and how long callers
+wait for it.
+
+Two reader modes are compared:
+  locked     readers take the game lock and build the state view themselves,
+             as they did when Game.state was a dict behind the lock
+  published  readers use Game.get_state(), the immutable view the writers
+             publish, and never touch the lock
+
+Usage (from the repository root):
+    python -m benchmarks.state_contention --readers 4 --read-rate 2000 --duration 5
+"""
+
+import argparse
+import threading
+import time
+
+import protocol
+from server import Game, update_game, TICK_RATE
+
+class TimedLock:
+    """threading.Lock that records wait and hold times per role of the calling thread"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.stats = {}
+        self.stats_lock = threading.Lock()
+
+    def __enter__(self):
+        start = time.perf_counter()
+        self.lock.acquire()
+        self.local.acquired = time.perf_counter()
+        self.local.waited = self.local.acquired - start
+        return self
+
+    def __exit__(self, *exc):
+        held = time.perf_counter() - self.local.acquired
+        self.lock.release()
+        role = threading.current_thread().name.split("-")[0]
+        with self.stats_lock:
+            count, wait, max_wait, hold = self.stats.get(role, (0, 0.0, 0.0, 0.0))
+            self.stats[role] = (count + 1, wait + self.local.waited,
+                                max(max_wait, self.local.waited), hold + held)
+
+def simulation(game: Game, stop: threading.Event):
+    dt = 1 / TICK_RATE
+    next_tick = time.perf_counter()
+    while not stop.is_set():
+        update_game(game, dt)
+        if game.get_state().winner_id is not None:
+            game.reset_game()
+            with game.lock:
+                game.state.countdown = 0
+                game.publish()
+        next_tick += dt
+        time.sleep(max(0.0, next_tick - time.perf_counter()))
+
+def player_input(game: Game, player_id: int, stop: threading.Event):
+    direction = 1
+    while not stop.is_set():
+        x = game.get_state().paddles_x[player_id]
+        if x <= 0 or x >= 800:
+            direction = -direction
+        game.move_paddle(player_id, direction)
+        time.sleep(1 / 60)
+
+def reader(game: Game, locked: bool, rate: int, stop: threading.Event, counts: list, index: int):
+    n = 0
+    start = time.perf_counter()
+    while not stop.is_set():
+        if locked:
+            with game.lock:
+                state = game.state.view()
+        else:
+            state = game.get_state()
+        protocol.snapshot_fields(state)
+        n += 1
+        # Paced in bursts of 10 reads, sleeping like a sender between sends
+        if n % 10 == 0:
+            time.sleep(max(0.0, start + n / rate - time.perf_counter()))
+    counts[index] = n
+
+def run(mode: str, readers: int, rate: int, duration: float):
+    game = Game("1234")
+    game.lock = TimedLock()
+    game.set_player_name(0, "Alice")
+    game.set_player_name(1, "Bob")
+    game.update_connected_players(2)
+    with game.lock:
+        game.state.countdown = 0
+        game.state.game_started = True
+        game.publish()
+    game.lock.stats.clear()
+
+    stop = threading.Event()
+    counts = [0] * readers
+    threads = [threading.Thread(target=simulation, args=(game, stop), name="simulation")]
+    threads += [threading.Thread(target=player_input, args=(game, i, stop), name=f"input-{i}") for i in range(2)]
+    threads += [threading.Thread(target=reader, args=(game, mode == "locked", rate, stop, counts, i), name=f"reader-{i}")
+                for i in range(readers)]
+    for t in threads:
+        t.start()
+    time.sleep(duration)
+    stop.set()
+    for t in threads:
+        t.join()
+
+    print(f"\n{mode} readers: {sum(counts) / duration:,.0f} state reads/s")
+    print(f"{'role':>11} {'locks/s':>9} {'held ms/s':>10} {'mean wait us':>13} {'max wait ms':>12}")
+    for role in ("simulation", "input", "reader"):
+        count, wait, max_wait, hold = game.lock.stats.get(role, (0, 0.0, 0.0, 0.0))
+        mean_wait = wait / count * 1e6 if count else 0.0
+        print(f"{role:>11} {count / duration:>9,.0f} {hold / duration * 1e3:>10.2f} "
+              f"{mean_wait:>13.1f} {max_wait * 1e3:>12.2f}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--readers", type=int, default=4)
+    parser.add_argument("--read-rate", type=int, default=2000, help="state reads per second per reader")
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--modes", nargs="+", choices=("locked", "published"), default=["locked", "published"])
+    args = parser.parse_args()
+    for mode in args.modes:
+        run(mode, args.readers, args.read_rate, args.duration)
+
+if __name__ == "__main__":
+    main()
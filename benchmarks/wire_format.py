@@ -0,0 +1,73 @@
+"""
+Compare the binary wire protocol with the old pickle messages.
+
+Measures bytes per message and encode/decode time for the per-frame traffic:
+the state snapshot the server sends to each client and the paddle update
+(an input since the paddle became server-authoritative) each client sends back.
+
+Usage (from the repository root):
+    python -m benchmarks.wire_format --iterations 100000
+"""
+
+import argparse
+import pickle
+import timeit
+
+import protocol
+from server import Game, GameState
+
+def report(label: str, size: int, encode_s: float, decode_s: float, iterations: int):
+    print(f"{label:>22} {size:>7} B {encode_s / iterations * 1e6:>9.2f} us {decode_s / iterations * 1e6:>9.2f} us")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=100000)
+    args = parser.parse_args()
+    n = args.iterations
+
+    game = Game("1234")
+    game.set_player_name(0, "Alice")
+    game.set_player_name(1, "Bob")
+    game.update_connected_players(2)
+    state = game.get_state()
+    # What the server used to pickle: the whole state dict, Rects included
+    legacy = {name: getattr(game.state, name) for name in GameState.__slots__ if name != "tick"}
+    paddle = game.state.paddles[0].copy()
+
+    print(f"{'message':>22} {'size':>9} {'encode':>12} {'decode':>12}")
+
+    pickled = pickle.dumps(legacy)
+    report("state (pickle)", len(pickled),
+           timeit.timeit(lambda: pickle.dumps(legacy), number=n),
+           timeit.timeit(lambda: pickle.loads(pickled), number=n), n)
+
+    fields = protocol.snapshot_fields(state)
+    frame = protocol.pack_snapshot(1, 100, 1, fields)
+    payload = frame[protocol.HEADER.size:]
+    report("state (keyframe)", len(frame),
+           timeit.timeit(lambda: protocol.pack_snapshot(1, 100, 1, fields), number=n),
+           timeit.timeit(lambda: protocol.unpack_snapshot(payload, {}), number=n), n)
+
+    # Steady play: only the ball moved since the acknowledged snapshot
+    state = state._replace(ball=(state.ball[0] + 5, state.ball[1] + 5))
+    moved = protocol.snapshot_fields(state)
+    frame = protocol.pack_snapshot(2, 101, 2, moved, 1, fields)
+    payload = frame[protocol.HEADER.size:]
+    history = {1: fields}
+    report("state (delta)", len(frame),
+           timeit.timeit(lambda: protocol.pack_snapshot(2, 101, 2, moved, 1, fields), number=n),
+           timeit.timeit(lambda: protocol.unpack_snapshot(payload, history), number=n), n)
+
+    pickled = pickle.dumps(paddle)
+    report("paddle (pickle)", len(pickled),
+           timeit.timeit(lambda: pickle.dumps(paddle), number=n),
+           timeit.timeit(lambda: pickle.loads(pickled), number=n), n)
+
+    frame = protocol.pack_input(1, 1, 1)
+    payload = frame[protocol.HEADER.size:]
+    report("input (binary)", len(frame),
+           timeit.timeit(lambda: protocol.pack_input(1, 1, 1), number=n),
+           timeit.timeit(lambda: protocol.unpack_input(payload), number=n), n)
+
+if __name__ == "__main__":
+    main()
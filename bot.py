@@ -0,0 +1,286 @@
+"""
+Headless Pong client for load testing.
+
+Speaks the same protocol as client.py without opening a window: sends its
+name, tracks the ball with its racket at 60 fps, votes for a rematch when a
+match ends or asks for a new opponent and, optionally, disconnects at
+random and connects again.
+Each bot keeps counters of what it received, so a load runner can report
+bandwidth, update rates and latency (see benchmarks/load.py).
+
+Bots can also misbehave, to load test the server's limits (see
+backpressure.py): a slow bot reads SLOW_READ_RATE bytes per second, like a
+client on a poor link, a stalled one stops reading once matched but keeps
+sending, a silent one stops sending once matched (answering no PING) but
+keeps reading, and a flooding one sends FLOOD_BATCH inputs per frame.
+
+Usage (server address from .env, like client.py):
+    python bot.py --bots 100
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import socket
+import time
+
+from dotenv import load_dotenv
+
+import protocol
+from server import BALL_RADIUS, PADDLE_WIDTH, PADDLE_SPEED
+
+FPS = 60
+# Snapshots kept to decode deltas against, same as the server's history
+SNAPSHOT_HISTORY = 64
+# Wait before connecting again after a disconnect
+REQUEUE_DELAY = 0.5
+BEHAVIOURS = ("normal", "slow", "stall", "silent", "flood")
+# Bytes per second a slow bot reads
+SLOW_READ_RATE = 100
+# Inputs per frame a flooding bot sends
+FLOOD_BATCH = 50
+# Receive buffers of misbehaving bots, so the server sees them fall behind within seconds
+SMALL_BUFFER = 2048
+
+class BotStats:
+    """
+    Counters shared by the bots of one process. sessions counts the
+    matches joined (MATCHED), several per connection.
+
+    latencies: seconds from sending an input until a snapshot acknowledging
+    it arrived (one clock, so no clock sync is needed).
+    jitter: per snapshot, receive time minus the time of the server tick it
+    carries, less the session's mean of that; its spread is the tick jitter
+    seen by the bot.
+    """
+    def __init__(self, recording: bool = True):
+        self.updates = 0
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self.sessions = 0
+        self.matches_won = 0
+        self.disconnects = 0
+        self.errors = 0
+        self.latencies = []
+        self.jitter = []
+        self.recording = recording
+
+    def reset(self):
+        """Starts a measurement window, clearing the counters"""
+        self.__init__()
+
+async def play_session(host: str, port: int, name: str, stats: BotStats, stop: asyncio.Event,
+                       vote_rate: float, disconnect_rate: float, rng: random.Random, behaviour: str = "normal"):
+    """
+    One connection: plays matches until told to stop or the bot decides to
+    leave (disconnect_rate per second). When the opponent leaves or the bot
+    does not vote for a rematch, it asks for a new opponent on the same
+    connection.
+    """
+    if behaviour == "normal":
+        reader, writer = await asyncio.open_connection(host, port)
+    else:
+        # Buffer little, so what it does not read stays on the server
+        reader, writer = await asyncio.open_connection(host, port, limit=SMALL_BUFFER // 4)
+        writer.get_extra_info("socket").setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SMALL_BUFFER)
+    try:
+        writer.write(protocol.pack_hello())
+        msg_type, payload = await protocol.read_frame(reader)
+        if msg_type != protocol.MSG_WELCOME:
+            raise protocol.ProtocolError("Connection rejected")
+        tick_rate, _ = protocol.unpack_welcome(payload)
+        writer.write(protocol.pack_join(name))
+        await writer.drain()
+
+        # The current match, player_id is None until MATCHED
+        latest = {"player_id": None, "seq": protocol.NO_SNAPSHOT, "state": None}
+        # Send times of the inputs not acknowledged yet, by sequence
+        pending = {}
+        # Receive time against server tick time, of the snapshots recorded in this match
+        offsets = []
+
+        def record_jitter():
+            if offsets:
+                mean = sum(offsets) / len(offsets)
+                stats.jitter.extend(offset - mean for offset in offsets)
+                offsets.clear()
+
+        async def receive():
+            snapshots = {}
+            tick = 0
+            last_tick16 = None
+            while True:
+                msg_type, payload = await protocol.read_frame(reader)
+                now = time.perf_counter()
+                if msg_type == protocol.MSG_MATCHED:
+                    # A new game: new sequences and a new server timeline
+                    record_jitter()
+                    snapshots.clear()
+                    pending.clear()
+                    last_tick16 = None
+                    latest.update(player_id=protocol.unpack_matched(payload)[0], seq=protocol.NO_SNAPSHOT, state=None)
+                    stats.sessions += 1
+                    continue
+                if msg_type == protocol.MSG_PING:
+                    # Answered like client.py does, the server adapts the snapshot rate to it
+                    if behaviour == "slow":
+                        await asyncio.sleep((protocol.HEADER.size + len(payload)) / SLOW_READ_RATE)
+                    if behaviour != "silent":
+                        writer.write(protocol.pack_pong(protocol.unpack_ping(payload)[0]))
+                    continue
+                if msg_type != protocol.MSG_SNAPSHOT:
+                    raise protocol.ProtocolError(f"Unexpected message {msg_type}")
+                if latest["player_id"] is None:
+                    # Still in flight from the match we left
+                    continue
+                if behaviour == "stall" and latest["state"] is not None:
+                    # Matched and playing: stop reading, for good
+                    await asyncio.Event().wait()
+                if behaviour == "slow":
+                    await asyncio.sleep((protocol.HEADER.size + len(payload)) / SLOW_READ_RATE)
+                seq, tick16, input_ack, fields = protocol.unpack_snapshot(payload, snapshots)
+                snapshots[seq] = fields
+                if len(snapshots) > SNAPSHOT_HISTORY:
+                    del snapshots[next(iter(snapshots))]
+                latest["seq"], latest["state"] = seq, protocol.fields_to_state(fields)
+
+                # Unwrap the 16-bit tick to place the snapshot on the server timeline
+                if last_tick16 is not None:
+                    tick += (tick16 - last_tick16) % 65536
+                else:
+                    tick = tick16
+                last_tick16 = tick16
+                if not stats.recording:
+                    continue
+                stats.updates += 1
+                stats.bytes_received += protocol.HEADER.size + len(payload)
+                offsets.append(now - tick / tick_rate)
+                sent_at = pending.pop(input_ack, None)
+                if sent_at is not None:
+                    stats.latencies.append(now - sent_at)
+                    # Older inputs are acknowledged by this one too
+                    for input_seq in [s for s in pending if not protocol.seq_newer(s, input_ack)]:
+                        del pending[input_seq]
+
+        receiver = asyncio.create_task(receive())
+        voted = False
+        input_seq = protocol.NO_INPUT
+        loop = asyncio.get_running_loop()
+        next_frame = loop.time()
+        try:
+            while not stop.is_set() and not receiver.done():
+                next_frame += 1 / FPS
+                await asyncio.sleep(max(0, next_frame - loop.time()))
+                if disconnect_rate and rng.random() < disconnect_rate / FPS:
+                    # Leaving on purpose, the opponent need not wait for us
+                    stats.disconnects += 1
+                    writer.write(protocol.pack_leave())
+                    break
+                state = latest["state"]
+                if state is None or behaviour == "silent":
+                    continue
+                player_id = latest["player_id"]
+                # Opponent gone (this match will not restart), or no rematch wanted
+                requeue = state["player_leaved"]
+                if state["winner_id"] is not None:
+                    if not voted and not requeue:
+                        voted = True
+                        if state["winner_id"] == player_id:
+                            stats.matches_won += 1
+                        if rng.random() >= vote_rate:
+                            requeue = True
+                        else:
+                            frame = protocol.pack_play_again()
+                            writer.write(frame)
+                            stats.bytes_sent += len(frame)
+                else:
+                    voted = False
+                if not requeue:
+                    # An input every frame, standing still on the winner screen, like client.py
+                    direction = 0
+                    if state["winner_id"] is None:
+                        ball_x, _ = state["ball"]
+                        paddle_x = state["paddles_x"][player_id]
+                        offset = ball_x + BALL_RADIUS - (paddle_x + PADDLE_WIDTH // 2)
+                        direction = 0 if abs(offset) < PADDLE_SPEED else (1 if offset > 0 else -1)
+                    for _ in range(FLOOD_BATCH if behaviour == "flood" else 1):
+                        input_seq = protocol.next_seq(input_seq)
+                        pending[input_seq] = time.perf_counter()
+                        frame = protocol.pack_input(input_seq, direction, latest["seq"])
+                        writer.write(frame)
+                        stats.bytes_sent += len(frame)
+                if requeue:
+                    latest.update(player_id=None, state=None)
+                    voted = False
+                    input_seq = protocol.NO_INPUT
+                    frame = protocol.pack_join(name)
+                    writer.write(frame)
+                    stats.bytes_sent += len(frame)
+                await writer.drain()
+        finally:
+            receiver.cancel()
+            record_jitter()
+    finally:
+        writer.close()
+
+async def run_bot(host: str, port: int, name: str, stats: BotStats, stop: asyncio.Event,
+                  vote_rate: float = 1.0, disconnect_rate: float = 0.0, seed=None, behaviour: str = "normal"):
+    """Plays on one connection after another, connecting again after each one, until `stop` is set"""
+    rng = random.Random(seed)
+    while not stop.is_set():
+        try:
+            await play_session(host, port, name, stats, stop, vote_rate, disconnect_rate, rng, behaviour)
+        except (ConnectionError, OSError, asyncio.IncompleteReadError, protocol.ProtocolError):
+            stats.errors += 1
+        if not stop.is_set():
+            await asyncio.sleep(REQUEUE_DELAY)
+
+async def run_bots(host: str, port: int, count: int, stats: BotStats, stop: asyncio.Event,
+                   vote_rate: float = 1.0, disconnect_rate: float = 0.0, ramp: float = 0.002,
+                   behaviour: str = "normal"):
+    """Starts `count` bots `ramp` seconds apart and waits for them to stop"""
+    bots = []
+    for i in range(count):
+        bots.append(asyncio.create_task(
+            run_bot(host, port, f"bot{i}", stats, stop, vote_rate, disconnect_rate, seed=i, behaviour=behaviour)))
+        await asyncio.sleep(ramp)
+    await asyncio.gather(*bots, return_exceptions=True)
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless Pong bots")
+    parser.add_argument("--bots", type=int, default=2)
+    parser.add_argument("--vote-rate", type=float, default=1.0,
+                        help="probability of voting for a rematch, otherwise the bot leaves")
+    parser.add_argument("--disconnect-rate", type=float, default=0.0,
+                        help="probability per second that a bot leaves its match")
+    parser.add_argument("--behaviour", choices=BEHAVIOURS, default="normal",
+                        help="slow: reads slowly; stall: stops reading once matched; "
+                             "silent: stops sending once matched; flood: sends inputs as fast as it can")
+    args = parser.parse_args()
+
+    load_dotenv()
+    host = os.getenv("SERVER_IP")
+    port = int(os.getenv("SERVER_PORT"))
+
+    stats = BotStats()
+
+    async def report():
+        while True:
+            await asyncio.sleep(5)
+            print(f"{stats.sessions} sessions, {stats.updates} updates, {stats.matches_won} wins, "
+                  f"{stats.disconnects} disconnects, {stats.errors} errors")
+
+    async def run():
+        reporter = asyncio.create_task(report())
+        await run_bots(host, port, args.bots, stats, asyncio.Event(), args.vote_rate, args.disconnect_rate,
+                       behaviour=args.behaviour)
+        reporter.cancel()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
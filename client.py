@@ -2,14 +2,18 @@ import pygame
 import sys
 from dotenv import load_dotenv
 import os
-import socket
-import pickle
+import time
+import protocol
+from client_net import ServerConnection, PaddlePredictor, connect, open_udp, resume, spectate
+from client_render import Canvas, View
 
 pygame.init()
 pygame.font.init()
 
 WIDTH, HEIGHT = 960, 600
 PADDLE_WIDTH, PADDLE_HEIGHT = 120, 10
+# Distance from the rackets to the top and bottom edges
+PADDLE_MARGIN = 20
 BALL_RADIUS = 8
 BLACK = (0, 0, 0)
 WHITE = (255, 255, 255)
@@ -17,11 +21,19 @@ BLUE = (0, 0, 255)
 RED = (255, 0, 0)
 GREEN_BTN = (0, 180, 0)
 PADDLE_SPEED = 12
+# How far in the past the ball and the opponent are drawn, to hide jitter
+INTERPOLATION_DELAY_MS = 100
+# How long to try to get back into the match after the connection dropped
+# (the server keeps the slot for sessions.RESUME_GRACE), and how often
+RECONNECT_FOR = 20
+RECONNECT_INTERVAL = 1
 COLOR_INACTIVE = pygame.Color('lightskyblue3')
 COLOR_ACTIVE = pygame.Color('dodgerblue2')
 
 screen = pygame.display.set_mode((WIDTH, HEIGHT))
 pygame.display.set_caption("Cliente Pong")
+# Every screen is drawn through it, only what changed reaches the display
+canvas = Canvas(screen, BLACK)
 
 # Fontes
 font = pygame.font.Font(None, 74)
@@ -29,94 +41,138 @@ small_font = pygame.font.Font(None, 40)
 input_font = pygame.font.Font(None, 50)
 countdown_font = pygame.font.Font(None, 200)
 
-def draw_name_input_screen(win, text, input_box, ok_button, is_active):
-    """Draw the name input screen"""
-    win.fill(BLACK)
-    
-    # Prompt
-    prompt_surface = input_font.render("Enter your name:", True, WHITE)
-    prompt_rect = prompt_surface.get_rect(center=(WIDTH/2, HEIGHT/2 - 80))
-    win.blit(prompt_surface, prompt_rect)
-    
-    # Input box
-    color = COLOR_ACTIVE if is_active else COLOR_INACTIVE
-    pygame.draw.rect(win, color, input_box, 2)
-    
-    # Typed text
-    text_surface = input_font.render(text, True, WHITE)
-    win.blit(text_surface, (input_box.x + 10, input_box.y + 10))
+def draw_name_input_screen(canvas, text, room, input_box, room_box, ok_button, watch_button, active_box):
+    """Draw the name input screen, with the optional room code below the name"""
+    for prompt, value, box in (("Enter your name:", text, input_box), ("Room code (optional):", room, room_box)):
+        # Prompt
+        canvas.text(input_font, prompt, WHITE, center=(WIDTH/2, box.y - 30))
+        
+        # Input box
+        color = COLOR_ACTIVE if active_box is box else COLOR_INACTIVE
+        canvas.rect(color, box, 2)
+        
+        # Typed text
+        canvas.text(input_font, value, WHITE, topleft=(box.x + 10, box.y + 10))
     
     # OK button
-    pygame.draw.rect(win, GREEN_BTN, ok_button, border_radius=10)
-    ok_text = small_font.render("OK", True, WHITE)
-    ok_rect = ok_text.get_rect(center=ok_button.center)
-    win.blit(ok_text, ok_rect)
+    draw_button(canvas, ok_button, "OK", GREEN_BTN)
     
-    pygame.display.flip()
-
-def redraw_window(win, p1, p2, ball, winner, players_online, countdown_val, button, voted, opponent_name, no_opponent, player_id):
-    """Draw the current state of the game"""
-    win.fill(BLACK)
+    # Watch button: the match of the room code, or the most watched one
+    draw_button(canvas, watch_button, "Watch", (0, 100, 150))
     
+    canvas.present()
+
+def draw_message(canvas, message):
+    """Draw a single line of text, e.g. while looking for an opponent"""
+    canvas.text(small_font, message, WHITE, center=(WIDTH/2, HEIGHT/2))
+    canvas.present()
+
+def draw_button(canvas, button, label, color):
+    canvas.rect(color, button, border_radius=10)
+    canvas.text(small_font, label, WHITE, center=button.center)
+
+def draw_field(canvas, view):
+    """Rackets and ball where `view` placed them"""
+    canvas.rect(BLUE, view.paddles[0])
+    canvas.rect(RED, view.paddles[1])
+    canvas.ellipse(WHITE, view.ball)
+
+def redraw_window(canvas, view, winner, players_online, countdown_val, button, voted, opponent_name, no_opponent,
+                  new_opponent_button):
+    """Draw the current state of the game, with the rackets and ball placed in `view`"""
     # Game inactive due to lack of opponent
     if no_opponent:
-        text = small_font.render("Your opponent has disconnected. Please start another session.", True, WHITE)
-        text_rect = text.get_rect(center=(WIDTH/2, HEIGHT/2))
-        win.blit(text, text_rect)
+        canvas.text(small_font, "Your opponent has disconnected.", WHITE, center=(WIDTH/2, HEIGHT/2))
+        draw_button(canvas, new_opponent_button, "New opponent", (0, 100, 150))
     
     elif players_online < 2:
-        text = small_font.render("Waiting for opponent...", True, WHITE)
-        text_rect = text.get_rect(center=(WIDTH/2, HEIGHT/2))
-        win.blit(text, text_rect)
+        canvas.text(small_font, "Waiting for opponent...", WHITE, center=(WIDTH/2, HEIGHT/2))
     
     # Countdown
     elif countdown_val > 0:
         # Nome do oponente
         if opponent_name:
-            opponent_text = small_font.render(f"Opponent: {opponent_name}", True, WHITE)
-            opponent_rect = opponent_text.get_rect(center=(WIDTH/2, HEIGHT/2 + 150))
-            win.blit(opponent_text, opponent_rect)
+            canvas.text(small_font, f"Opponent: {opponent_name}", WHITE, center=(WIDTH/2, HEIGHT/2 + 150))
         
         # Countdown
-        countdown_text = countdown_font.render(str(countdown_val), True, WHITE)
-        countdown_rect = countdown_text.get_rect(center=(WIDTH/2, HEIGHT/2))
-        win.blit(countdown_text, countdown_rect)
+        canvas.text(countdown_font, str(countdown_val), WHITE, center=(WIDTH/2, HEIGHT/2))
     
-    # Game started
+    # Game started: each player sees his racket at the bottom (see client_render.View)
     elif countdown_val == 0 and not winner:
-        # Each player sees his racket at the bottom
-        if player_id == 0:
-            # Player 0 (p1) at the bottom in blue
-            pygame.draw.rect(win, BLUE, p1)
-            # The opponent (p2) on top in red
-            pygame.draw.rect(win, RED, p2)
-            pygame.draw.ellipse(win, WHITE, ball)
-        else:
-            # Flip the view to player 1
-            my_paddle_inverted = pygame.Rect(p2.x, HEIGHT - 20 - PADDLE_HEIGHT, p2.width, p2.height)
-            opponent_paddle_inverted = pygame.Rect(p1.x, 20, p1.width, p1.height)
-            ball_inverted = pygame.Rect(ball.x, HEIGHT - ball.y - ball.height, ball.width, ball.height)   
-            
-            pygame.draw.rect(win, RED, my_paddle_inverted)
-            pygame.draw.rect(win, BLUE, opponent_paddle_inverted)
-            pygame.draw.ellipse(win, WHITE, ball_inverted)
+        draw_field(canvas, view)
     
     # Winner screen
     if winner and not no_opponent:
-        winner_text = font.render(winner, True, WHITE)
-        winner_rect = winner_text.get_rect(center=(WIDTH/2, HEIGHT/2 - 50))
-        win.blit(winner_text, winner_rect)
+        canvas.text(font, winner, WHITE, center=(WIDTH/2, HEIGHT/2 - 50))
         
         # Restart button
         button_color = (150, 150, 0) if voted else (0, 150, 0)
-        pygame.draw.rect(win, button_color, button, border_radius=10)
-        
-        button_text = "Waiting..." if voted else "Revenge"
-        button_surface = small_font.render(button_text, True, WHITE)
-        button_rect = button_surface.get_rect(center=button.center)
-        win.blit(button_surface, button_rect)
+        draw_button(canvas, button, "Waiting..." if voted else "Revenge", button_color)
+        draw_button(canvas, new_opponent_button, "New opponent", (0, 100, 150))
+    
+    canvas.present()
+
+def draw_spectator_window(canvas, view, player_names, countdown_val, winner_id, no_opponent):
+    """Draw a match being watched: player 1 at the bottom, player 2 on top"""
+    for player_id, y in ((0, HEIGHT - 60), (1, 60)):
+        canvas.text(small_font, player_names[player_id] or f"Player {player_id+1}", BLUE if player_id == 0 else RED,
+                    center=(WIDTH/2, y))
+    
+    if no_opponent:
+        canvas.text(small_font, "A player has disconnected.", WHITE, center=(WIDTH/2, HEIGHT/2))
+    elif winner_id is not None:
+        name = player_names[winner_id] or f"Player {winner_id+1}"
+        canvas.text(font, f"{name} won!", WHITE, center=(WIDTH/2, HEIGHT/2))
+    elif countdown_val > 0:
+        canvas.text(countdown_font, str(countdown_val), WHITE, center=(WIDTH/2, HEIGHT/2))
+    else:
+        draw_field(canvas, view)
     
-    pygame.display.flip()
+    canvas.present()
+
+def new_view(player_id):
+    return View(player_id, HEIGHT, (PADDLE_WIDTH, PADDLE_HEIGHT), PADDLE_MARGIN, BALL_RADIUS * 2)
+
+def watch(connection):
+    """Render loop of a spectator: no input, until the match closes or the window does"""
+    clock = pygame.time.Clock()
+    view = new_view(None)
+    while connection.connected:
+        clock.tick(60)
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                return
+            if event.type == pygame.WINDOWEXPOSED:
+                canvas.invalidate()
+        
+        latest = connection.latest
+        if latest is None:
+            draw_message(canvas, "Waiting for the match...")
+            continue
+        game_state, _ = latest
+        ball_pos, paddles_x = connection.interpolator.sample(time.perf_counter())
+        view.place(paddles_x, ball_pos)
+        draw_spectator_window(canvas, view, game_state["player_names"], game_state["countdown"],
+                              game_state["winner_id"], game_state["player_leaved"])
+    print("The match is over")
+
+def reconnect(address, token, interpolation_delay):
+    """
+    Tries to resume our session after the connection dropped, drawing a
+    message meanwhile. Returns the new connection, or None.
+    """
+    deadline = time.monotonic() + RECONNECT_FOR
+    while time.monotonic() < deadline:
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                return None
+        draw_message(canvas, "Connection lost, reconnecting...")
+        try:
+            return resume(address, token, interpolation_delay)
+        except (OSError, protocol.ProtocolError) as e:
+            print(f"Reconnection failed: {e}")
+            time.sleep(RECONNECT_INTERVAL)
+    return None
 
 def get_winner_text(winner_id:int, player_id:int):
     """
@@ -135,64 +191,99 @@ def main():
     load_dotenv()
     ip_address = os.getenv("SERVER_IP")
     port_number = int(os.getenv("SERVER_PORT"))
+    interpolation_delay = int(os.getenv("INTERPOLATION_DELAY_MS", INTERPOLATION_DELAY_MS)) / 1000
 
-    # TCP socket
-    client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    address = (ip_address, port_number)
     
+    # TCP connection and protocol handshake, the server answers with its settings
     try:
-        client_socket.connect((ip_address, port_number))
+        client_socket, reader, tick_rate, udp_token = connect(address)
         print(f"Connected to server {ip_address}:{port_number}")
     except Exception as e:
         print(f"Connection error: {e}")
         pygame.quit()
         sys.exit()
     
-    # Receive player ID
-    try:
-        player_id = pickle.loads(client_socket.recv(2048))
-        print(f"I'm the player {player_id+1}")
-    except Exception as e:
-        print(f"Error receiving ID: {e}")
-        pygame.quit()
-        sys.exit()
+    # UDP for inputs and snapshots if the server offers it
+    udp_socket = open_udp(address, udp_token)
+    if udp_socket:
+        print("Using UDP for inputs and snapshots")
     
-    # Name entry
+    # Name and room entry, Tab switches between the two boxes
     player_name = ""
-    input_box = pygame.Rect(WIDTH/2 - 200, HEIGHT/2 - 25, 400, 50)
-    ok_button = pygame.Rect(WIDTH/2 - 75, HEIGHT/2 + 50, 150, 60)
-    active = True
+    room = ""
+    input_box = pygame.Rect(WIDTH/2 - 200, HEIGHT/2 - 110, 400, 50)
+    room_box = pygame.Rect(WIDTH/2 - 200, HEIGHT/2 + 10, 400, 50)
+    ok_button = pygame.Rect(WIDTH/2 - 160, HEIGHT/2 + 90, 150, 60)
+    watch_button = pygame.Rect(WIDTH/2 + 10, HEIGHT/2 + 90, 150, 60)
+    active_box = input_box
     name_entered = False
+    watching = False
     
     while not name_entered:
         for event in pygame.event.get():
             if event.type == pygame.QUIT:
                 pygame.quit()
                 sys.exit()
+            if event.type == pygame.WINDOWEXPOSED:
+                canvas.invalidate()
             
             if event.type == pygame.MOUSEBUTTONDOWN:
                 if input_box.collidepoint(event.pos):
-                    active = True
+                    active_box = input_box
+                elif room_box.collidepoint(event.pos):
+                    active_box = room_box
                 else:
-                    active = False
+                    active_box = None
                 
                 if ok_button.collidepoint(event.pos) and player_name.strip():
                     name_entered = True
+                elif watch_button.collidepoint(event.pos):
+                    name_entered = watching = True
             
-            if event.type == pygame.KEYDOWN and active:
+            if event.type == pygame.KEYDOWN and active_box:
                 if event.key == pygame.K_RETURN and player_name.strip():
                     name_entered = True
-                elif event.key == pygame.K_BACKSPACE:
-                    player_name = player_name[:-1]
-                else:
-                    if len(player_name) < 15 and event.unicode.isprintable():
+                elif event.key == pygame.K_TAB:
+                    active_box = room_box if active_box is input_box else input_box
+                elif active_box is input_box:
+                    if event.key == pygame.K_BACKSPACE:
+                        player_name = player_name[:-1]
+                    elif len(player_name) < 15 and event.unicode.isprintable():
                         player_name += event.unicode
+                elif event.key == pygame.K_BACKSPACE:
+                    room = room[:-1]
+                elif event.unicode.isprintable() and len((room + event.unicode).encode()) <= protocol.MAX_ROOM_BYTES:
+                    room += event.unicode
         
-        draw_name_input_screen(screen, player_name, input_box, ok_button, active)
+        draw_name_input_screen(canvas, player_name, room, input_box, room_box, ok_button, watch_button, active_box)
     
-    # Send name to server
+    # Spectator: no name, no input, the server only streams the match (over TCP)
+    if watching:
+        if udp_socket:
+            udp_socket.close()
+        try:
+            found = spectate(client_socket, reader, room)
+        except Exception as e:
+            print(f"Error asking to watch: {e}")
+            found = False
+        if found:
+            pygame.display.set_caption("Pong - Spectator")
+            connection = ServerConnection(client_socket, tick_rate, interpolation_delay, reader=reader)
+            connection.handle_spectating()
+            connection.start()
+            watch(connection)
+            connection.close()
+        else:
+            print("No match to watch" + (f" in room {room}" if room else ""))
+            client_socket.close()
+        pygame.quit()
+        sys.exit()
+    
+    # Send name and room to server
     try:
-        client_socket.send(pickle.dumps(player_name))
-        print(f"Submitted name: {player_name}")
+        client_socket.sendall(protocol.pack_join(player_name, room))
+        print(f"Submitted name: {player_name}" + (f", room: {room}" if room else ""))
     except Exception as e:
         print(f"Error sending name: {e}")
         pygame.quit()
@@ -200,87 +291,123 @@ def main():
     
     pygame.display.set_caption(f"Pong - {player_name}")
     
-    # Initialization of rackets
-    my_paddle = pygame.Rect(WIDTH/2 - PADDLE_WIDTH/2, 
-                           HEIGHT - 30 if player_id == 0 else 20, 
-                           PADDLE_WIDTH, PADDLE_HEIGHT)
+    # Network I/O runs on background threads from here on
+    connection = ServerConnection(client_socket, tick_rate, interpolation_delay, udp_socket, udp_token, reader)
+    connection.start()
+    
+    # Our racket is predicted locally, the opponent's and the ball are interpolated
+    predictor = PaddlePredictor(int(WIDTH/2 - PADDLE_WIDTH/2), PADDLE_SPEED, WIDTH - PADDLE_WIDTH)
     
     play_again_button = pygame.Rect(WIDTH/2 - 100, HEIGHT/2 + 50, 200, 60)
+    new_opponent_button = pygame.Rect(WIDTH/2 - 100, HEIGHT/2 + 130, 200, 60)
     voted_for_reset = False
     clock = pygame.time.Clock()
     running = True
     
     print("Entering the main loop...")
     winner_text = None
+    no_opponent = False
+    reconciled = None
+    match = 0
+    rtt = 0
     while running:
         clock.tick(60)
         
+        # Round-trip time to the server in the title, as the server measures it
+        if connection.rtt != rtt:
+            rtt = connection.rtt
+            pygame.display.set_caption(f"Pong - {player_name} ({rtt} ms)")
+        
         # Process events
         for event in pygame.event.get():
             if event.type == pygame.QUIT:
                 running = False
+            if event.type == pygame.WINDOWEXPOSED:
+                canvas.invalidate()
             
-            if winner_text is not None and event.type == pygame.MOUSEBUTTONDOWN:
-                if play_again_button.collidepoint(event.pos) and not voted_for_reset:
-                    try:
-                        client_socket.send(pickle.dumps("play_again"))
-                        voted_for_reset = True
-                        print("Vote to restart sent")
-                        continue
-                    except Exception as e:
-                        print(f"Error sending vote: {e}")
-            
+            if event.type == pygame.MOUSEBUTTONDOWN and connection.latest is not None:
+                if winner_text is not None and play_again_button.collidepoint(event.pos) and not voted_for_reset:
+                    connection.send(protocol.pack_play_again())
+                    voted_for_reset = True
+                    print("Vote to restart sent")
+                elif (winner_text is not None or no_opponent) and new_opponent_button.collidepoint(event.pos):
+                    # Any opponent: the friend of a private room is the one who left
+                    connection.requeue(player_name)
+                    print("Looking for a new opponent")
+        
+        if not connection.connected:
+            print(f"Connection error: {connection.error}")
+            if connection.resume_token is None:
+                break
+            token = connection.resume_token
+            connection.close()
+            connection = reconnect(address, token, interpolation_delay)
+            if connection is None:
+                print("Could not get back into the match")
+                break
+            print("Back in the match")
+            # Resumed like a new match: our paddle is predicted afresh
+            match = 0
+            continue
+        
+        latest = connection.latest
+        if latest is None:
+            draw_message(canvas, "Looking for an opponent...")
+            continue
+        
+        # Matched again: a new game, a new paddle
+        if connection.matches != match:
+            match = connection.matches
+            player_id = connection.player_id
+            print(f"I'm the player {player_id+1}")
+            predictor = PaddlePredictor(int(WIDTH/2 - PADDLE_WIDTH/2), PADDLE_SPEED, WIDTH - PADDLE_WIDTH)
+            view = new_view(player_id)
+            voted_for_reset = False
+            winner_text = None
+        game_state, input_ack = latest
+        
+        # Reconcile our prediction with the newest authoritative position
+        if latest is not reconciled:
+            predictor.reconcile(game_state["paddles_x"][player_id], input_ack)
+            reconciled = latest
+        
         # Paddle control
         keys = pygame.key.get_pressed()
-        if keys[pygame.K_LEFT] and my_paddle.left > 0:
-            my_paddle.x -= PADDLE_SPEED
-        if keys[pygame.K_RIGHT] and my_paddle.right < WIDTH:
-            my_paddle.x += PADDLE_SPEED
+        direction = 0
+        if keys[pygame.K_LEFT]:
+            direction -= 1
+        if keys[pygame.K_RIGHT]:
+            direction += 1
+        input_seq = predictor.apply_input(direction)
+        connection.send_input(input_seq, direction)
         
-        try:
-            # Send racket position
-            client_socket.send(pickle.dumps(my_paddle))
-            
-            # Receive game state
-            data = client_socket.recv(4096)
-            if not data:
-                print("Estado do jogo vazio - desconectando")
-                break
-            
-            game_state = pickle.loads(data)
-            
-            # Extract information from the state
-            p1_server = game_state.get("paddles")[0]
-            p2_server = game_state.get("paddles")[1]
-            ball_server = game_state.get("ball")
-            winner_id = game_state.get("winner_id")
-            players_online = game_state.get("connected_players")
-            countdown = game_state.get("countdown")
-            player_names = game_state.get("player_names")
-            no_opponent = game_state.get("player_leaved")
+        # Extract information from the state
+        ball_pos, paddles_x = connection.interpolator.sample(time.perf_counter())
+        paddles_x = list(paddles_x)
+        paddles_x[player_id] = predictor.x
+        view.place(paddles_x, ball_pos)
+        winner_id = game_state.get("winner_id")
+        players_online = game_state.get("connected_players")
+        countdown = game_state.get("countdown")
+        player_names = game_state.get("player_names")
+        no_opponent = game_state.get("player_leaved")
 
-            # Opponent's name
-            opponent_name = player_names[1 - player_id]
-            
-            # Vote reset if game restarted
-            if winner_id == None:
-                voted_for_reset = False
-            
-            winner_text = get_winner_text(winner_id, player_id)
-            
-            redraw_window(screen, p1_server, p2_server, ball_server, 
-                         winner_text, players_online, countdown, 
-                         play_again_button, voted_for_reset, opponent_name, no_opponent, player_id)
-            
-        except (ConnectionResetError, EOFError, socket.error) as e:
-            print(f"Connection error: {e}")
-            break
-        except Exception as e:
-            print(f"General error: {e}")
-            break
+        # Opponent's name
+        opponent_name = player_names[1 - player_id]
+        
+        # Vote reset if game restarted
+        if winner_id == None:
+            voted_for_reset = False
+        
+        winner_text = get_winner_text(winner_id, player_id)
+        
+        redraw_window(canvas, view,
+                     winner_text, players_online, countdown, 
+                     play_again_button, voted_for_reset, opponent_name, no_opponent,
+                     new_opponent_button)
     
     print("Closing client...")
-    client_socket.close()
+    connection.close()
     pygame.quit()
     sys.exit()
 
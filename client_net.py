@@ -0,0 +1,374 @@
+"""
+Client-side netcode: the network threads, paddle prediction and snapshot
+interpolation used by client.py. Nothing in here touches pygame, so the
+render loop only ever reads what these objects already hold.
+"""
+
+import os
+import queue
+import socket
+import threading
+import time
+from collections import deque
+
+import protocol
+
+# Decoded snapshots kept as possible delta bases
+SNAPSHOT_HISTORY = 64
+# Interpolation buffer length, in server ticks
+BUFFER_TICKS = 120
+# Seconds to wait for the server while reconnecting
+RECONNECT_TIMEOUT = 3
+
+class PaddlePredictor:
+    """
+    Moves the local paddle as soon as a key is pressed and reconciles with
+    the server: on every snapshot, the authoritative position is taken and
+    the inputs the server has not applied yet are replayed on top of it.
+    """
+    def __init__(self, x: int, speed: int, max_x: int):
+        self.x = x
+        self.speed = speed
+        self.max_x = max_x
+        self.input_seq = protocol.NO_INPUT
+        # (input sequence, direction) sent but not yet acknowledged
+        self.pending = deque()
+
+    def move(self, x: int, direction: int) -> int:
+        return max(0, min(x + direction * self.speed, self.max_x))
+
+    def apply_input(self, direction: int) -> int:
+        """Predicts one input locally. Returns its sequence number"""
+        self.input_seq = protocol.next_seq(self.input_seq)
+        self.pending.append((self.input_seq, direction))
+        self.x = self.move(self.x, direction)
+        return self.input_seq
+
+    def reconcile(self, server_x: int, input_ack: int):
+        while self.pending and not protocol.seq_newer(self.pending[0][0], input_ack):
+            self.pending.popleft()
+        x = server_x
+        for _, direction in self.pending:
+            x = self.move(x, direction)
+        self.x = x
+
+class SnapshotInterpolator:
+    """
+    Buffers snapshots by server tick and renders the world `delay` seconds
+    in the past, interpolating the ball and the opponent's paddle between
+    the two snapshots around that instant. This hides jitter and a send
+    rate lower than the frame rate.
+    """
+    def __init__(self, tick_rate: int, delay: float):
+        self.tick_rate = tick_rate
+        self.delay_ticks = delay * tick_rate
+        self.buffer = deque()      # (tick, state), oldest first
+        self.last_tick16 = None
+        self.tick = 0              # unwrapped server tick of the newest snapshot
+        self.clock_offset = None   # server tick - local time * tick_rate
+        self.lock = threading.Lock()
+
+    def add(self, tick16: int, state: dict, now: float):
+        with self.lock:
+            # Unwrap the 16-bit tick carried by snapshots
+            if self.last_tick16 is not None:
+                self.tick += (tick16 - self.last_tick16) & 0xFFFF
+            else:
+                self.tick = tick16
+            self.last_tick16 = tick16
+
+            # Smoothed estimate of the server clock; resync after a long stall
+            offset = self.tick - now * self.tick_rate
+            if self.clock_offset is None or abs(offset - self.clock_offset) > self.tick_rate:
+                self.clock_offset = offset
+            else:
+                self.clock_offset += 0.05 * (offset - self.clock_offset)
+
+            if self.buffer and self.buffer[-1][0] == self.tick:
+                self.buffer[-1] = (self.tick, state)
+            else:
+                self.buffer.append((self.tick, state))
+            while self.buffer and self.buffer[0][0] < self.tick - BUFFER_TICKS:
+                self.buffer.popleft()
+
+    def sample(self, now: float):
+        """
+        Returns (ball (x, y), paddles x) at the render time, or None before
+        the first snapshot.
+        """
+        with self.lock:
+            if not self.buffer:
+                return None
+            render_tick = now * self.tick_rate + self.clock_offset - self.delay_ticks
+
+            older = self.buffer[0]
+            for entry in self.buffer:
+                if entry[0] > render_tick:
+                    newer = entry
+                    break
+                older = entry
+            else:
+                # Starved: hold the newest snapshot rather than extrapolate
+                return older[1]["ball"], older[1]["paddles_x"]
+
+        old_tick, old_state = older
+        new_tick, new_state = newer
+        if newer is older or not (in_play(old_state) and in_play(new_state)):
+            return old_state["ball"], old_state["paddles_x"]
+
+        t = (render_tick - old_tick) / (new_tick - old_tick)
+        ball = tuple(a + (b - a) * t for a, b in zip(old_state["ball"], new_state["ball"]))
+        paddles = [a + (b - a) * t for a, b in zip(old_state["paddles_x"], new_state["paddles_x"])]
+        return ball, paddles
+
+def in_play(state: dict) -> bool:
+    """Whether the ball is moving in this state (positions jump otherwise)"""
+    return state["countdown"] == 0 and state["winner_id"] is None
+
+class ServerConnection:
+    """
+    Runs the network I/O of a connected client on background threads: one
+    decodes the snapshots pushed by the server, the other writes queued
+    messages. The render loop never blocks on the socket.
+
+    With a UDP socket (connected to the server) inputs are sent as datagrams
+    carrying the last few inputs, and snapshots may arrive on it as well.
+    `reader` is the FrameReader used for the handshake, if any, as it may
+    already hold the first snapshots.
+
+    player_id is None until the server matched us (MATCHED). Every match
+    starts from scratch: snapshots of the previous one are dropped, and
+    `matches` counts the matches so the render loop notices a new one.
+    resume_token is what resume() needs should the connection drop.
+    A spectator (see spectate()) gets a match with player_id None.
+    """
+    def __init__(self, sock: socket.socket, tick_rate: int, interpolation_delay: float,
+                 udp_sock: socket.socket = None, udp_token: int = 0, reader: protocol.FrameReader = None):
+        self.sock = sock
+        self.reader = reader or protocol.FrameReader(sock)
+        self.udp_sock = udp_sock
+        self.udp_token = udp_token
+        self.tick_rate = tick_rate
+        self.interpolation_delay = interpolation_delay
+        self.interpolator = SnapshotInterpolator(tick_rate, interpolation_delay)
+        self.acked_seq = protocol.NO_SNAPSHOT
+        # (state, input ack) of the newest snapshot, None until one arrives
+        self.latest = None
+        self.player_id = None
+        self.resume_token = None
+        self.matches = 0
+        # Round-trip time in ms the server last measured, 0 until it did (see PING)
+        self.rtt = 0
+        # Between JOIN and MATCHED, snapshots still in flight are of the old game
+        self.matching = True
+        self.error = None
+        self.outgoing = queue.Queue()
+        # Inputs repeated in every datagram, so a lost one costs nothing
+        self.recent_inputs = deque(maxlen=protocol.INPUT_REDUNDANCY)
+        self.snapshots = {}
+        self.snapshot_lock = threading.Lock()
+        self.receiver = threading.Thread(target=self.receive_loop, daemon=True)
+        self.sender = threading.Thread(target=self.send_loop, daemon=True)
+        self.udp_receiver = threading.Thread(target=self.udp_receive_loop, daemon=True)
+
+    def start(self):
+        self.receiver.start()
+        self.sender.start()
+        if self.udp_sock:
+            self.udp_receiver.start()
+
+    @property
+    def connected(self) -> bool:
+        return self.error is None
+
+    def send(self, frame: bytes):
+        self.outgoing.put(frame)
+
+    def send_input(self, input_seq: int, direction: int):
+        if not self.udp_sock:
+            self.send(protocol.pack_input(input_seq, direction, self.acked_seq))
+            return
+        self.recent_inputs.append((input_seq, direction))
+        frame = protocol.pack_inputs(self.recent_inputs, self.acked_seq)
+        try:
+            self.udp_sock.send(protocol.pack_datagram(self.udp_token, frame))
+        except OSError:
+            # Lost like any datagram, the next one repeats this input
+            pass
+
+    def requeue(self, name: str, room: str = ""):
+        """Leaves the current match and asks the server for a new opponent"""
+        with self.snapshot_lock:
+            self.matching = True
+            self.latest = None
+        self.send(protocol.pack_join(name, room))
+
+    def handle_matched(self, payload: bytes):
+        player_id, token = protocol.unpack_matched(payload)
+        with self.snapshot_lock:
+            self.snapshots.clear()
+            self.acked_seq = protocol.NO_SNAPSHOT
+            self.interpolator = SnapshotInterpolator(self.tick_rate, self.interpolation_delay)
+            self.latest = None
+            self.recent_inputs.clear()
+            self.player_id = player_id
+            self.resume_token = token
+            self.matches += 1
+            self.matching = False
+
+    def handle_spectating(self):
+        with self.snapshot_lock:
+            self.matches += 1
+            self.matching = False
+
+    def handle_snapshot(self, payload: bytes):
+        with self.snapshot_lock:
+            if self.matching:
+                return
+            seq, tick, input_ack, fields = protocol.unpack_snapshot(payload, self.snapshots)
+            # Over UDP an older snapshot may arrive after a newer one
+            if self.acked_seq != protocol.NO_SNAPSHOT and not protocol.seq_newer(seq, self.acked_seq):
+                return
+            self.snapshots[seq] = fields
+            if len(self.snapshots) > SNAPSHOT_HISTORY:
+                del self.snapshots[next(iter(self.snapshots))]
+
+            state = protocol.fields_to_state(fields)
+            self.interpolator.add(tick, state, time.perf_counter())
+            self.latest = (state, input_ack)
+            self.acked_seq = seq
+
+    def receive_loop(self):
+        try:
+            while True:
+                msg_type, payload = self.reader.read_frame()
+                if msg_type == protocol.MSG_SNAPSHOT:
+                    self.handle_snapshot(payload)
+                elif msg_type == protocol.MSG_MATCHED:
+                    self.handle_matched(payload)
+                elif msg_type == protocol.MSG_PING:
+                    clock, self.rtt = protocol.unpack_ping(payload)
+                    self.send(protocol.pack_pong(clock))
+                else:
+                    raise protocol.ProtocolError(f"Unexpected message {msg_type}")
+        except Exception as e:
+            self.error = e
+            self.outgoing.put(None)
+
+    def udp_receive_loop(self):
+        while True:
+            try:
+                data = self.udp_sock.recv(2048)
+            except OSError:
+                # Closed, or an ICMP error for an earlier datagram
+                if self.error is not None or self.udp_sock.fileno() == -1:
+                    break
+                continue
+            try:
+                msg_type, payload = protocol.parse_frame(data)
+                if msg_type == protocol.MSG_SNAPSHOT:
+                    self.handle_snapshot(payload)
+            except protocol.ProtocolError:
+                # A stray or truncated datagram, not a broken connection
+                continue
+
+    def send_loop(self):
+        try:
+            while True:
+                frames = [self.outgoing.get()]
+                # Whatever queued up meanwhile goes out in the same write
+                while not self.outgoing.empty() and frames[-1] is not None:
+                    frames.append(self.outgoing.get_nowait())
+                closing = frames[-1] is None
+                if closing:
+                    frames.pop()
+                if frames:
+                    self.sock.sendall(b"".join(frames))
+                if closing:
+                    break
+        except Exception as e:
+            self.error = e
+
+    def close(self):
+        """Leaves the game, for good, and closes the connection"""
+        self.outgoing.put(protocol.pack_leave())
+        self.outgoing.put(None)
+        if self.sender.is_alive():
+            self.sender.join(timeout=1)
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+        if self.udp_sock:
+            self.udp_sock.close()
+
+def connect(address, timeout: float = None):
+    """
+    Opens a connection to the server and runs the protocol handshake.
+    Returns (socket, reader, server tick rate, UDP token).
+    """
+    sock = socket.create_connection(address, timeout)
+    try:
+        # Inputs are tiny and latency sensitive, don't let Nagle batch them
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        reader = protocol.FrameReader(sock)
+        sock.sendall(protocol.pack_hello())
+        msg_type, payload = reader.read_frame()
+        if msg_type == protocol.MSG_REJECT:
+            raise protocol.ProtocolError("Server rejected our protocol version")
+        if msg_type != protocol.MSG_WELCOME:
+            raise protocol.ProtocolError("Expected WELCOME")
+        tick_rate, udp_token = protocol.unpack_welcome(payload)
+        # The server sends nothing while a game is idle, reads must not time out
+        sock.settimeout(None)
+    except Exception:
+        sock.close()
+        raise
+    return sock, reader, tick_rate, udp_token
+
+def spectate(sock: socket.socket, reader: protocol.FrameReader, room: str = "") -> bool:
+    """
+    Asks, after connect(), to watch the match of `room`, or with no code
+    the most watched one. Returns False if there is no such match.
+    """
+    sock.sendall(protocol.pack_spectate(room))
+    msg_type, _ = reader.read_frame()
+    if msg_type == protocol.MSG_NO_MATCH:
+        return False
+    if msg_type != protocol.MSG_SPECTATING:
+        raise protocol.ProtocolError("Expected SPECTATING")
+    return True
+
+def open_udp(address, udp_token: int):
+    """UDP socket for inputs and snapshots, if the server offers it (USE_UDP=0 to keep TCP only)"""
+    if not udp_token or os.getenv("USE_UDP", "1") == "0":
+        return None
+    udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    udp_sock.connect(address)
+    return udp_sock
+
+def resume(address, token: bytes, interpolation_delay: float):
+    """
+    Reconnects after the connection dropped and takes our slot back with
+    the token of the last MATCHED. Returns the started ServerConnection, or
+    None if the server no longer keeps the slot.
+    """
+    sock, reader, tick_rate, udp_token = connect(address, RECONNECT_TIMEOUT)
+    try:
+        sock.settimeout(RECONNECT_TIMEOUT)
+        sock.sendall(protocol.pack_resume(token))
+        msg_type, payload = reader.read_frame()
+        sock.settimeout(None)
+        if msg_type == protocol.MSG_RESUME_FAILED:
+            sock.close()
+            return None
+        if msg_type != protocol.MSG_MATCHED:
+            raise protocol.ProtocolError("Expected MATCHED")
+    except Exception:
+        sock.close()
+        raise
+    connection = ServerConnection(sock, tick_rate, interpolation_delay, open_udp(address, udp_token), udp_token, reader)
+    connection.handle_matched(payload)
+    connection.start()
+    return connection
@@ -0,0 +1,113 @@
+"""
+Rendering layer of client.py: cached text, dirty-rect updates and the view
+of each player.
+
+Screens are described again every frame, but drawing is deferred: a Canvas
+records what the frame draws and compares it with the previous frame in
+present(). A frame identical to the last one (waiting screens, the winner
+screen, a countdown between digits) costs nothing. Otherwise only the
+regions the previous frame drew are cleared, the frame is drawn and
+pygame.display.update() is given those regions and the new ones instead
+of flipping the whole window. The result is pixel for pixel what filling
+the screen and drawing everything would give.
+
+Text is rendered once per (font, string, colour) by TextCache, so static
+labels and countdown digits are not rendered by the font every frame.
+"""
+
+from collections import OrderedDict
+
+import pygame
+
+# Text surfaces kept, the screens only show a few dozen strings
+TEXT_CACHE_SIZE = 256
+
+class TextCache:
+    """Rendered text surfaces by (font, string, colour), least recently used dropped first"""
+    def __init__(self, size: int = TEXT_CACHE_SIZE):
+        self.size = size
+        self.surfaces = OrderedDict()
+
+    def render(self, font: pygame.font.Font, text: str, color) -> pygame.Surface:
+        key = (font, text, tuple(color))
+        surface = self.surfaces.get(key)
+        if surface is None:
+            surface = font.render(text, True, color)
+            self.surfaces[key] = surface
+            if len(self.surfaces) > self.size:
+                self.surfaces.popitem(last=False)
+        else:
+            self.surfaces.move_to_end(key)
+        return surface
+
+class Canvas:
+    """
+    Draws frames into `surface` (the display surface by default) and tells
+    `update` which regions changed. Draw calls only record the frame,
+    present() draws it.
+    """
+    def __init__(self, surface: pygame.Surface, background, texts: TextCache = None,
+                 update=pygame.display.update):
+        self.surface = surface
+        self.background = background
+        self.texts = texts or TextCache()
+        self.update = update
+        self.ops = []
+        self.previous = None
+        # Regions the frame on screen drew: all of it, its content is unknown yet
+        self.previous_rects = [surface.get_rect()]
+
+    def rect(self, color, rect, width: int = 0, border_radius: int = 0):
+        self.ops.append((pygame.draw.rect, self.surface, color, tuple(rect), width, border_radius))
+
+    def ellipse(self, color, rect):
+        self.ops.append((pygame.draw.ellipse, self.surface, color, tuple(rect)))
+
+    def text(self, font: pygame.font.Font, text: str, color, center=None, topleft=None):
+        """Draws `text` centred on `center`, or from `topleft`"""
+        surface = self.texts.render(font, text, color)
+        if center is not None:
+            rect = surface.get_rect(center=center)
+        else:
+            rect = surface.get_rect(topleft=topleft)
+        self.ops.append((self.surface.blit, surface, tuple(rect)))
+
+    def invalidate(self):
+        """Redraws and updates the whole window at the next present(), e.g. after it was exposed"""
+        self.previous = None
+        self.previous_rects = [self.surface.get_rect()]
+
+    def present(self):
+        """Draws the frame recorded since the last call, if it differs from that one"""
+        ops, self.ops = self.ops, []
+        if ops == self.previous:
+            return
+        for rect in self.previous_rects:
+            self.surface.fill(self.background, rect)
+        rects = [draw(*args) for draw, *args in ops]
+        self.update(self.previous_rects + rects)
+        self.previous = ops
+        self.previous_rects = rects
+
+class View:
+    """
+    Where the rackets and the ball go on screen for one player, who sees
+    their racket at the bottom (player 1 sees the field upside down). The
+    rects are computed once and moved by place() every frame.
+    """
+    def __init__(self, player_id, height: int, paddle_size, paddle_margin: int, ball_size: int):
+        paddle_width, paddle_height = paddle_size
+        bottom, top = height - paddle_margin - paddle_height, paddle_margin
+        self.flipped = player_id == 1
+        # By player ID, as in the game state
+        self.paddles = [pygame.Rect(0, top if self.flipped else bottom, paddle_width, paddle_height),
+                        pygame.Rect(0, bottom if self.flipped else top, paddle_width, paddle_height)]
+        self.ball = pygame.Rect(0, 0, ball_size, ball_size)
+        self.flip_y = height - ball_size
+
+    def place(self, paddles_x, ball_pos):
+        for paddle, x in zip(self.paddles, paddles_x):
+            paddle.x = int(x)
+        ball_y = int(ball_pos[1])
+        self.ball.x = int(ball_pos[0])
+        self.ball.y = self.flip_y - ball_y if self.flipped else ball_y
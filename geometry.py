@@ -0,0 +1,109 @@
+"""
+Rectangles for the server's physics, in place of pygame.Rect.
+
+The server only used pygame for Rect, and importing it (with pygame.init())
+loaded SDL into every server and worker process. Rect here keeps
+pygame's whole-pixel behaviour, so matches play out exactly as before and
+batch_physics.py still agrees with it tick for tick: values given to the
+constructor are truncated towards zero, floats assigned to a position
+later are rounded half away from zero, and colliderect() is pygame's test.
+"""
+
+import math
+
+def round_half_away(value) -> int:
+    """Rounds half away from zero, like assigning a float to a pygame.Rect attribute"""
+    if type(value) is int:
+        return value
+    whole = math.trunc(value)
+    fraction = value - whole
+    if fraction >= 0.5:
+        return whole + 1
+    if fraction <= -0.5:
+        return whole - 1
+    return whole
+
+class Rect:
+    """
+    Whole-pixel rectangle with the pygame.Rect attributes the server uses:
+    x/left, y/top, width, height, right, bottom, centerx, centery, center.
+    Only the position can be changed, rackets and ball never change size.
+    """
+    __slots__ = ("_x", "_y", "_width", "_height")
+
+    def __init__(self, x, y, width, height):
+        self._x = int(x)
+        self._y = int(y)
+        self._width = int(width)
+        self._height = int(height)
+
+    @property
+    def x(self) -> int:
+        return self._x
+
+    @x.setter
+    def x(self, value):
+        self._x = round_half_away(value)
+
+    @property
+    def y(self) -> int:
+        return self._y
+
+    @y.setter
+    def y(self, value):
+        self._y = round_half_away(value)
+
+    left = x
+    top = y
+
+    @property
+    def width(self) -> int:
+        return self._width
+
+    @property
+    def height(self) -> int:
+        return self._height
+
+    @property
+    def right(self) -> int:
+        return self._x + self._width
+
+    @property
+    def bottom(self) -> int:
+        return self._y + self._height
+
+    @property
+    def centerx(self) -> int:
+        return self._x + self._width // 2
+
+    @property
+    def centery(self) -> int:
+        return self._y + self._height // 2
+
+    @property
+    def center(self) -> tuple:
+        return self.centerx, self.centery
+
+    @center.setter
+    def center(self, value):
+        center_x, center_y = value
+        self._x = round_half_away(center_x) - self._width // 2
+        self._y = round_half_away(center_y) - self._height // 2
+
+    def copy(self) -> "Rect":
+        return Rect(self._x, self._y, self._width, self._height)
+
+    def colliderect(self, other: "Rect") -> bool:
+        """Whether the two overlap, touching edges do not count (as in pygame)"""
+        if not (self._width and self._height and other._width and other._height):
+            return False
+        return (self._x < other._x + other._width and other._x < self._x + self._width
+                and self._y < other._y + other._height and other._y < self._y + self._height)
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, Rect):
+            return NotImplemented
+        return (self._x, self._y, self._width, self._height) == (other._x, other._y, other._width, other._height)
+
+    def __repr__(self) -> str:
+        return f"<rect({self._x}, {self._y}, {self._width}, {self._height})>"
@@ -0,0 +1,213 @@
+"""
+Restarting the Pong server without dropping its matches (threaded engine).
+
+Draining: on SIGTERM the server stops accepting connections (it closes its
+listening socket, so a new server can bind the port right away), ends the
+games still waiting for an opponent and the matches on their winner
+screen, closes every match as soon as it is won instead of offering a
+rematch, and exits once the last game is over. A second SIGTERM, or
+Ctrl-C, stops it right away.
+
+Handing over: a server started with --handoff PATH listens for its
+successor on the Unix socket PATH, and a server started with the same
+flag while another one listens there takes everything over from it:
+
+  1. the old server stops accepting and hands over its listening socket
+     (and its UDP one), so the new one accepts from then on and no
+     connection attempt is refused;
+  2. each player's reader stops at the next frame boundary (clients send
+     an input every frame and answer pings) and their sender after the
+     frame it is writing, so each byte stream carries on exactly where it
+     stopped. Bytes received but not read yet go along;
+  3. the games are frozen (their locks held) and sent over with the
+     resume sessions and the games waiting for an opponent, then every
+     connection with its file descriptor (SCM_RIGHTS);
+  4. the old server writes out ratings and recordings, then exits; the
+     new one resumes each game at the tick it stopped on and plays on
+     with every connection. Clients get a full snapshot and see nothing
+     else.
+
+A player whose reader does not reach a frame boundary within
+HANDOFF_TIMEOUT (a client that sent nothing) is not handed over: its
+connection drops with the old server and its session is suspended on the
+new one, where the client resumes it like after any drop. Spectators and
+clients still in the handshake are hung up on. If the successor goes away
+before it has everything, the old server unfreezes and plays on.
+
+Messages on the handoff socket are JSON, one per game, session or
+connection, over SOCK_SEQPACKET so each arrives whole with its
+descriptors.
+"""
+
+import json
+import os
+import socket
+import threading
+import time
+
+# Seconds the old server waits for players' readers to reach a frame boundary
+HANDOFF_TIMEOUT = 2.0
+# Seconds between two checks of a draining server for games still going on
+DRAIN_INTERVAL = 0.5
+# Largest message on the handoff socket, and descriptors per message
+MAX_MESSAGE = 65536
+MAX_FDS = 4
+
+# Set once the server takes no new matches and lets the current ones end
+draining = False
+# Set while the server hands its matches over to a successor
+handing_over = False
+# Wakes the accept loop up, set by the server while it runs
+wake = None
+# The Handoff of this process, None unless it runs with --handoff
+current = None
+
+def send_message(channel: socket.socket, message: dict, socks=()):
+    socket.send_fds(channel, [json.dumps(message).encode()], [sock.fileno() for sock in socks])
+
+def recv_message(channel: socket.socket):
+    """Returns (message, sockets that came with it), or (None, []) once the other end is gone"""
+    data, fds, _, _ = socket.recv_fds(channel, MAX_MESSAGE, MAX_FDS)
+    if not data:
+        return None, []
+    return json.loads(data), [socket.socket(fileno=fd) for fd in fds]
+
+def connect(path: str):
+    """The handoff socket of a server running with --handoff `path`, None if there is none"""
+    channel = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    try:
+        channel.connect(path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        channel.close()
+        return None
+    return channel
+
+def wait_closed(channel: socket.socket):
+    """Waits until the old server exited, which closes its end of the handoff socket"""
+    while channel.recv(MAX_MESSAGE):
+        pass
+    channel.close()
+
+def drain():
+    """Stops taking new matches, see the module's docstring. Raises KeyboardInterrupt if already draining"""
+    global draining
+    if draining:
+        raise KeyboardInterrupt
+    draining = True
+    if current:
+        current.close()
+    if wake:
+        wake()
+
+def on_sigterm(signum, frame):
+    drain()
+
+class Parked:
+    """A connection stopped at a frame boundary, ready to be handed over"""
+    __slots__ = ("player", "conn", "reader", "session", "join")
+
+    def __init__(self, player, conn, reader, session, join):
+        self.player = player
+        self.conn = conn
+        self.reader = reader
+        self.session = session
+        self.join = join
+
+class Handoff:
+    """
+    Old server's side of a handoff: listens on `path` for a successor and
+    keeps track of the players to stop before handing them over. Readers
+    call park() once handing_over is set.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.condition = threading.Condition()
+        # Players past the handshake, and those of them stopped at a frame boundary
+        self.players = set()
+        self.parked = {}
+        # Successor's end of the handoff socket, once one connected
+        self.channel = None
+        self.resumed = threading.Event()
+        self.sock = None
+
+    def listen(self):
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self.sock.bind(self.path)
+        self.sock.listen(1)
+        threading.Thread(target=self.accept, name="handoff", daemon=True).start()
+        print(f"Waiting for a successor on {self.path}")
+
+    def accept(self):
+        global handing_over
+        while True:
+            try:
+                channel, _ = self.sock.accept()
+            except OSError:
+                return
+            with self.condition:
+                if draining or self.channel is not None:
+                    channel.close()
+                    continue
+                self.channel = channel
+                self.resumed.clear()
+                handing_over = True
+            if wake:
+                wake()
+
+    def close(self):
+        """Takes no successor any more"""
+        if self.sock:
+            self.sock.close()
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+
+    def enter(self, player):
+        """A player is past the handshake, it has to be stopped before handing over"""
+        with self.condition:
+            self.players.add(player)
+
+    def leave(self, player):
+        with self.condition:
+            self.players.discard(player)
+            self.parked.pop(player, None)
+            self.condition.notify_all()
+
+    def park(self, player, conn, reader, session=None, join=None):
+        """
+        Called by a player's reader at a frame boundary while handing over,
+        with its session or the (name, room) it asked to be matched with.
+        Blocks until the process exits, or returns once the handoff failed.
+        """
+        with self.condition:
+            self.parked[player] = Parked(player, conn, reader, session, join)
+            self.condition.notify_all()
+        self.resumed.wait()
+        with self.condition:
+            self.parked.pop(player, None)
+
+    def wait_parked(self, timeout: float = HANDOFF_TIMEOUT) -> list:
+        """Waits for every player to park, up to `timeout` seconds. Returns those that did"""
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while len(self.parked) < len(self.players):
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    break
+                self.condition.wait(left)
+            return list(self.parked.values())
+
+    def resume(self):
+        """The handoff failed: wakes the parked readers up and waits for another successor"""
+        global handing_over
+        with self.condition:
+            handing_over = False
+            if self.channel:
+                self.channel.close()
+            self.channel = None
+        self.resumed.set()
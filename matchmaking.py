@@ -0,0 +1,142 @@
+"""
+Matchmaking for the Pong server.
+
+Players are paired as they ask to play. The first player of a pair gets a
+new game that waits in a queue, the next compatible player joins it. Queues
+are dicts used as ordered sets (insertion order is arrival order), so
+queuing, pairing with the longest waiting game and cancelling a game whose
+player left are all O(1):
+
+  - public games wait in one queue per rating bucket, and a player joins
+    the longest waiting game of their bucket, or else of the buckets on
+    either side of it;
+  - private rooms are keyed by a code the players agreed on: the second
+    player giving the same code joins the first one, nobody else does.
+
+The Matchmaker does no I/O and knows nothing of what it queues (a Game, or
+a game handed to a worker in sharded mode), so every engine shares it.
+"""
+
+import threading
+import time
+
+import metrics
+
+# Rating of players who have none yet
+INITIAL_RATING = 1000
+# Players are paired within their rating bucket, or the neighbouring ones
+RATING_BUCKET_WIDTH = 100
+
+class Ticket:
+    """A game waiting for its second player"""
+    __slots__ = ("entry", "bucket", "room", "since")
+
+    def __init__(self, entry, bucket: int, room: str):
+        self.entry = entry
+        self.bucket = bucket
+        self.room = room
+        self.since = time.monotonic()
+
+class Matchmaker:
+    """
+    Queues of games waiting for a second player. Thread-safe, every method
+    is O(1) except cancel_where().
+    """
+    def __init__(self, bucket_width: int = RATING_BUCKET_WIDTH):
+        self.bucket_width = bucket_width
+        self.lock = threading.Lock()
+        # bucket -> {entry: Ticket}, longest waiting first
+        self.queues = {}
+        # room code -> Ticket
+        self.rooms = {}
+        # entry -> Ticket, of every waiting game
+        self.tickets = {}
+
+    def join(self, create, rating: int = INITIAL_RATING, room: str = ""):
+        """
+        Pairs a player. Returns (entry, 1) when they join a waiting game,
+        otherwise (create(), 0) once the new game is queued. create() runs
+        under the matchmaker's lock, so two players arriving together never
+        both end up waiting.
+        """
+        bucket = rating // self.bucket_width
+        with self.lock:
+            if room:
+                ticket = self.rooms.get(room)
+            else:
+                ticket = self.oldest(bucket)
+            if ticket is not None:
+                self.remove(ticket)
+                wait = metrics.room_wait_seconds if room else metrics.matchmaking_wait_seconds
+                wait.observe(time.monotonic() - ticket.since)
+                return ticket.entry, 1
+
+            entry = create()
+            self.add(Ticket(entry, bucket, room))
+            return entry, 0
+
+    def add(self, ticket: Ticket):
+        """Caller holds the lock"""
+        self.tickets[ticket.entry] = ticket
+        if ticket.room:
+            self.rooms[ticket.room] = ticket
+        else:
+            self.queues.setdefault(ticket.bucket, {})[ticket.entry] = ticket
+
+    def restore(self, entry, bucket: int, room: str = ""):
+        """Queues a game handed over by the previous server process (see handoff.py), as join() left it"""
+        with self.lock:
+            self.add(Ticket(entry, bucket, room))
+
+    def oldest(self, bucket: int):
+        """Longest waiting public game a player of `bucket` may join. Caller holds the lock"""
+        queue = self.queues.get(bucket)
+        if queue:
+            return next(iter(queue.values()))
+        best = None
+        for neighbour in (bucket - 1, bucket + 1):
+            queue = self.queues.get(neighbour)
+            if queue:
+                ticket = next(iter(queue.values()))
+                if best is None or ticket.since < best.since:
+                    best = ticket
+        return best
+
+    def remove(self, ticket: Ticket):
+        """Caller holds the lock"""
+        del self.tickets[ticket.entry]
+        if ticket.room:
+            del self.rooms[ticket.room]
+            return
+        queue = self.queues[ticket.bucket]
+        del queue[ticket.entry]
+        if not queue:
+            del self.queues[ticket.bucket]
+
+    def cancel(self, entry) -> bool:
+        """Drops a waiting game, e.g. its player left. False if it was not waiting"""
+        with self.lock:
+            ticket = self.tickets.get(entry)
+            if ticket is None:
+                return False
+            self.remove(ticket)
+        metrics.matchmaking_cancelled.inc()
+        return True
+
+    def cancel_where(self, predicate) -> int:
+        """Drops every waiting game for which predicate(entry) is true, returns how many"""
+        with self.lock:
+            tickets = [ticket for entry, ticket in self.tickets.items() if predicate(entry)]
+            for ticket in tickets:
+                self.remove(ticket)
+        metrics.matchmaking_cancelled.inc(len(tickets))
+        return len(tickets)
+
+    def queued(self) -> dict:
+        """(rating bucket, room code) of every waiting game, by game"""
+        with self.lock:
+            return {entry: (ticket.bucket, ticket.room) for entry, ticket in self.tickets.items()}
+
+    def waiting(self) -> int:
+        """Games waiting for a second player"""
+        return len(self.tickets)
@@ -0,0 +1,269 @@
+"""
+Server metrics in the Prometheus text format, served over HTTP.
+
+All metrics are module-level objects created once. Hot paths only bump
+plain integers (the per-client byte and frame counters live on Player),
+and timings are taken on one call out of SAMPLE_EVERY, so the
+instrumentation is cheap enough to leave on. Nothing is timed until
+enable() is called (server.py --metrics-port).
+
+Scrape with:  curl http://127.0.0.1:<port>/metrics
+"""
+
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# One call in this many is timed
+SAMPLE_EVERY = 16
+# Histogram bucket upper bounds, in seconds
+TIMING_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001,
+                  0.0025, 0.005, 0.01, 0.025, 0.05, 0.1)
+WAIT_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+enabled = False
+registry = []
+# HTTP server started by serve(), if any
+server = None
+
+class Counter:
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def inc(self, amount: int = 1):
+        with self.lock:
+            self.value += amount
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        yield f"{self.name} {self.value}"
+
+    def reset(self):
+        self.value = 0
+
+class Gauge:
+    """A value kept with inc()/dec(), or read at scrape time from `function` when set"""
+    def __init__(self, name: str, help: str, function=None):
+        self.name = name
+        self.help = help
+        self.function = function
+        self.value = 0
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def inc(self, amount: int = 1):
+        with self.lock:
+            self.value += amount
+
+    def dec(self, amount: int = 1):
+        self.inc(-amount)
+
+    def reset(self):
+        pass
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} gauge"
+        yield f"{self.name} {self.function() if self.function else self.value}"
+
+class Histogram:
+    def __init__(self, name: str, help: str, buckets: tuple = TIMING_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def observe(self, value: float):
+        i = 0
+        while i < len(self.buckets) and value > self.buckets[i]:
+            i += 1
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    def reset(self):
+        with self.lock:
+            self.counts = [0] * len(self.counts)
+            self.sum = 0.0
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        with self.lock:
+            counts, total = list(self.counts), self.sum
+        cumulative = 0
+        for bound, count in zip(self.buckets + ("+Inf",), counts):
+            cumulative += count
+            yield f'{self.name}_bucket{{le="{bound}"}} {cumulative}'
+        yield f"{self.name}_sum {total}"
+        yield f"{self.name}_count {cumulative}"
+
+class Sampler:
+    """Picks the calls to time: one in SAMPLE_EVERY while metrics are enabled"""
+    __slots__ = ("calls",)
+
+    def __init__(self):
+        self.calls = 0
+
+    def sample(self) -> bool:
+        # Racy between threads, which at worst shifts which call is sampled
+        self.calls += 1
+        return enabled and self.calls % SAMPLE_EVERY == 0
+
+class SampledLock:
+    """threading.Lock that records how long a sample of its acquisitions wait"""
+    __slots__ = ("lock", "sampler")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sampler = Sampler()
+
+    def __enter__(self):
+        if not self.sampler.sample():
+            self.lock.acquire()
+            return self
+        start = time.perf_counter()
+        self.lock.acquire()
+        game_lock_wait_seconds.observe(time.perf_counter() - start)
+        return self
+
+    def __exit__(self, *exc):
+        self.lock.release()
+
+def new_lock():
+    """Lock for a new Game: sampled while metrics are enabled, a plain Lock otherwise"""
+    return SampledLock() if enabled else threading.Lock()
+
+# Players currently connected, their counters are exported per client
+players = set()
+players_lock = threading.Lock()
+# Counters of players that already left, so totals never go down
+retired = {"bytes_sent": 0, "bytes_received": 0, "frames_sent": 0, "frames_received": 0}
+
+def add_player(player):
+    with players_lock:
+        players.add(player)
+
+def remove_player(player):
+    with players_lock:
+        if player in players:
+            players.discard(player)
+            for key in retired:
+                retired[key] += getattr(player, key)
+
+games_active = Gauge("pong_games_active", "Games created and not yet terminated")
+games_unmatched = Gauge("pong_games_unmatched", "Games waiting for a second player")
+clients_connected = Gauge("pong_clients_connected", "Connected players", lambda: len(players))
+game_tick_seconds = Histogram("pong_game_tick_seconds", "Time to simulate one tick of one game (sampled)")
+batch_step_seconds = Histogram("pong_batch_step_seconds", "Time to simulate one tick of every game with batch physics")
+tick_overruns = Counter("pong_tick_overruns_total", "Ticks that started late because the previous ones overran")
+ticks_dropped = Counter("pong_ticks_dropped_total", "Ticks skipped after a stall longer than the catch-up limit")
+serialize_seconds = Histogram("pong_snapshot_encode_seconds", "Time to encode one snapshot (sampled)")
+game_lock_wait_seconds = Histogram("pong_game_lock_wait_seconds", "Time spent waiting for Game.lock (sampled)")
+matchmaking_wait_seconds = Histogram("pong_matchmaking_wait_seconds",
+                                     "Time the first player of a game waited for an opponent", WAIT_BUCKETS)
+room_wait_seconds = Histogram("pong_room_wait_seconds",
+                              "Time the first player of a private room waited for the second one", WAIT_BUCKETS)
+matchmaking_cancelled = Counter("pong_matchmaking_cancelled_total",
+                                "Waiting games dropped from matchmaking because their player left")
+matchmaking_requeues = Counter("pong_matchmaking_requeues_total",
+                               "Players queuing for a new opponent without reconnecting")
+sessions_suspended = Gauge("pong_sessions_suspended", "Dropped players whose slot is kept for them to resume")
+sessions_resumed = Counter("pong_sessions_resumed_total", "Connections that took a player's slot back with a resume token")
+sessions_expired = Counter("pong_sessions_expired_total", "Dropped players who did not resume within the grace period")
+recorded_bytes = Counter("pong_recorded_bytes_total", "Bytes of match recordings written to disk")
+match_results = Counter("pong_match_results_total", "Match results rated (see ratings.py)")
+ratings_pending = Gauge("pong_ratings_pending", "Match results rated but not written to the ratings database yet")
+clients_evicted = Counter("pong_clients_evicted_total",
+                          "Players hung up on for falling behind or going silent (see backpressure.py)")
+snapshots_skipped = Counter("pong_snapshots_skipped_total",
+                            "Snapshots not sent because the client had too much unsent already")
+messages_throttled = Counter("pong_messages_throttled_total",
+                             "Client messages over the rate limit, delayed (TCP) or dropped (UDP)")
+spectators = Gauge("pong_spectators", "Connected spectators")
+spectator_frames_encoded = Counter("pong_spectator_frames_encoded_total",
+                                   "Snapshots encoded for spectators, each one shared by every spectator of its game")
+spectator_frames_dropped = Counter("pong_spectator_frames_dropped_total",
+                                   "Snapshots dropped from the queue of a spectator who fell behind")
+
+game_tick_sampler = Sampler()
+serialize_sampler = Sampler()
+
+def render_clients():
+    with players_lock:
+        current = list(players)
+        totals = dict(retired)
+    for key in retired:
+        totals[key] += sum(getattr(player, key) for player in current)
+
+    for key, help in (("bytes_sent", "Bytes sent to clients"), ("bytes_received", "Bytes received from clients"),
+                      ("frames_sent", "Frames sent to clients"), ("frames_received", "Frames received from clients")):
+        name = f"pong_{key}_total"
+        yield f"# HELP {name} {help}"
+        yield f"# TYPE {name} counter"
+        yield f"{name} {totals[key]}"
+        name = f"pong_client_{key}_total"
+        yield f"# HELP {name} {help}, per connected client"
+        yield f"# TYPE {name} counter"
+        for player in current:
+            yield f'{name}{{game="{player.game.game_id}",player="{player.player_id+1}"}} {getattr(player, key)}'
+
+    # Link quality of each client, see qos.py
+    for key, name, help in (("rtt", "rtt_seconds", "Smoothed round-trip time, 0 until measured"),
+                            ("jitter", "jitter_seconds", "Smoothed deviation of the round-trip time"),
+                            ("throughput", "throughput_bytes", "Bytes per second taken off the connection"),
+                            ("send_rate", "send_rate", "Snapshots per second sent")):
+        name = f"pong_client_{name}"
+        yield f"# HELP {name} {help}, per connected client"
+        yield f"# TYPE {name} gauge"
+        for player in current:
+            value = getattr(player.link, key) or 0
+            yield f'{name}{{game="{player.game.game_id}",player="{player.player_id+1}"}} {value:g}'
+
+def render() -> str:
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    lines.extend(render_clients())
+    return "\n".join(lines) + "\n"
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def reset():
+    """Zeroes counters and histograms, for a forked worker starting its own"""
+    for metric in registry:
+        metric.reset()
+
+def enable():
+    """Starts timing and counting, must be called before games are created"""
+    global enabled
+    enabled = True
+
+def serve(port: int, host: str = "127.0.0.1"):
+    """Serves /metrics on a background thread"""
+    global server
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Metrics at http://{host}:{port}/metrics")
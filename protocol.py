@@ -0,0 +1,545 @@
+"""
+Binary wire protocol shared by the server engines and the client.
+
+Every message is a length-prefixed frame:
+
+    uint16 length | uint8 type | payload (length - 1 bytes)
+
+All integers are big-endian. A connection starts with a handshake in which
+the client announces the protocol version it speaks:
+
+    client -> HELLO(magic, version)
+    server -> WELCOME(version, tick rate, UDP token)   or   REJECT(server version)
+    client -> JOIN(room code, utf-8 name)   or   RESUME(resume token)   or   SPECTATE(room code)
+    server -> MATCHED(player_id, resume token)   or   RESUME_FAILED   or   SPECTATING / NO_MATCH
+
+An empty room code queues the player for any opponent, otherwise they are
+paired with the player who gave the same code. MATCHED comes as soon as the
+player has a game, possibly one still waiting for an opponent; the client
+sends nothing between JOIN and MATCHED. After that the server streams
+SNAPSHOTs and the client sends one INPUT per frame (which also acknowledges
+the last snapshot it decoded) and PLAY_AGAIN votes. A JOIN sent during a
+match leaves it and queues again on the same connection: the server answers
+with a new MATCHED, and the snapshots after it belong to the new game, with
+their own sequence numbers. A client that quits sends LEAVE before closing.
+Nothing received from the network is ever unpickled.
+
+If the connection drops instead, the server keeps the player's slot in the
+game (and pauses the match) for a grace period. A client that connects
+again and sends RESUME with the token of its last MATCHED instead of JOIN
+gets a MATCHED for the same game, followed by a keyframe snapshot. An
+unknown or expired token gets RESUME_FAILED, after which the server hangs
+up.
+
+A spectator sends SPECTATE instead, with the room code of the match to
+watch, or an empty one for the match in play with the most spectators. It
+gets SPECTATING and then the same SNAPSHOTs as the players (with no input
+acknowledged), or NO_MATCH and a hang up if there is nothing to watch. A
+spectator sends nothing but LEAVE; the server hangs up when the game
+closes. Spectator snapshots are encoded once for every spectator of a
+game, each one a delta against the one before it; a spectator who fell
+behind has its queued snapshots dropped and gets the next one as a
+keyframe.
+
+During a match the server sends a player PING about once a second, with
+its clock in milliseconds and the round-trip time it last measured for
+that player (0 before the first one). The client echoes the clock in a
+PONG at once, so the server measures the link (see qos.py); the client
+may show the round-trip time it was told.
+
+Paddles are server-authoritative: an INPUT only carries the direction the
+player pushes and a sequence number. Every snapshot tells its recipient the
+last input sequence the server applied, so the client can predict its own
+paddle and reconcile against the server, and the server tick the snapshot
+was taken at, so the client can interpolate between snapshots.
+
+Snapshots are delta-compressed. Each one carries a sequence number, a
+reference to the snapshot it is based on (0 for a keyframe) and a bitmask
+of the fields that differ from that base. The server deltas against the last
+snapshot the client acknowledged, so in steady play only the ball moves and
+a snapshot costs 15 bytes on the wire.
+
+When the server runs with a UDP channel, WELCOME carries a non-zero token.
+The client may then send its inputs as datagrams on the same port, each one
+being the token followed by a frame. Datagrams carry INPUTS, which repeat
+the last few inputs so a lost datagram does not lose an input. Once the
+server has heard from the client over UDP it sends snapshots there as well
+(one frame per datagram). Clients drop snapshots older than the newest one
+they decoded. The handshake, names and rematch votes always stay on TCP.
+"""
+
+import struct
+
+PROTOCOL_VERSION = 8
+MAGIC = b"PONG"
+
+# Message types
+MSG_HELLO = 1
+MSG_WELCOME = 2
+MSG_REJECT = 3
+MSG_JOIN = 4
+MSG_SNAPSHOT = 5
+MSG_INPUT = 6
+MSG_PLAY_AGAIN = 7
+MSG_INPUTS = 8
+MSG_MATCHED = 9
+MSG_RESUME = 10
+MSG_RESUME_FAILED = 11
+MSG_LEAVE = 12
+MSG_SPECTATE = 13
+MSG_SPECTATING = 14
+MSG_NO_MATCH = 15
+MSG_PING = 16
+MSG_PONG = 17
+
+MAX_NAME_BYTES = 64
+MAX_ROOM_BYTES = 16
+RESUME_TOKEN_BYTES = 8
+
+HEADER = struct.Struct("!HB")
+HELLO = struct.Struct("!4sB")
+WELCOME = struct.Struct("!BBI")
+REJECT = struct.Struct("!B")
+# length of the room code, followed by the room code and the name
+JOIN = struct.Struct("!B")
+# player ID, resume token
+MATCHED = struct.Struct(f"!B{RESUME_TOKEN_BYTES}s")
+# acknowledged snapshot, input sequence, direction (-1, 0 or 1)
+INPUT = struct.Struct("!HHb")
+# acknowledged snapshot, sequence of the newest input, input count, then one
+# direction byte per input, oldest first
+INPUTS = struct.Struct("!HHB")
+# server clock (ms, wraps around), round-trip time last measured (ms, 0 = none yet)
+PING = struct.Struct("!IH")
+# server clock of the PING answered
+PONG = struct.Struct("!I")
+# token identifying the player a datagram comes from
+UDP_TOKEN = struct.Struct("!I")
+# Inputs repeated in every INPUTS datagram
+INPUT_REDUNDANCY = 8
+
+# Initial receive buffer of a FrameReader, plenty for the frames of this protocol
+RECV_BUFFER_SIZE = 4096
+
+# sequence, distance back to the base snapshot plus one (0 = keyframe), changed fields,
+# server tick, last input sequence applied for the recipient
+SNAPSHOT = struct.Struct("!HBBHH")
+
+# Snapshot fields, in wire order. Paddle y positions never change, so only
+# x is sent for them.
+FIELD_BALL = 0       # x, y
+FIELD_PADDLE_0 = 1   # x
+FIELD_PADDLE_1 = 2   # x
+FIELD_STATUS = 3     # countdown, winner_id (-1 = none), connected players, votes, flags
+FIELD_NAMES = 4      # one length-prefixed utf-8 string per player
+FIELD_COUNT = 5
+ALL_FIELDS = (1 << FIELD_COUNT) - 1
+
+BALL = struct.Struct("!hh")
+PADDLE_X = struct.Struct("!h")
+STATUS = struct.Struct("!BbBBB")
+
+FLAG_GAME_STARTED = 1
+FLAG_ACTIVE = 2
+FLAG_PLAYER_LEFT = 4
+
+# Snapshot and input sequence numbers wrap around at 16 bits; 0 means "none"
+NO_SNAPSHOT = 0
+NO_INPUT = 0
+class ProtocolError(Exception):
+    """Raised when a peer sends a malformed frame or an unexpected message"""
+
+def pack_frame(msg_type: int, payload: bytes = b"") -> bytes:
+    """Wrap a payload into a frame"""
+    return HEADER.pack(len(payload) + 1, msg_type) + payload
+
+def pack_hello() -> bytes:
+    return pack_frame(MSG_HELLO, HELLO.pack(MAGIC, PROTOCOL_VERSION))
+
+def unpack_hello(payload: bytes) -> int:
+    """Returns the version announced by the client"""
+    if len(payload) != HELLO.size:
+        raise ProtocolError("Malformed HELLO")
+    magic, version = HELLO.unpack(payload)
+    if magic != MAGIC:
+        raise ProtocolError("Not a Pong client")
+    return version
+
+def pack_welcome(tick_rate: int, udp_token: int = 0) -> bytes:
+    return pack_frame(MSG_WELCOME, WELCOME.pack(PROTOCOL_VERSION, tick_rate, udp_token))
+
+def unpack_welcome(payload: bytes):
+    """
+    Returns (server tick rate, UDP token), the token being 0 when the
+    server has no UDP channel
+    """
+    if len(payload) != WELCOME.size:
+        raise ProtocolError("Malformed WELCOME")
+    version, tick_rate, udp_token = WELCOME.unpack(payload)
+    if version != PROTOCOL_VERSION:
+        raise ProtocolError(f"Server speaks protocol version {version}")
+    return tick_rate, udp_token
+
+def pack_reject() -> bytes:
+    return pack_frame(MSG_REJECT, REJECT.pack(PROTOCOL_VERSION))
+
+def pack_join(name: str, room: str = "") -> bytes:
+    room = room.encode("utf-8")[:MAX_ROOM_BYTES]
+    return pack_frame(MSG_JOIN, JOIN.pack(len(room)) + room + name.encode("utf-8")[:MAX_NAME_BYTES])
+
+def unpack_join(payload: bytes):
+    """Returns (name, room code), the room code being "" for a public game"""
+    if len(payload) < JOIN.size:
+        raise ProtocolError("Malformed JOIN")
+    room_size, = JOIN.unpack_from(payload)
+    if room_size > MAX_ROOM_BYTES or len(payload) < JOIN.size + room_size:
+        raise ProtocolError("Malformed JOIN")
+    room = bytes(payload[JOIN.size:JOIN.size + room_size]).decode("utf-8", errors="replace")
+    name = bytes(payload[JOIN.size + room_size:][:MAX_NAME_BYTES]).decode("utf-8", errors="replace")
+    return name, room
+
+def pack_matched(player_id: int, token: bytes = bytes(RESUME_TOKEN_BYTES)) -> bytes:
+    return pack_frame(MSG_MATCHED, MATCHED.pack(player_id, token))
+
+def unpack_matched(payload: bytes):
+    """Returns (player ID in the game, token to resume it with)"""
+    if len(payload) != MATCHED.size:
+        raise ProtocolError("Malformed MATCHED")
+    player_id, token = MATCHED.unpack(payload)
+    if player_id > 1:
+        raise ProtocolError("Malformed MATCHED")
+    return player_id, token
+
+def pack_resume(token: bytes) -> bytes:
+    return pack_frame(MSG_RESUME, token)
+
+def unpack_resume(payload: bytes) -> bytes:
+    if len(payload) != RESUME_TOKEN_BYTES:
+        raise ProtocolError("Malformed RESUME")
+    return bytes(payload)
+
+def pack_resume_failed() -> bytes:
+    return pack_frame(MSG_RESUME_FAILED)
+
+def pack_leave() -> bytes:
+    return pack_frame(MSG_LEAVE)
+
+def pack_spectate(room: str = "") -> bytes:
+    return pack_frame(MSG_SPECTATE, room.encode("utf-8")[:MAX_ROOM_BYTES])
+
+def unpack_spectate(payload: bytes) -> str:
+    """Returns the room code to watch, "" for any match"""
+    if len(payload) > MAX_ROOM_BYTES:
+        raise ProtocolError("Malformed SPECTATE")
+    return bytes(payload).decode("utf-8", errors="replace")
+
+def pack_spectating() -> bytes:
+    return pack_frame(MSG_SPECTATING)
+
+def pack_no_match() -> bytes:
+    return pack_frame(MSG_NO_MATCH)
+
+def pack_ping(clock: int, rtt: int) -> bytes:
+    return pack_frame(MSG_PING, PING.pack(clock & 0xFFFFFFFF, min(rtt, 0xFFFF)))
+
+def unpack_ping(payload: bytes):
+    """Returns (server clock, round-trip time in ms, 0 if unknown)"""
+    if len(payload) != PING.size:
+        raise ProtocolError("Malformed PING")
+    return PING.unpack(payload)
+
+def pack_pong(clock: int) -> bytes:
+    return pack_frame(MSG_PONG, PONG.pack(clock))
+
+def unpack_pong(payload: bytes) -> int:
+    """Returns the server clock of the PING answered"""
+    if len(payload) != PONG.size:
+        raise ProtocolError("Malformed PONG")
+    return PONG.unpack(payload)[0]
+
+def pack_input(input_seq: int, direction: int, acked_seq: int) -> bytes:
+    return pack_frame(MSG_INPUT, INPUT.pack(acked_seq, input_seq, direction))
+
+def unpack_input(payload: bytes):
+    """Returns (input sequence, direction, acknowledged snapshot sequence)"""
+    if len(payload) != INPUT.size:
+        raise ProtocolError("Malformed INPUT")
+    acked_seq, input_seq, direction = INPUT.unpack(payload)
+    return input_seq, max(-1, min(direction, 1)), acked_seq
+
+def pack_inputs(inputs, acked_seq: int) -> bytes:
+    """Encode the most recent inputs, given as (sequence, direction) pairs oldest first"""
+    inputs = list(inputs)[-INPUT_REDUNDANCY:]
+    payload = INPUTS.pack(acked_seq, inputs[-1][0], len(inputs))
+    payload += struct.pack(f"!{len(inputs)}b", *(direction for _, direction in inputs))
+    return pack_frame(MSG_INPUTS, payload)
+
+def unpack_inputs(payload: bytes):
+    """Returns ([(sequence, direction), ...] oldest first, acknowledged snapshot sequence)"""
+    try:
+        acked_seq, newest_seq, count = INPUTS.unpack_from(payload)
+        directions = struct.unpack_from(f"!{count}b", payload, INPUTS.size)
+    except struct.error:
+        raise ProtocolError("Malformed INPUTS")
+    if count == 0 or count > INPUT_REDUNDANCY or len(payload) != INPUTS.size + count:
+        raise ProtocolError("Malformed INPUTS")
+    inputs = [(seq_back(newest_seq, count - 1 - i), max(-1, min(d, 1))) for i, d in enumerate(directions)]
+    return inputs, acked_seq
+
+def pack_datagram(udp_token: int, frame: bytes) -> bytes:
+    """Client to server datagram: the player's token followed by one frame"""
+    return UDP_TOKEN.pack(udp_token) + frame
+
+def unpack_datagram(data: bytes):
+    """Returns (token, type, payload) of a client datagram"""
+    if len(data) < UDP_TOKEN.size:
+        raise ProtocolError("Short datagram")
+    return (UDP_TOKEN.unpack_from(data)[0],) + parse_frame(memoryview(data)[UDP_TOKEN.size:])
+
+def parse_frame(data: bytes):
+    """Parse a buffer holding exactly one frame. Returns (type, payload)"""
+    if len(data) < HEADER.size:
+        raise ProtocolError("Short frame")
+    length, msg_type = HEADER.unpack_from(data)
+    if length < 1 or len(data) != HEADER.size + length - 1:
+        raise ProtocolError("Frame length mismatch")
+    return msg_type, bytes(data[HEADER.size:])
+
+def pack_play_again() -> bytes:
+    return pack_frame(MSG_PLAY_AGAIN)
+
+def next_seq(seq: int) -> int:
+    """Snapshot sequence that follows `seq`, skipping NO_SNAPSHOT on wrap around"""
+    return seq % 0xFFFF + 1
+
+def seq_offset(seq: int, base_seq: int) -> int:
+    """How many snapshots `base_seq` is behind `seq`, accounting for wrap around"""
+    return (seq - base_seq) % 0xFFFF
+
+def seq_back(seq: int, offset: int) -> int:
+    """Sequence of the snapshot `offset` snapshots before `seq`"""
+    return (seq - offset - 1) % 0xFFFF + 1
+
+def seq_newer(seq: int, than: int) -> bool:
+    """Whether `seq` comes after `than` (within half the sequence space)"""
+    return 0 < seq_offset(seq, than) < 0x8000
+
+def snapshot_fields(state) -> tuple:
+    """
+    Extracts the fields sent to clients from a published game state
+    (server.StateView), in wire order.
+    """
+    winner_id = state.winner_id
+    flags = ((FLAG_GAME_STARTED if state.game_started else 0)
+             | (FLAG_ACTIVE if state.active else 0)
+             | (FLAG_PLAYER_LEFT if state.player_leaved else 0))
+    return (
+        state.ball,
+        state.paddles_x[0],
+        state.paddles_x[1],
+        (state.countdown, -1 if winner_id is None else winner_id,
+         state.connected_players, state.play_again_votes, flags),
+        state.player_names,
+    )
+
+def pack_names(names) -> bytes:
+    payload = b""
+    for name in names:
+        encoded = name.encode("utf-8")[:MAX_NAME_BYTES]
+        payload += bytes([len(encoded)]) + encoded
+    return bytes([len(names)]) + payload
+
+def unpack_names(payload: bytes, pos: int):
+    """Returns (names, position after them)"""
+    names = []
+    count = payload[pos]
+    pos += 1
+    for _ in range(count):
+        size = payload[pos]
+        names.append(bytes(payload[pos+1:pos+1+size]).decode("utf-8", errors="replace"))
+        pos += 1 + size
+    return tuple(names), pos
+
+def pack_snapshot(seq: int, tick: int, input_ack: int, fields: tuple,
+                  base_seq: int = NO_SNAPSHOT, base_fields: tuple = None) -> bytes:
+    """
+    Encode a snapshot taken at server `tick` for a client whose last applied
+    input is `input_ack`. With a base it only carries the fields that differ
+    from it; without one it is a keyframe carrying every field.
+    """
+    if base_fields is None:
+        base_ref, mask = 0, ALL_FIELDS
+    else:
+        base_ref, mask = seq_offset(seq, base_seq) + 1, 0
+        for i in range(FIELD_COUNT):
+            if fields[i] != base_fields[i]:
+                mask |= 1 << i
+
+    payload = SNAPSHOT.pack(seq, base_ref, mask, tick & 0xFFFF, input_ack)
+    if mask & (1 << FIELD_BALL):
+        payload += BALL.pack(*fields[FIELD_BALL])
+    if mask & (1 << FIELD_PADDLE_0):
+        payload += PADDLE_X.pack(fields[FIELD_PADDLE_0])
+    if mask & (1 << FIELD_PADDLE_1):
+        payload += PADDLE_X.pack(fields[FIELD_PADDLE_1])
+    if mask & (1 << FIELD_STATUS):
+        payload += STATUS.pack(*fields[FIELD_STATUS])
+    if mask & (1 << FIELD_NAMES):
+        payload += pack_names(fields[FIELD_NAMES])
+    return pack_frame(MSG_SNAPSHOT, payload)
+
+def unpack_snapshot(payload: bytes, history: dict):
+    """
+    Decode a snapshot against the snapshots already received, given as a
+    dict of sequence -> fields. Returns (seq, tick, input_ack, fields), where
+    tick is the server tick modulo 2**16.
+    Raises ProtocolError if the delta base is not in `history`.
+    """
+    try:
+        seq, base_ref, mask, tick, input_ack = SNAPSHOT.unpack_from(payload)
+        if base_ref == 0:
+            if mask != ALL_FIELDS:
+                raise ProtocolError("Incomplete keyframe")
+            fields = [None] * FIELD_COUNT
+        else:
+            base = history.get(seq_back(seq, base_ref - 1))
+            if base is None:
+                raise ProtocolError("Unknown delta base")
+            fields = list(base)
+
+        pos = SNAPSHOT.size
+        if mask & (1 << FIELD_BALL):
+            fields[FIELD_BALL] = BALL.unpack_from(payload, pos)
+            pos += BALL.size
+        if mask & (1 << FIELD_PADDLE_0):
+            fields[FIELD_PADDLE_0] = PADDLE_X.unpack_from(payload, pos)[0]
+            pos += PADDLE_X.size
+        if mask & (1 << FIELD_PADDLE_1):
+            fields[FIELD_PADDLE_1] = PADDLE_X.unpack_from(payload, pos)[0]
+            pos += PADDLE_X.size
+        if mask & (1 << FIELD_STATUS):
+            fields[FIELD_STATUS] = STATUS.unpack_from(payload, pos)
+            pos += STATUS.size
+        if mask & (1 << FIELD_NAMES):
+            fields[FIELD_NAMES], pos = unpack_names(payload, pos)
+    except (struct.error, IndexError):
+        raise ProtocolError("Malformed SNAPSHOT")
+    if pos != len(payload):
+        raise ProtocolError("Malformed SNAPSHOT")
+    return seq, tick, input_ack, tuple(fields)
+
+def fields_to_state(fields: tuple) -> dict:
+    """
+    Turn snapshot fields back into a state dict. Positions are plain
+    numbers; the client knows the paddle and ball sizes and where each
+    paddle sits vertically.
+    """
+    countdown, winner_id, connected_players, play_again_votes, flags = fields[FIELD_STATUS]
+    return {
+        "ball": fields[FIELD_BALL],
+        "paddles_x": [fields[FIELD_PADDLE_0], fields[FIELD_PADDLE_1]],
+        "countdown": countdown,
+        "winner_id": None if winner_id < 0 else winner_id,
+        "connected_players": connected_players,
+        "play_again_votes": play_again_votes,
+        "game_started": bool(flags & FLAG_GAME_STARTED),
+        "active": bool(flags & FLAG_ACTIVE),
+        "player_leaved": bool(flags & FLAG_PLAYER_LEFT),
+        "player_names": list(fields[FIELD_NAMES]),
+    }
+
+class FrameReader:
+    """
+    Buffered frame reader for a blocking stream socket.
+
+    Receives with recv_into into one preallocated buffer, so a single recv
+    may bring in several frames (handed out one by one without touching the
+    socket again) or part of one (kept until the rest arrives). Bytes are
+    only moved when the frame being assembled does not fit in what is left
+    of the buffer, and the buffer only grows for frames larger than itself.
+
+    Payloads are memoryviews into the buffer, valid until the next call to
+    read_frame(). The decoders in this module copy what they keep.
+    """
+    def __init__(self, sock, size: int = RECV_BUFFER_SIZE):
+        self.sock = sock
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        # Unread data is buffer[start:end]
+        self.start = 0
+        self.end = 0
+
+    def read_frame(self):
+        """Returns (type, payload) of the next frame"""
+        while True:
+            needed = HEADER.size
+            if self.end - self.start >= HEADER.size:
+                length, msg_type = HEADER.unpack_from(self.buffer, self.start)
+                if length < 1:
+                    raise ProtocolError("Empty frame")
+                needed = HEADER.size + length - 1
+                if self.end - self.start >= needed:
+                    payload = self.view[self.start + HEADER.size:self.start + needed]
+                    self.start += needed
+                    return msg_type, payload
+            self.fill(needed)
+
+    def buffered(self) -> int:
+        """Bytes received but not read yet"""
+        return self.end - self.start
+
+    def pending(self) -> bytes:
+        """The bytes received but not read yet, to hand them over with the socket"""
+        return bytes(self.buffer[self.start:self.end])
+
+    def push(self, data: bytes):
+        """Makes `data` (pending() of another reader of the socket) the next bytes read"""
+        pending = self.buffer[self.start:self.end]
+        if len(data) + len(pending) > len(self.buffer):
+            self.buffer = bytearray(len(data) + len(pending))
+            self.view = memoryview(self.buffer)
+        self.buffer[:len(data) + len(pending)] = data + pending
+        self.start, self.end = 0, len(data) + len(pending)
+
+    def fill(self, needed: int):
+        """Receives more data, first making room for `needed` bytes from the unread data on"""
+        if self.start == self.end:
+            self.start = self.end = 0
+        elif self.start + needed > len(self.buffer):
+            pending = self.buffer[self.start:self.end]
+            if needed > len(self.buffer):
+                self.buffer = bytearray(max(needed, 2 * len(self.buffer)))
+                self.view = memoryview(self.buffer)
+            self.buffer[:len(pending)] = pending
+            self.start, self.end = 0, len(pending)
+        received = self.sock.recv_into(self.view[self.end:])
+        if not received:
+            raise ConnectionError("Connection closed")
+        self.end += received
+
+def recv_exact(sock, size: int) -> bytes:
+    """Read exactly `size` bytes from a blocking socket"""
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("Connection closed")
+        data += chunk
+    return data
+
+def recv_frame(sock):
+    """
+    Read one frame from a blocking socket, without buffering ahead. Returns
+    (type, payload). For a connection read frame after frame, use a FrameReader.
+    """
+    length, msg_type = HEADER.unpack(recv_exact(sock, HEADER.size))
+    if length < 1:
+        raise ProtocolError("Empty frame")
+    return msg_type, recv_exact(sock, length - 1)
+
+async def read_frame(reader):
+    """Read one frame from an asyncio StreamReader. Returns (type, payload)"""
+    length, msg_type = HEADER.unpack(await reader.readexactly(HEADER.size))
+    if length < 1:
+        raise ProtocolError("Empty frame")
+    return msg_type, await reader.readexactly(length - 1)
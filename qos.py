@@ -0,0 +1,107 @@
+"""
+Link quality of each client, and send rates adapted to it.
+
+While a player's snapshots are being sent, its sender also sends a PING
+every PING_INTERVAL seconds, stamped with the server's clock, which the
+client echoes in a PONG. Link keeps, per connection:
+
+  rtt         smoothed round-trip time (as TCP does, RFC 6298)
+  jitter      smoothed deviation of the round-trip time from it
+  base_rtt    lowest round-trip time seen, the link without queues
+  throughput  bytes per second the client took off the connection, from
+              what was sent minus what is still unsent at each ping
+
+Before each ping the send rate is adapted, additive increase and
+multiplicative decrease like TCP's congestion control: a link that queues
+(more than QUEUE_BYTES unsent, or a round-trip time QUEUE_DELAY over its
+base) gets RATE_DECREASE of its rate, down to MIN_SEND_RATE; any other gets
+RATE_INCREASE more snapshots per second, up to the server's send rate.
+Snapshots are deltas against what the client acknowledged, so a client
+sent fewer of them only sees the game in coarser steps.
+
+With adaptive off (server.py --fixed-send-rate) links are still measured,
+every client gets the server's send rate.
+"""
+
+import time
+
+import protocol
+
+# Seconds between two pings to a player
+PING_INTERVAL = 1.0
+# Snapshots per second a client is never sent fewer of
+MIN_SEND_RATE = 10
+# Signs of a link that queues: bytes still unsent at a ping, or seconds of round trip over its base
+QUEUE_BYTES = 512
+QUEUE_DELAY = 0.1
+# Multiplier of the send rate when the link queues, and snapshots per second added per ping otherwise
+RATE_DECREASE = 0.7
+RATE_INCREASE = 5
+# Round trips longer than this are stale pongs, not measurements
+MAX_RTT = 30.0
+
+adaptive = True
+
+def clock() -> int:
+    """The server's clock in milliseconds, as stamped in PINGs"""
+    return int(time.monotonic() * 1000) & 0xFFFFFFFF
+
+class Link:
+    """Measurements and send rate of one client connection, see the module's docstring"""
+    __slots__ = ("max_rate", "send_rate", "rtt", "jitter", "base_rtt", "throughput", "next_ping",
+                 "delivered", "measured_at")
+
+    def __init__(self, send_rate: int):
+        self.max_rate = send_rate
+        self.send_rate = send_rate
+        # Seconds, None until the first pong
+        self.rtt = None
+        self.jitter = 0.0
+        self.base_rtt = None
+        self.throughput = 0.0
+        self.next_ping = 0.0
+        # Bytes the client took off the connection at the last ping, and when
+        self.delivered = 0
+        self.measured_at = None
+
+    def due(self) -> bool:
+        return time.monotonic() >= self.next_ping
+
+    def ping(self, bytes_sent: int, unsent: int) -> bytes:
+        """
+        PING to send now. Updates the throughput from `bytes_sent` so far
+        and `unsent` of them, and adapts the send rate first.
+        """
+        now = time.monotonic()
+        delivered = bytes_sent - unsent
+        if self.measured_at is not None and now > self.measured_at:
+            sample = (delivered - self.delivered) / (now - self.measured_at)
+            self.throughput = sample if not self.throughput else 0.75 * self.throughput + 0.25 * sample
+        self.delivered, self.measured_at = delivered, now
+        if adaptive:
+            self.adapt(unsent)
+        self.next_ping = now + PING_INTERVAL
+        rtt = round(self.rtt * 1000) if self.rtt is not None else 0
+        return protocol.pack_ping(clock(), rtt)
+
+    def pong(self, stamp: int):
+        """A PONG echoing `stamp` arrived"""
+        rtt = ((clock() - stamp) & 0xFFFFFFFF) / 1000
+        if rtt > MAX_RTT:
+            return
+        if self.rtt is None:
+            self.rtt, self.jitter = rtt, rtt / 2
+        else:
+            self.jitter = 0.75 * self.jitter + 0.25 * abs(self.rtt - rtt)
+            self.rtt = 0.875 * self.rtt + 0.125 * rtt
+        self.base_rtt = rtt if self.base_rtt is None else min(self.base_rtt, rtt)
+
+    def queueing(self, unsent: int) -> bool:
+        """Whether the link holds back what it is sent"""
+        return unsent > QUEUE_BYTES or (self.rtt is not None and self.rtt > self.base_rtt + QUEUE_DELAY)
+
+    def adapt(self, unsent: int):
+        if self.queueing(unsent):
+            self.send_rate = max(min(MIN_SEND_RATE, self.max_rate), self.send_rate * RATE_DECREASE)
+        else:
+            self.send_rate = min(self.max_rate, self.send_rate + RATE_INCREASE)
@@ -0,0 +1,262 @@
+"""
+Player ratings for the Pong server.
+
+With server.py --ratings FILE, the result of every match played by two
+connected players updates both players' Elo ratings, which matchmaking
+pairs them by, and is kept in a SQLite database along with wins and
+losses. Players are known by the name they give, as nothing else
+identifies them across connections.
+
+Ratings live in memory, loaded from the database at startup: a result
+only updates two entries under a lock and queues the rows to write, so a
+game's tick never waits for the disk. A writer thread owns the database
+connection and writes what is queued in batches, one transaction every
+FLUSH_INTERVAL seconds or BATCH_SIZE results, whichever comes first. A
+result not written yet is lost if the process is killed, close() writes
+everything out on a normal exit.
+
+The leaderboard is cached and only recomputed when a result may change it
+(one of its players played, or someone rated above its last entry).
+
+In sharded mode the workers play the matches but the front-end owns the
+ratings: workers send it their results (see sharded_server.py).
+
+Usage, to print the leaderboard of a database:
+    python ratings.py ratings.db --top 10
+"""
+
+import argparse
+import heapq
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+import metrics
+from matchmaking import INITIAL_RATING
+
+# Elo: most a rating moves in one match, and the rating gap giving 10:1 odds
+K_FACTOR = 32
+ELO_SCALE = 400
+# Results written in one transaction at most, and seconds a result waits to be written at most
+BATCH_SIZE = 1000
+FLUSH_INTERVAL = 1.0
+# Entries of the leaderboard cached
+LEADERBOARD_SIZE = 10
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS players (
+    name TEXT PRIMARY KEY,
+    rating REAL NOT NULL,
+    wins INTEGER NOT NULL,
+    losses INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS matches (
+    id INTEGER PRIMARY KEY,
+    played_at REAL NOT NULL,
+    winner TEXT NOT NULL,
+    loser TEXT NOT NULL,
+    winner_rating REAL NOT NULL,
+    loser_rating REAL NOT NULL
+);
+"""
+
+# Where results go, None while ratings are off (see enable()). In a sharded
+# worker, a function sending them to the front-end
+store = None
+report = None
+
+class Rating:
+    """A player's rating and record"""
+    __slots__ = ("name", "rating", "wins", "losses")
+
+    def __init__(self, name: str, rating: float = INITIAL_RATING, wins: int = 0, losses: int = 0):
+        self.name = name
+        self.rating = rating
+        self.wins = wins
+        self.losses = losses
+
+    def row(self) -> tuple:
+        return (self.name, self.rating, self.wins, self.losses)
+
+def expected_score(rating: float, opponent: float) -> float:
+    """Chance of winning against `opponent`, according to Elo"""
+    return 1 / (1 + 10 ** ((opponent - rating) / ELO_SCALE))
+
+class Ratings:
+    """
+    Ratings of every player, in memory, written behind to the SQLite
+    database at `path`. Thread-safe.
+    """
+    def __init__(self, path: str, k_factor: float = K_FACTOR, batch_size: int = BATCH_SIZE,
+                 flush_interval: float = FLUSH_INTERVAL):
+        self.path = path
+        self.k_factor = k_factor
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.players = {}
+        # Rows of the best rated players, best first, None once a result may have changed them
+        self.top = None
+        self.queue = queue.SimpleQueue()
+        self.thread = None
+        db = sqlite3.connect(path)
+        try:
+            db.executescript(SCHEMA)
+            for row in db.execute("SELECT name, rating, wins, losses FROM players"):
+                self.players[row[0]] = Rating(*row)
+        finally:
+            db.close()
+        metrics.ratings_pending.function = self.queue.qsize
+
+    def rating(self, name: str) -> int:
+        """A player's rating, INITIAL_RATING if they never played"""
+        player = self.players.get(name)
+        return round(player.rating) if player else INITIAL_RATING
+
+    def player(self, name: str):
+        """(name, rating, wins, losses) of a player, None if they never played"""
+        with self.lock:
+            player = self.players.get(name)
+            return player.row() if player else None
+
+    def record(self, winner: str, loser: str):
+        """Updates the ratings with a match result and queues it to be written. Never blocks on the disk"""
+        with self.lock:
+            players = self.players
+            won = players.get(winner) or players.setdefault(winner, Rating(winner))
+            lost = players.get(loser) or players.setdefault(loser, Rating(loser))
+            change = self.k_factor * (1 - expected_score(won.rating, lost.rating))
+            won.rating += change
+            lost.rating -= change
+            won.wins += 1
+            lost.losses += 1
+            top = self.top
+            if top is not None and (len(top) < LEADERBOARD_SIZE or won.rating >= top[-1][1]
+                                    or any(row[0] in (winner, loser) for row in top)):
+                self.top = None
+            result = (time.time(), winner, loser, won.rating, lost.rating, won.row(), lost.row())
+        metrics.match_results.inc()
+        if self.thread is None:
+            self.start()
+        self.queue.put(result)
+
+    def leaderboard(self, count: int = LEADERBOARD_SIZE) -> list:
+        """(name, rating, wins, losses) of the `count` best rated players, best first"""
+        if count > LEADERBOARD_SIZE:
+            with self.lock:
+                return [player.row() for player in heapq.nlargest(count, self.players.values(),
+                                                                 key=lambda player: player.rating)]
+        top = self.top
+        if top is None:
+            with self.lock:
+                if self.top is None:
+                    self.top = [player.row() for player in heapq.nlargest(LEADERBOARD_SIZE, self.players.values(),
+                                                                          key=lambda player: player.rating)]
+                top = self.top
+        return top[:count]
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="ratings", daemon=True)
+                self.thread.start()
+
+    def flush(self):
+        """Waits until every result recorded so far is written"""
+        if self.thread is None:
+            return
+        written = threading.Event()
+        self.queue.put(written)
+        written.wait()
+
+    def run(self):
+        """Writer thread: takes what is queued and writes it a batch at a time"""
+        db = sqlite3.connect(self.path)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        while True:
+            batch, waiting = [], []
+            item = self.queue.get()
+            deadline = time.monotonic() + self.flush_interval
+            while True:
+                if isinstance(item, threading.Event):
+                    waiting.append(item)
+                    break
+                batch.append(item)
+                if len(batch) >= self.batch_size:
+                    break
+                try:
+                    item = self.queue.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+            if batch:
+                self.write(db, batch)
+            for written in waiting:
+                written.set()
+
+    def write(self, db: sqlite3.Connection, batch: list):
+        # Only the latest row of each player in the batch is needed
+        rows = {}
+        for *_, won, lost in batch:
+            rows[won[0]] = won
+            rows[lost[0]] = lost
+        try:
+            with db:
+                db.executemany("INSERT INTO matches (played_at, winner, loser, winner_rating, loser_rating) "
+                               "VALUES (?, ?, ?, ?, ?)", [result[:5] for result in batch])
+                db.executemany("INSERT OR REPLACE INTO players (name, rating, wins, losses) VALUES (?, ?, ?, ?)",
+                               rows.values())
+        except sqlite3.Error as e:
+            print(f"Error writing ratings to {self.path}: {e}")
+
+def enable(path: str):
+    """Rates every match from now on, with the ratings kept in `path`"""
+    global store
+    store = Ratings(path)
+
+def rating(name: str) -> int:
+    """Rating to pair a player by"""
+    return store.rating(name) if store else INITIAL_RATING
+
+def record(player_names, winner_id: int):
+    """Rates a match between two connected players that `winner_id` won, if ratings are on"""
+    if store is None and report is None:
+        return
+    winner, loser = player_names[winner_id], player_names[1 - winner_id]
+    # Nobody to rate, or the same player twice
+    if not winner or not loser or winner == loser:
+        return
+    if report:
+        report(winner, loser)
+    else:
+        store.record(winner, loser)
+
+def close():
+    """Writes out every result recorded"""
+    if store:
+        store.flush()
+
+def main():
+    parser = argparse.ArgumentParser(description="Prints the leaderboard of a ratings database")
+    parser.add_argument("path")
+    parser.add_argument("--top", type=int, default=LEADERBOARD_SIZE)
+    parser.add_argument("--player", help="print this player's rating and record instead")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.path):
+        parser.error(f"{args.path} does not exist")
+    ratings = Ratings(args.path)
+    if args.player:
+        row = ratings.player(args.player)
+        if row is None:
+            print(f"{args.player} has not played")
+        else:
+            print(f"{row[0]}: {row[1]:.0f} ({row[2]} wins, {row[3]} losses)")
+        return
+    for rank, (name, value, wins, losses) in enumerate(ratings.leaderboard(args.top), 1):
+        print(f"{rank:>4}. {name:<24} {value:>6.0f} {wins:>6} W {losses:>6} L")
+
+if __name__ == "__main__":
+    main()
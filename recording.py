@@ -0,0 +1,240 @@
+"""
+Match recordings for the Pong server.
+
+With server.py --record DIR, every game appends what changed its physics
+to its own file in DIR: the rackets' moves, the countdown (which serves
+the ball or pauses it), rematches and who won. Physics has no randomness,
+so these, the tick rate and the collision detection in use are all
+replay.py needs to run the match again and check its result.
+
+Events are placed on the game's ball steps (ticks with the ball in play)
+rather than on wall-clock ticks: an event recorded at step S took effect
+after step S and before step S+1, whatever the engine and however long
+the game sat parked in between.
+
+File format, big endian:
+    header   "PREC", format version (B), tick rate (H), game ID length (B), game ID,
+             collision detection length (B) and name (server.COLLISIONS)
+    records  tag (B), ball steps since the previous record (H)
+The tag's high nibble is the kind of event, its low nibble an argument:
+    MOVE       player ID << 1 | 1 if to the right, 0 if to the left
+    COUNTDOWN  seconds left, the ball is in play at 0
+    RESET      (rematch) ball, rackets and countdown back to the start
+    WIN        winner ID
+    NAME       player ID, followed by the name's length (B) and UTF-8 bytes
+    END        game closed
+    WAIT       nothing, only moves the step on (gaps over 65535 steps)
+
+Records are buffered per game and handed to one writer thread that owns
+the files, so no file I/O happens while a game is locked. A recording is
+complete once it has its END record.
+"""
+
+import itertools
+import os
+import queue
+import struct
+import threading
+import time
+
+import metrics
+
+MAGIC = b"PREC"
+FORMAT_VERSION = 2
+HEADER = struct.Struct("!4sBHB")
+RECORD = struct.Struct("!BH")
+NAME_LENGTH = struct.Struct("!B")
+# Version 1 recordings have no collision detection in the header
+DEFAULT_COLLISION = "discrete"
+MAX_DELTA = 0xFFFF
+
+REC_MOVE = 0x10
+REC_COUNTDOWN = 0x20
+REC_RESET = 0x30
+REC_WIN = 0x40
+REC_NAME = 0x50
+REC_END = 0x60
+REC_WAIT = 0x70
+
+# Bytes buffered per game before they are handed to the writer thread
+FLUSH_BYTES = 4096
+EXTENSION = ".pongrec"
+
+# Where recordings go, None while recording is off (see enable())
+directory = None
+# Numbers the files of this process, game IDs are not unique
+counter = itertools.count()
+
+class RecordingError(Exception):
+    pass
+
+class Writer:
+    """
+    Appends chunks to recording files on a single thread, started on first
+    use, keeping each file open until its last chunk.
+    """
+    def __init__(self):
+        self.queue = queue.SimpleQueue()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def write(self, path: str, data: bytes, close: bool = False):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="recording", daemon=True)
+                self.thread.start()
+        self.queue.put((path, data, close))
+
+    def flush(self):
+        """Waits until every chunk handed over so far is written"""
+        if self.thread is None:
+            return
+        written = threading.Event()
+        self.queue.put((None, written, False))
+        written.wait()
+
+    def run(self):
+        files = {}
+        while True:
+            path, data, close = self.queue.get()
+            if path is None:
+                for file in files.values():
+                    file.flush()
+                data.set()
+                continue
+            try:
+                file = files.get(path)
+                if file is None:
+                    file = files[path] = open(path, "ab")
+                file.write(data)
+                metrics.recorded_bytes.inc(len(data))
+                if close:
+                    del files[path]
+                    file.close()
+            except OSError as e:
+                print(f"Error writing recording {path}: {e}")
+                files.pop(path, None)
+
+writer = Writer()
+
+class Recorder:
+    """
+    Records the events of one game. Callers hold the game lock, so events
+    arrive in the order they took effect; `write(data, close)` gets the
+    encoded records in chunks.
+    """
+    def __init__(self, game_id: str, tick_rate: int, write, collision: str = DEFAULT_COLLISION, path: str = None):
+        self.write = write
+        self.path = path
+        self.step = 0
+        game_id, collision = game_id.encode(), collision.encode()
+        self.buffer = bytearray(HEADER.pack(MAGIC, FORMAT_VERSION, tick_rate, len(game_id)) + game_id
+                                + NAME_LENGTH.pack(len(collision)) + collision)
+
+    def record(self, tag: int, step: int, extra: bytes = b""):
+        """Adds an event that took effect after ball step `step`"""
+        delta = step - self.step
+        while delta > MAX_DELTA:
+            self.buffer += RECORD.pack(REC_WAIT, MAX_DELTA)
+            delta -= MAX_DELTA
+        self.buffer += RECORD.pack(tag, delta)
+        self.buffer += extra
+        self.step = step
+        if len(self.buffer) >= FLUSH_BYTES:
+            self.flush()
+
+    def move(self, step: int, player_id: int, direction: int):
+        self.record(REC_MOVE | player_id << 1 | (direction > 0), step)
+
+    def countdown(self, step: int, seconds: int):
+        self.record(REC_COUNTDOWN | seconds, step)
+
+    def reset(self, step: int):
+        self.record(REC_RESET, step)
+
+    def win(self, step: int, winner_id: int):
+        self.record(REC_WIN | winner_id, step)
+
+    def name(self, step: int, player_id: int, name: str):
+        name = name.encode()[:255]
+        self.record(REC_NAME | player_id, step, NAME_LENGTH.pack(len(name)) + name)
+
+    def end(self, step: int):
+        """Records the end of the game and hands over the rest"""
+        self.record(REC_END, step)
+        self.flush(close=True)
+
+    def flush(self, close: bool = False):
+        self.write(bytes(self.buffer), close)
+        self.buffer.clear()
+
+def enable(path: str):
+    """Records every game created from now on to a file in `path`"""
+    global directory
+    os.makedirs(path, exist_ok=True)
+    directory = path
+
+def open_recorder(game_id: str, tick_rate: int, collision: str = DEFAULT_COLLISION):
+    """Recorder for a new game, or None if recording is off"""
+    if directory is None:
+        return None
+    name = f"{time.strftime('%Y%m%d-%H%M%S')}-{game_id}-{os.getpid()}-{next(counter)}{EXTENSION}"
+    path = os.path.join(directory, name)
+    return Recorder(game_id, tick_rate, lambda data, close: writer.write(path, data, close), collision, path)
+
+def continue_recorder(path: str, step: int):
+    """
+    Recorder appending to the recording at `path`, started by the previous
+    server process (see handoff.py), whose last record was at ball step
+    `step`. None if recording is off.
+    """
+    if directory is None:
+        return None
+    recorder = Recorder("", 0, lambda data, close: writer.write(path, data, close), path=path)
+    # The file has its header already
+    recorder.buffer.clear()
+    recorder.step = step
+    return recorder
+
+def read_header(data: bytes):
+    """Returns (tick rate, collision detection, game ID, offset of the first record)"""
+    if len(data) < HEADER.size:
+        raise RecordingError("Truncated header")
+    magic, version, tick_rate, id_length = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise RecordingError("Not a match recording")
+    if version not in (1, FORMAT_VERSION):
+        raise RecordingError(f"Unsupported recording version {version}")
+    offset = HEADER.size + id_length
+    game_id = data[HEADER.size:offset].decode(errors="replace")
+    collision = DEFAULT_COLLISION
+    if version >= 2:
+        if len(data) <= offset:
+            raise RecordingError("Truncated header")
+        length = data[offset]
+        collision = data[offset + 1:offset + 1 + length].decode(errors="replace")
+        offset += 1 + length
+    if len(data) < offset:
+        raise RecordingError("Truncated header")
+    return tick_rate, collision, game_id, offset
+
+def read_records(data: bytes, offset: int):
+    """Yields (step, kind, argument, extra) for each record, WAIT records left out"""
+    step = 0
+    end = len(data)
+    while offset < end:
+        if end - offset < RECORD.size:
+            raise RecordingError("Truncated record")
+        tag, delta = RECORD.unpack_from(data, offset)
+        offset += RECORD.size
+        step += delta
+        kind = tag & 0xF0
+        extra = b""
+        if kind == REC_NAME:
+            if offset >= end:
+                raise RecordingError("Truncated record")
+            length = data[offset]
+            extra = data[offset + 1:offset + 1 + length]
+            offset += 1 + length
+        if kind != REC_WAIT:
+            yield step, kind, tag & 0x0F, extra
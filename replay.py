@@ -0,0 +1,145 @@
+"""
+Replays match recordings (server.py --record) and checks their results.
+
+Each recording is run again through the server's own physics
+(server.advance_ball, or advance_ball_swept if it was recorded with swept
+collision detection), as fast as it goes, and the winner of every match
+in it is compared with the one the server recorded. Exits with status 1
+if any recording does not replay to the same results.
+
+Usage:
+    python replay.py recordings/ --jobs 4
+    python replay.py recordings/20240101-120000-1234-4242-0.pongrec --verbose
+"""
+
+import argparse
+import glob
+import os
+import sys
+import time
+from multiprocessing import Pool
+from typing import NamedTuple
+
+import recording
+from recording import RecordingError
+from server import GameState, BASE_TICK_RATE, ADVANCE_BALL, move_racket
+
+class ReplayResult(NamedTuple):
+    game_id: str
+    tick_rate: int
+    collision: str
+    steps: int                  # ball steps replayed
+    player_names: tuple
+    recorded: list              # (step, winner ID) of each match won, as recorded
+    replayed: list              # and as replayed
+    complete: bool              # the recording has its END record
+
+    @property
+    def verified(self) -> bool:
+        return self.complete and self.recorded == self.replayed
+
+def replay(data: bytes) -> ReplayResult:
+    """Runs a recorded match again from its events"""
+    tick_rate, collision, game_id, offset = recording.read_header(data)
+    advance_ball = ADVANCE_BALL.get(collision)
+    if advance_ball is None:
+        raise RecordingError(f"Unknown collision detection {collision}")
+    frames = 1 / tick_rate * BASE_TICK_RATE
+    state = GameState()
+    steps = 0
+    recorded, replayed = [], []
+    complete = False
+    for step, kind, argument, extra in recording.read_records(data, offset):
+        # Steps the ball until the event, it was in play all along
+        while steps < step:
+            if state.countdown > 0:
+                raise RecordingError(f"Event at ball step {step} while the ball was not in play")
+            if state.winner_id is not None:
+                # The replay ended the match before the server did, go on from the next event
+                steps = step
+                break
+            steps += 1
+            state.ball_pos, state.ball_speed, winner_id = advance_ball(state.ball_pos, state.ball_speed,
+                                                                       state.paddles, frames)
+            if winner_id is not None:
+                state.winner_id = winner_id
+                replayed.append((steps, winner_id))
+
+        if kind == recording.REC_MOVE:
+            paddle = state.paddles[argument >> 1]
+            paddle.x = move_racket(paddle.x, 1 if argument & 1 else -1)
+        elif kind == recording.REC_COUNTDOWN:
+            state.countdown = argument
+        elif kind == recording.REC_RESET:
+            state.reset()
+        elif kind == recording.REC_WIN:
+            recorded.append((step, argument))
+            # Follow the server from here even if the replay went another way
+            state.winner_id = argument
+        elif kind == recording.REC_NAME:
+            state.player_names[argument] = extra.decode(errors="replace")
+        elif kind == recording.REC_END:
+            complete = True
+    return ReplayResult(game_id, tick_rate, collision, steps, tuple(state.player_names), recorded, replayed, complete)
+
+def replay_file(path: str):
+    """Returns (path, ReplayResult or None, error message or None)"""
+    try:
+        with open(path, "rb") as file:
+            data = file.read()
+        return path, replay(data), None
+    except (OSError, RecordingError) as e:
+        return path, None, str(e)
+
+def find_recordings(paths: list) -> list:
+    """The files given, and the recordings in the directories given"""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(glob.glob(os.path.join(path, "*" + recording.EXTENSION))))
+        else:
+            files.append(path)
+    return files
+
+def describe(result: ReplayResult) -> str:
+    names = " vs ".join(name or "?" for name in result.player_names)
+    winners = ", ".join(f"{result.player_names[winner_id] or f'Player {winner_id+1}'} at step {step}"
+                        for step, winner_id in result.recorded) or "no winner"
+    return f"game {result.game_id} ({names}), {result.steps} ball steps, won by {winners}"
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("paths", nargs="+", help="recordings, or directories of recordings")
+    parser.add_argument("--jobs", type=int, default=1, help="replay in this many processes")
+    parser.add_argument("--verbose", action="store_true", help="describe every recording, not only failures")
+    args = parser.parse_args()
+
+    files = find_recordings(args.paths)
+    start = time.perf_counter()
+    if args.jobs > 1:
+        with Pool(args.jobs) as pool:
+            results = list(pool.imap_unordered(replay_file, files, chunksize=16))
+    else:
+        results = [replay_file(path) for path in files]
+    elapsed = time.perf_counter() - start
+
+    failed = steps = 0
+    for path, result, error in sorted(results, key=lambda item: item[0]):
+        if error:
+            failed += 1
+            print(f"{path}: ERROR {error}")
+            continue
+        steps += result.steps
+        if not result.complete:
+            print(f"{path}: INCOMPLETE {describe(result)}")
+        elif result.recorded != result.replayed:
+            failed += 1
+            print(f"{path}: MISMATCH recorded {result.recorded}, replayed {result.replayed}")
+        elif args.verbose:
+            print(f"{path}: OK {describe(result)}")
+    print(f"{len(files)} recordings, {failed} failed, {steps} ball steps in {elapsed:.2f}s "
+          f"({steps / elapsed if elapsed else 0:.0f} steps/s)")
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""
+Timer scheduler for the threaded engine.
+
+One thread runs every timed event of the server (countdowns, rematch
+windows) from a heap ordered by deadline, sleeping until the next one is
+due, instead of one sleeping thread per event. It has the same call_later()
+interface as an asyncio event loop, so game code schedules through either.
+"""
+
+import heapq
+import itertools
+import threading
+import time
+
+class Timer:
+    """A scheduled call, cancel() drops it if it has not run yet"""
+    __slots__ = ("when", "callback", "args", "cancelled")
+
+    def __init__(self, when: float, callback, args: tuple):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+class Scheduler:
+    """
+    Runs callbacks at their deadline on a single thread, started on first
+    use. Callbacks must be short: they delay every event due after them.
+    """
+    def __init__(self):
+        self.heap = []
+        # Tie breaker, so timers due at the same time run in scheduling order
+        self.counter = itertools.count()
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def call_later(self, delay: float, callback, *args) -> Timer:
+        timer = Timer(time.monotonic() + delay, callback, args)
+        with self.condition:
+            heapq.heappush(self.heap, (timer.when, next(self.counter), timer))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="scheduler", daemon=True)
+                self.thread.start()
+            # Only a new earliest deadline changes how long the thread sleeps
+            if self.heap[0][2] is timer:
+                self.condition.notify()
+        return timer
+
+    def run(self):
+        while True:
+            with self.condition:
+                while True:
+                    while self.heap and self.heap[0][2].cancelled:
+                        heapq.heappop(self.heap)
+                    now = time.monotonic()
+                    if self.heap and self.heap[0][0] <= now:
+                        break
+                    self.condition.wait(self.heap[0][0] - now if self.heap else None)
+                _, _, timer = heapq.heappop(self.heap)
+            try:
+                timer.callback(*timer.args)
+            except Exception as e:
+                print(f"Error in scheduled {getattr(timer.callback, '__name__', timer.callback)}: {e}")
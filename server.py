@@ -1,216 +1,1162 @@
+import argparse
+import base64
+import select
+import signal
 import socket
+import sys
 import threading
-import pickle
-import pygame
 import time
 import math
+from collections import deque
+from typing import NamedTuple
 from dotenv import load_dotenv
 import os
+import secrets
+from functools import partial
+from contextlib import ExitStack
+import protocol
+import metrics
+import recording
+import ratings
+import backpressure
+import qos
+import handoff
+from matchmaking import Matchmaker
+from sessions import Sessions, Session
+from spectators import Stands, Spectator
+from scheduler import Scheduler
+from geometry import Rect
 from random import randint
 import time
 
 WIDTH, HEIGHT = 960, 600
 PADDLE_WIDTH, PADDLE_HEIGHT = 120, 10
+PADDLE_SPEED = 12
 BALL_RADIUS = 8
 BALL_SPEED_X_INITIAL, BALL_SPEED_Y_INITIAL = 4, 4
 SPEED_INCREASE_PER_FRAME = 0.005
 MAX_SPEED = 12
 
-# Initialize pygame to use Rect
-pygame.init()
+# Speeds above are expressed per frame at this rate; other tick rates scale them
+BASE_TICK_RATE = 60
+TICK_RATE = 60
+SEND_RATE = 30
+# Ticks simulated at most per wake up when the loop falls behind, the rest is dropped
+MAX_CATCH_UP_TICKS = 5
+
+# Seconds counted down before the ball is served, or served again after a pause
+COUNTDOWN = 3
+# Seconds a finished match waits for both rematch votes before it is closed
+REMATCH_WINDOW = 60
+
+# Snapshots kept per game to encode deltas against (below 255, the
+# distance to the base snapshot is sent in one byte)
+SNAPSHOT_HISTORY = 64
+
+ENGINES = ("threaded", "asyncio")
+# per-game: one logic thread (or task) per game; batch: every game in one NumPy step
+PHYSICS = ("per-game", "batch")
+# discrete: the ball is tested against the rackets where each tick leaves it;
+# swept: along its whole path, see advance_ball_swept()
+COLLISIONS = ("discrete", "swept")
+
+# Swept collision: largest angle off the vertical a ball leaves a racket at
+# when hit on its very edge, and most bounces resolved within one tick
+MAX_BOUNCE_ANGLE = math.radians(60)
+MAX_BOUNCES_PER_TICK = 8
+
+# Countdowns and rematch windows of the threaded engine
+timers = Scheduler()
+
+class StateView(NamedTuple):
+    """
+    Immutable state of a game as of its last change. Writers publish a new
+    one after every change, so readers never take the game lock and never
+    see a half-updated state.
+    """
+    tick: int
+    ball: tuple                 # whole pixels, as sent to clients
+    ball_pos: tuple
+    ball_speed: tuple
+    paddles_x: tuple
+    winner_id: object           # None while nobody has won
+    game_started: bool
+    countdown: int
+    player_names: tuple
+    connected_players: int
+    active: bool
+    play_again_votes: int
+    player_leaved: bool
+
+class GameState:
+    """
+    Mutable state of a game. Only touched while holding Game.lock, by the
+    code that changes it; everything else reads the published StateView.
+    """
+    __slots__ = ("tick", "steps", "paddles", "ball", "ball_pos", "ball_speed", "winner_id", "game_started",
+                 "countdown", "player_names", "connected_players", "active", "play_again_votes",
+                 "player_leaved")
+    
+    def __init__(self):
+        # Simulation ticks run so far, clients interpolate snapshots on it
+        self.tick = 0
+        # Ticks run with the ball in play, recordings place events on it
+        self.steps = 0
+        self.player_names = ["", ""]
+        self.connected_players = 0
+        self.active = True
+        self.player_leaved = False
+        self.reset()
+    
+    def reset(self):
+        """Puts rackets, ball and countdown back for a new match"""
+        self.paddles = [
+            Rect(WIDTH/2 - PADDLE_WIDTH/2, HEIGHT - 20 - PADDLE_HEIGHT, PADDLE_WIDTH, PADDLE_HEIGHT),
+            Rect(WIDTH/2 - PADDLE_WIDTH/2, 20, PADDLE_WIDTH, PADDLE_HEIGHT)
+        ]
+        self.ball = Rect(WIDTH/2 - BALL_RADIUS, HEIGHT/2 - BALL_RADIUS, BALL_RADIUS * 2, BALL_RADIUS * 2)
+        # Exact ball position, the Rect above only holds whole pixels
+        self.ball_pos = [WIDTH/2 - BALL_RADIUS, HEIGHT/2 - BALL_RADIUS]
+        self.winner_id = None
+        self.game_started = False
+        self.countdown = COUNTDOWN
+        self.ball_speed = [BALL_SPEED_X_INITIAL, BALL_SPEED_Y_INITIAL]
+        self.play_again_votes = 0
+    
+    def view(self) -> StateView:
+        return StateView(self.tick, (self.ball.x, self.ball.y), tuple(self.ball_pos), tuple(self.ball_speed),
+                         (self.paddles[0].x, self.paddles[1].x), self.winner_id, self.game_started,
+                         self.countdown, tuple(self.player_names), self.connected_players, self.active,
+                         self.play_again_votes, self.player_leaved)
 
 class Game:
     """
     Represents a two-player Pong game.
-    Each game has its own lock to securely access the game state.
+    Code changing the game holds its lock and publishes a new StateView,
+    readers use get_state() without locking.
     """
-    def __init__(self, game_id: str):
+    def __init__(self, game_id: str, tick_rate: int = TICK_RATE, collision: str = "discrete"):
         self.game_id = game_id
-        self.lock = threading.Lock() 
-        self.state = {
-            "paddles": [
-                pygame.Rect(WIDTH/2 - PADDLE_WIDTH/2, HEIGHT - 20 - PADDLE_HEIGHT, PADDLE_WIDTH, PADDLE_HEIGHT),
-                pygame.Rect(WIDTH/2 - PADDLE_WIDTH/2, 20, PADDLE_WIDTH, PADDLE_HEIGHT)
-            ],
-            "ball": pygame.Rect(WIDTH/2 - BALL_RADIUS, HEIGHT/2 - BALL_RADIUS, BALL_RADIUS * 2, BALL_RADIUS * 2),
-            "winner_id": None,
-            "game_started": False,
-            "countdown": 3,
-            "ball_speed": [BALL_SPEED_X_INITIAL, BALL_SPEED_Y_INITIAL],
-            "player_names": ["", ""],
-            "connected_players": 0,
-            "active": True,
-            "play_again_votes": 0,
-            "player_leaved": False
-        }
-    
-    def get_state_copy(self):
-        """Get a secure copy of the current game state"""
+        self.tick_rate = tick_rate
+        self.lock = metrics.new_lock()
+        self.state = GameState()
+        self.published = self.state.view()
+        # Numbered snapshots recently sent to clients, oldest first. Only the
+        # snapshot senders use them, under their own lock
+        self.snapshots = deque(maxlen=SNAPSHOT_HISTORY)
+        self.snapshot_lock = threading.Lock()
+        # BatchPhysics holding the ball while attached, see batch_physics.py
+        self.physics = None
+        self.physics_slot = None
+        self.collision = collision
+        # Spectators' Broadcast, once somebody watched, see spectators.py
+        self.broadcast = None
+        # Records the match when the server runs with --record, see recording.py
+        self.recorder = recording.open_recorder(game_id, tick_rate, collision)
+        metrics.games_active.inc()
+        # Where countdowns and the rematch window are scheduled: the Scheduler
+        # of the threaded engine, or the event loop with the asyncio engine
+        self.timers = timers
+        self.rematch_timer = None
+        # Numbers countdowns, so a superseded one stops at its next step
+        self.countdown_run = 0
+        # Set while the game logic sleeps, see park()
+        self.wake = None
+        # Counts publish() calls, and callbacks due at the next one, see watch()
+        self.version = 0
+        self.watchers = []
+    
+    def publish(self):
+        """
+        Swaps in a view of the current state, and wakes the game logic up if
+        the ball was just served or the game ended. Caller holds the lock.
+        """
+        self.published = self.state.view()
+        self.version += 1
+        if self.wake is not None and not self.idle():
+            wake, self.wake = self.wake, None
+            wake()
+        if self.watchers:
+            watchers, self.watchers = self.watchers, []
+            for wake in watchers:
+                wake()
+    
+    def idle(self) -> bool:
+        """Whether the game is active with the ball not in play. Caller holds the lock"""
+        state = self.state
+        return state.active and (state.countdown > 0 or state.winner_id is not None)
+    
+    def park(self, wake) -> bool:
+        """
+        Lets the game logic sleep while nothing moves (waiting for an opponent,
+        countdown, winner screen): `wake` is called once the ball is served or
+        the game ends. Returns False, without registering it, if it already is.
+        """
         with self.lock:
-            return self.state.copy()
+            if not self.idle():
+                return False
+            self.wake = wake
+            return True
     
-    def update_connected_players(self, delta: int):
-        """Updates the number of securely connected players"""
+    def watch(self, wake, version: int) -> bool:
+        """
+        Lets a snapshot sender sleep while the game is idle: `wake` is called
+        at the next publish(). Returns False, without registering it, if the
+        game is not idle or was published since `version`.
+        """
         with self.lock:
-            self.state["connected_players"] += delta
+            if version != self.version or not self.idle():
+                return False
+            self.watchers.append(wake)
+            return True
+    
+    def skip_ticks(self, ticks: int):
+        """Counts the ticks that passed while the game logic was parked"""
+        with self.lock:
+            self.state.tick += ticks
+            self.publish()
+    
+    def get_state(self) -> StateView:
+        """Latest published state. Immutable, so it needs neither lock nor copy"""
+        physics, slot = self.physics, self.physics_slot
+        if physics is None or slot is None:
+            return self.published
+        return physics.view(self.published, slot)
+    
+    def snapshot(self, acked_seq: int):
+        """
+        Returns (seq, tick, fields, base_fields) where seq/fields is the latest
+        snapshot, numbered anew only if the state changed, tick the current
+        simulation tick and base_fields the acknowledged snapshot to delta
+        against, or None for a keyframe.
+        """
+        state = self.get_state()
+        fields = protocol.snapshot_fields(state)
+        with self.snapshot_lock:
+            if not self.snapshots or self.snapshots[-1][1] != fields:
+                seq = protocol.next_seq(self.snapshots[-1][0]) if self.snapshots else 1
+                self.snapshots.append((seq, fields))
+            seq, fields = self.snapshots[-1]
+            
+            base_fields = None
+            if acked_seq != protocol.NO_SNAPSHOT:
+                offset = protocol.seq_offset(seq, acked_seq)
+                if offset < len(self.snapshots):
+                    base_seq, base_fields = self.snapshots[-1 - offset]
+                    if base_seq != acked_seq:
+                        base_fields = None
+        return seq, state.tick, fields, base_fields
+    
+    def push_physics(self, ball: bool = False) -> int:
+        """
+        Hands state changes over to batch physics, if attached. Returns the
+        ball step they take effect after, for the recorder. Caller holds the lock
+        """
+        if self.physics:
+            return self.physics.load(self, ball)
+        return self.state.steps
+    
+    def update_connected_players(self, delta: int) -> int:
+        """Updates the number of securely connected players, returns the new count"""
+        with self.lock:
+            self.state.connected_players += delta
+            self.publish()
+            return self.state.connected_players
     
     def set_player_name(self, player_id: int, name: str):
         """Set a player's name securely"""
         with self.lock:
-            self.state["player_names"][player_id] = name
+            self.state.player_names[player_id] = name
+            if self.recorder:
+                self.recorder.name(self.push_physics(), player_id, name)
+            self.publish()
+    
+    def claim_start(self) -> bool:
+        """
+        Marks the game started once both players are connected. Returns True
+        for the one caller that should run the countdown.
+        """
+        with self.lock:
+            if self.state.connected_players == 2 and not self.state.game_started:
+                self.state.game_started = True
+                self.publish()
+                return True
+            return False
+    
+    def suspend_player(self):
+        """
+        A player dropped and may resume: the ball stops where it is until
+        they are back, then a new countdown serves it again
+        """
+        with self.lock:
+            state = self.state
+            state.connected_players -= 1
+            if state.game_started and state.winner_id is None:
+                state.countdown = COUNTDOWN
+                self.countdown_run += 1
+                step = self.push_physics()
+                if self.recorder:
+                    self.recorder.countdown(step, COUNTDOWN)
+            self.publish()
+    
+    def resume_player(self) -> bool:
+        """A dropped player is back. Returns True if the countdown should start again"""
+        with self.lock:
+            state = self.state
+            state.connected_players += 1
+            self.publish()
+            return state.connected_players == 2 and state.game_started and state.winner_id is None and state.countdown > 0
+    
+    def set_game_started(self):
+        with self.lock:
+            self.state.game_started = True
+            self.publish()
+    
+    def move_paddle(self, player_id: int, direction: int):
+        """Moves a player's racket one step left (-1) or right (1), keeping it inside the screen"""
+        with self.lock:
+            paddle = self.state.paddles[player_id]
+            paddle.x = move_racket(paddle.x, direction)
+            step = self.push_physics()
+            if self.recorder:
+                self.recorder.move(step, player_id, direction)
+            self.publish()
     
-    def update_paddle(self, player_id: int, paddle_rect):
-        """Updates a player's racket position"""
+    def decrement_countdown(self, run: int):
+        """
+        Counts down one second before the ball is served, returns the seconds
+        left, or None if the game ended or countdown `run` was superseded
+        """
         with self.lock:
-            self.state["paddles"][player_id] = paddle_rect
+            if run != self.countdown_run or not self.state.active or self.state.countdown <= 0:
+                return None
+            self.state.countdown -= 1
+            step = self.push_physics()
+            if self.recorder:
+                self.recorder.countdown(step, self.state.countdown)
+            self.publish()
+            return self.state.countdown
     
     def increment_play_again_votes(self):
         """Add a vote to play again"""
         with self.lock:
-            self.state["play_again_votes"] += 1
-            return self.state["play_again_votes"]
+            self.state.play_again_votes += 1
+            self.publish()
+            return self.state.play_again_votes
+    
+    def open_rematch_window(self):
+        """
+        Closes the game unless a rematch starts within REMATCH_WINDOW, right
+        away while the server drains (see handoff.py). Caller holds the lock
+        """
+        window = 0 if handoff.draining else REMATCH_WINDOW
+        self.rematch_timer = self.timers.call_later(window, self.close_rematch_window)
+    
+    def close_rematch_window(self):
+        with self.lock:
+            if not self.state.active or self.state.winner_id is None:
+                return
+            print(f"Game {self.game_id}: no rematch, closing")
+            self.end()
     
     def reset_game(self):
         """Restart the game for a new start"""
         with self.lock:
-            self.state["paddles"] = [
-                pygame.Rect(WIDTH/2 - PADDLE_WIDTH/2, HEIGHT - 20 - PADDLE_HEIGHT, PADDLE_WIDTH, PADDLE_HEIGHT),
-                pygame.Rect(WIDTH/2 - PADDLE_WIDTH/2, 20, PADDLE_WIDTH, PADDLE_HEIGHT)
-            ]
-            self.state["ball"] = pygame.Rect(WIDTH/2 - BALL_RADIUS, HEIGHT/2 - BALL_RADIUS, BALL_RADIUS * 2, BALL_RADIUS * 2)
-            self.state["winner_id"] = None
-            self.state["game_started"] = False
-            self.state["countdown"] = 3
-            self.state["ball_speed"] = [BALL_SPEED_X_INITIAL, BALL_SPEED_Y_INITIAL]
-            self.state["play_again_votes"] = 0
+            if self.rematch_timer:
+                self.rematch_timer.cancel()
+                self.rematch_timer = None
+            self.state.reset()
+            step = self.push_physics(ball=True)
+            if self.recorder:
+                self.recorder.reset(step)
+            self.publish()
     
     def set_player_left(self):
         """Marks that a player has left the match"""
         with self.lock:
-            self.state["player_leaved"] = True
+            self.state.player_leaved = True
+            self.publish()
     
     def deactivate(self):
         """Disables the game (ends the match)"""
         with self.lock:
-            self.state["active"] = False
+            self.end()
+    
+    def end(self):
+        """Body of deactivate(). Caller holds the lock"""
+        if self.state.active:
+            metrics.games_active.dec()
+        self.state.active = False
+        if self.rematch_timer:
+            self.rematch_timer.cancel()
+            self.rematch_timer = None
+        if self.physics:
+            self.physics.remove(self)
+        if self.recorder:
+            self.recorder.end(self.state.steps)
+            self.recorder = None
+        self.publish()
 
-def countdown_thread(game: Game):
+def start_countdown(game: Game):
     """
-    Countdown before the game starts
+    Countdown before the game starts, one timer per second on game.timers
+    rather than a sleeping thread. Replaces any countdown still running.
     """
     print(f"Starting countdown for game {game.game_id}")
+    with game.lock:
+        game.countdown_run += 1
+        run = game.countdown_run
+    game.timers.call_later(1, countdown_step, game, run)
+
+def countdown_step(game: Game, run: int):
+    countdown = game.decrement_countdown(run)
+    if countdown is None:
+        # Game closed, or countdown paused or restarted meanwhile
+        return
+    print(f"Game {game.game_id}: Countdown = {countdown+1}")
+    if countdown > 0:
+        game.timers.call_later(1, countdown_step, game, run)
+        return
+    game.set_game_started()
     
-    while True:
-        with game.lock:
-            is_active = game.state["active"]
-            current_countdown = game.state["countdown"]
-        if not is_active:
-            break
-        if current_countdown > 0:
-            time.sleep(1)
-            with game.lock:
-                game.state["countdown"] -= 1
-                print(f"Game {game.game_id}: Countdown = {game.state['countdown']+1}")
+    print(f"Countdown for game {game.game_id} has ended")
+
+def move_racket(x: int, direction: int) -> int:
+    """Racket position after one step left (-1) or right (1), kept inside the screen"""
+    return max(0, min(x + direction * PADDLE_SPEED, WIDTH - PADDLE_WIDTH))
+
+def advance_ball(ball_pos, ball_speed, paddles, frames: float):
+    """
+    Advances the ball by one tick covering `frames` base frames, bouncing it
+    off the side walls and the rackets (geometry.Rects). Returns (ball_pos,
+    ball_speed, winner ID or None). Pure, replay.py runs recorded matches
+    through it.
+    """
+    ball_x, ball_y = ball_pos
+    ball_speed_x, ball_speed_y = ball_speed
+    ball_size = BALL_RADIUS * 2
+    
+    # Increase speed gradually
+    if abs(ball_speed_y) < MAX_SPEED:
+        new_speed_y = abs(ball_speed_y) + SPEED_INCREASE_PER_FRAME * frames
+        ball_speed_y = math.copysign(new_speed_y, ball_speed_y)
+    
+    if abs(ball_speed_x) < MAX_SPEED:
+        new_speed_x = abs(ball_speed_x) + SPEED_INCREASE_PER_FRAME * frames
+        ball_speed_x = math.copysign(new_speed_x, ball_speed_x)
+    
+    # Calculates new ball position
+    new_ball_x = ball_x + ball_speed_x * frames
+    new_ball_y = ball_y + ball_speed_y * frames
+    
+    # Collisions with side walls
+    if new_ball_x <= 0 or new_ball_x >= WIDTH - ball_size:
+        ball_speed_x *= -1
+        new_ball_x = ball_x + ball_speed_x * frames  # Recalcula posição
+    
+    # Creates temporary rect for collision testing
+    temp_ball = Rect(new_ball_x, new_ball_y, ball_size, ball_size)
+    
+    # Collisions with rackets
+    if (temp_ball.colliderect(paddles[0]) and ball_speed_y > 0):
+        ball_speed_y = -abs(ball_speed_y)
+        new_ball_y = ball_y + ball_speed_y * frames
+    elif (temp_ball.colliderect(paddles[1]) and ball_speed_y < 0):
+        ball_speed_y = abs(ball_speed_y)
+        new_ball_y = ball_y + ball_speed_y * frames
+    
+    # Check victory conditions
+    winner_id = None
+    if new_ball_y <= 0:
+        winner_id = 0
+    elif new_ball_y >= HEIGHT - ball_size:
+        winner_id = 1
+    
+    return [new_ball_x, new_ball_y], [ball_speed_x, ball_speed_y], winner_id
+
+def racket_contact(center_x: float, center_y: float, speed_x: float, speed_y: float, paddle, limit: float):
+    """
+    First contact, within `limit` frames, of a ball centred at (center_x,
+    center_y) moving at (speed_x, speed_y) with `paddle` (a Rect), on a
+    side it is moving towards. Returns (frames, normal x, normal y) or None.
+    """
+    left, top = paddle.x, paddle.y
+    right, bottom = left + paddle.width, top + paddle.height
+    
+    # Already touching, e.g. the racket moved onto the ball
+    closest_x = min(max(center_x, left), right)
+    closest_y = min(max(center_y, top), bottom)
+    dx, dy = center_x - closest_x, center_y - closest_y
+    if dx * dx + dy * dy < BALL_RADIUS * BALL_RADIUS:
+        distance = math.hypot(dx, dy)
+        if distance:
+            normal_x, normal_y = dx / distance, dy / distance
         else:
-            with game.lock:
-                game.state["game_started"] = True
+            # Centre inside the racket, push back the way it came
+            normal_x, normal_y = 0.0, -math.copysign(1.0, speed_y)
+        if speed_x * normal_x + speed_y * normal_y < 0:
+            return 0.0, normal_x, normal_y
+        return None
+    
+    # Faces of the racket grown by the ball's radius. The ball is not
+    # touching it yet, so contacts behind it are dropped
+    contacts = []
+    if speed_y > 0:
+        t = (top - BALL_RADIUS - center_y) / speed_y
+        contacts.append((t, 0.0, -1.0, center_x + speed_x * t, left, right))
+    elif speed_y < 0:
+        t = (bottom + BALL_RADIUS - center_y) / speed_y
+        contacts.append((t, 0.0, 1.0, center_x + speed_x * t, left, right))
+    if speed_x > 0:
+        t = (left - BALL_RADIUS - center_x) / speed_x
+        contacts.append((t, -1.0, 0.0, center_y + speed_y * t, top, bottom))
+    elif speed_x < 0:
+        t = (right + BALL_RADIUS - center_x) / speed_x
+        contacts.append((t, 1.0, 0.0, center_y + speed_y * t, top, bottom))
+    best = None
+    for t, normal_x, normal_y, along, start, end in contacts:
+        if 0 <= t <= limit and start <= along <= end and (best is None or t < best[0]):
+            best = (t, normal_x, normal_y)
+    
+    # Corners, rounded by the ball's radius
+    a = speed_x * speed_x + speed_y * speed_y
+    if a == 0:
+        return None
+    for corner_x, corner_y in ((left, top), (right, top), (left, bottom), (right, bottom)):
+        px, py = center_x - corner_x, center_y - corner_y
+        b = px * speed_x + py * speed_y
+        c = px * px + py * py - BALL_RADIUS * BALL_RADIUS
+        discriminant = b * b - a * c
+        if b >= 0 or discriminant < 0:
+            continue
+        t = (-b - math.sqrt(discriminant)) / a
+        if t > limit or (best is not None and t >= best[0]):
+            continue
+        contact_x, contact_y = center_x + speed_x * t, center_y + speed_y * t
+        # Only where no face is, the faces were tested above
+        if left < contact_x < right or top < contact_y < bottom:
+            continue
+        best = (t, (contact_x - corner_x) / BALL_RADIUS, (contact_y - corner_y) / BALL_RADIUS)
+    return best
+
+def advance_ball_swept(ball_pos, ball_speed, paddles, frames: float):
+    """
+    Same as advance_ball(), but the ball is swept along its path: it bounces
+    off the walls and rackets at the exact moment it touches them, however
+    far it moves in one tick, and goes on for the rest of the tick (a wall
+    and then a racket, or the other way round). A ball hitting the flat of a
+    racket leaves it at an angle set by where it hit, up to
+    MAX_BOUNCE_ANGLE off the vertical at the edges; the ends of a racket
+    reflect it. The ball is a circle of BALL_RADIUS.
+    """
+    ball_speed_x, ball_speed_y = ball_speed
+    
+    # Increase speed gradually, as advance_ball() does
+    if abs(ball_speed_y) < MAX_SPEED:
+        new_speed_y = abs(ball_speed_y) + SPEED_INCREASE_PER_FRAME * frames
+        ball_speed_y = math.copysign(new_speed_y, ball_speed_y)
+    
+    if abs(ball_speed_x) < MAX_SPEED:
+        new_speed_x = abs(ball_speed_x) + SPEED_INCREASE_PER_FRAME * frames
+        ball_speed_x = math.copysign(new_speed_x, ball_speed_x)
+    
+    center_x, center_y = ball_pos[0] + BALL_RADIUS, ball_pos[1] + BALL_RADIUS
+    remaining = frames
+    for _ in range(MAX_BOUNCES_PER_TICK):
+        # Earliest contact: (frames, normal x, normal y, racket or None for a wall)
+        hit = None
+        if ball_speed_x < 0:
+            hit = (max(0.0, (BALL_RADIUS - center_x) / ball_speed_x), 1.0, 0.0, None)
+        elif ball_speed_x > 0:
+            hit = (max(0.0, (WIDTH - BALL_RADIUS - center_x) / ball_speed_x), -1.0, 0.0, None)
+        if hit and hit[0] > remaining:
+            hit = None
+        # A racket only sends back a ball coming towards its own goal
+        paddle = paddles[0] if ball_speed_y > 0 else paddles[1]
+        contact = racket_contact(center_x, center_y, ball_speed_x, ball_speed_y, paddle, remaining)
+        if contact and (hit is None or contact[0] < hit[0]):
+            hit = (*contact, paddle)
+        if hit is None:
             break
+        
+        t, normal_x, normal_y, paddle = hit
+        center_x += ball_speed_x * t
+        center_y += ball_speed_y * t
+        remaining -= t
+        if paddle is not None and normal_x == 0:
+            # Flat of the racket: the further from its middle, the wider the angle
+            half = paddle.width / 2
+            offset = max(-1.0, min((center_x - paddle.x - half) / half, 1.0))
+            angle = offset * MAX_BOUNCE_ANGLE
+            speed = math.hypot(ball_speed_x, ball_speed_y)
+            ball_speed_x = speed * math.sin(angle)
+            ball_speed_y = math.copysign(speed * math.cos(angle), normal_y)
+        else:
+            # Wall or end of a racket: mirror the speed on the surface
+            dot = ball_speed_x * normal_x + ball_speed_y * normal_y
+            ball_speed_x -= 2 * dot * normal_x
+            ball_speed_y -= 2 * dot * normal_y
+    else:
+        # Wedged between a racket and a wall, it stays put for this tick
+        remaining = 0
+    center_x += ball_speed_x * remaining
+    center_y += ball_speed_y * remaining
+    new_ball_x, new_ball_y = center_x - BALL_RADIUS, center_y - BALL_RADIUS
     
-    print(f"Countdown for game {game.game_id} has ended")
+    # Check victory conditions
+    winner_id = None
+    if new_ball_y <= 0:
+        winner_id = 0
+    elif new_ball_y >= HEIGHT - BALL_RADIUS * 2:
+        winner_id = 1
+    
+    return [new_ball_x, new_ball_y], [ball_speed_x, ball_speed_y], winner_id
+
+# Ball physics of each collision detection
+ADVANCE_BALL = {"discrete": advance_ball, "swept": advance_ball_swept}
+
+def update_game(game: Game, dt: float = 1/BASE_TICK_RATE) -> bool:
+    """
+    Advance the ball by one tick of `dt` seconds and check who won.
+    Returns False once the game is no longer active.
+    """
+    with game.lock:
+        state = game.state
+        state.tick += 1
+        in_play = state.active and state.countdown <= 0 and state.winner_id is None
+        if not in_play:
+            game.publish()
+            return state.active
+        state.steps += 1
+        
+        # Captures the current state, the lock is not held while computing
+        step = state.steps
+        ball_pos = state.ball_pos
+        ball_speed = state.ball_speed
+        current_paddles = [paddle.copy() for paddle in state.paddles]
+        connected_players = state.connected_players
+    
+    # Fraction of a base frame this tick covers
+    advance = ADVANCE_BALL[game.collision]
+    ball_pos, ball_speed, new_winner_id = advance(ball_pos, ball_speed, current_paddles, dt * BASE_TICK_RATE)
+    
+    with game.lock:
+        state.ball_pos = ball_pos
+        state.ball.x, state.ball.y = ball_pos
+        state.ball_speed = ball_speed
+        
+        if new_winner_id is not None:
+            state.winner_id = new_winner_id
+            if game.recorder:
+                game.recorder.win(step, new_winner_id)
+            game.open_rematch_window()
+            if connected_players == 2:
+                print(f'Game {game.game_id}: Player {new_winner_id+1} won!')
+                ratings.record(state.player_names, new_winner_id)
+        game.publish()
+    
+    return True
+
+def timed_update(game: Game, dt: float) -> bool:
+    """update_game(), timed for the metrics one call out of metrics.SAMPLE_EVERY"""
+    if not metrics.game_tick_sampler.sample():
+        return update_game(game, dt)
+    start = time.perf_counter()
+    running = update_game(game, dt)
+    metrics.game_tick_seconds.observe(time.perf_counter() - start)
+    return running
+
+class FixedTimestep:
+    """
+    Accumulator that turns elapsed wall-clock time into a whole number of
+    fixed-length simulation ticks, so the simulation rate does not drift
+    with the time each tick takes or how late the loop wakes up.
+    """
+    def __init__(self, tick_rate: int):
+        self.dt = 1 / tick_rate
+        self.accumulator = 0.0
+        self.last_time = time.perf_counter()
+    
+    def advance(self) -> int:
+        """Returns how many ticks are due since the last call"""
+        now = time.perf_counter()
+        self.accumulator += now - self.last_time
+        self.last_time = now
+        
+        ticks = int(self.accumulator / self.dt)
+        self.accumulator -= ticks * self.dt
+        if ticks > 1:
+            metrics.tick_overruns.inc(ticks - 1)
+        # After a long stall, drop the backlog instead of fast-forwarding the match
+        if ticks > MAX_CATCH_UP_TICKS:
+            metrics.ticks_dropped.inc(ticks - MAX_CATCH_UP_TICKS)
+            ticks = MAX_CATCH_UP_TICKS
+        return ticks
+    
+    def skip(self) -> int:
+        """Consumes every tick due since the last call, for a loop that was parked"""
+        now = time.perf_counter()
+        self.accumulator += now - self.last_time
+        self.last_time = now
+        
+        ticks = int(self.accumulator / self.dt)
+        self.accumulator -= ticks * self.dt
+        return ticks
+    
+    def time_to_next_tick(self) -> float:
+        return max(0.0, self.dt - self.accumulator - (time.perf_counter() - self.last_time))
 
 def game_logic_thread(game: Game):
     """
-    Control the movement of the ball and check who won.    
+    Control the movement of the ball and check who won, at a fixed tick rate.
+    Sleeps without ticking whenever the ball is not in play.
     """
     print(f"Starting game {game.game_id} logic")
 
+    timestep = FixedTimestep(game.tick_rate)
+    running = True
+    while running:
+        wake = threading.Event()
+        if game.park(wake.set):
+            wake.wait()
+            game.skip_ticks(timestep.skip())
+        for _ in range(timestep.advance()):
+            running = timed_update(game, timestep.dt)
+            if not running:
+                break
+        time.sleep(timestep.time_to_next_tick())
+    print(f"Closing game {game.game_id} logic")
+
+def batch_logic_thread(physics):
+    """
+    Steps every game attached to a batch_physics.BatchPhysics, replacing the
+    per-game logic threads. Sleeps without ticking while no ball is in play.
+    """
+    print("Starting batch physics")
+    
+    timestep = FixedTimestep(physics.tick_rate)
     while True:
-        with game.lock:
-            is_active = game.state["active"]
-            countdown = game.state["countdown"]
-            winner_id = game.state["winner_id"]
-        
-        if not is_active:
-            break
+        wake = threading.Event()
+        if physics.park(wake.set):
+            wake.wait()
+            physics.skip_ticks(timestep.skip())
+        for _ in range(timestep.advance()):
+            physics.step(timestep.dt)
+        time.sleep(timestep.time_to_next_tick())
 
-        if countdown <= 0 and winner_id is None:
-            
-            # Captures snapshot of the current state with minimal locking
-            with game.lock:
-                current_ball = game.state["ball"].copy()
-                current_speed = game.state["ball_speed"].copy()
-                current_paddles = [paddle.copy() for paddle in game.state["paddles"]]
-                connected_players = game.state["connected_players"]
-            
-            ball_speed_x, ball_speed_y = current_speed
-            
-            # Increase speed gradually
-            if abs(ball_speed_y) < MAX_SPEED:
-                new_speed_y = abs(ball_speed_y) + SPEED_INCREASE_PER_FRAME
-                ball_speed_y = math.copysign(new_speed_y, ball_speed_y)
-            
-            if abs(ball_speed_x) < MAX_SPEED:
-                new_speed_x = abs(ball_speed_x) + SPEED_INCREASE_PER_FRAME
-                ball_speed_x = math.copysign(new_speed_x, ball_speed_x)
-            
-            # Calculates new ball position
-            new_ball_x = current_ball.x + ball_speed_x
-            new_ball_y = current_ball.y + ball_speed_y
-            
-            # Collisions with side walls
-            if new_ball_x <= 0 or new_ball_x >= WIDTH - current_ball.width:
-                ball_speed_x *= -1
-                new_ball_x = current_ball.x + ball_speed_x  # Recalcula posição
-            
-            # Creates temporary rect for collision testing
-            temp_ball = pygame.Rect(new_ball_x, new_ball_y, current_ball.width, current_ball.height)
-            
-            # Collisions with rackets
-            if (temp_ball.colliderect(current_paddles[0]) and ball_speed_y > 0):
-                ball_speed_y = -abs(ball_speed_y)
-                new_ball_y = current_ball.y + ball_speed_y
-            elif (temp_ball.colliderect(current_paddles[1]) and ball_speed_y < 0):
-                ball_speed_y = abs(ball_speed_y)
-                new_ball_y = current_ball.y + ball_speed_y
-            
-            # Check victory conditions
-            new_winner_id = None
-            if new_ball_y <= 0:
-                new_winner_id = 0
-            elif new_ball_y >= HEIGHT - current_ball.height:
-                new_winner_id = 1
+def start_game_logic(game: Game, physics=None):
+    """Starts the game logic (ball movement, physics) of a new game"""
+    if physics:
+        physics.add(game)
+    else:
+        game_logic = threading.Thread(target=game_logic_thread, args=(game,))
+        game_logic.start()
+
+def check_hello(msg_type: int, payload: bytes):
+    """Validates the first message of a connection"""
+    if msg_type != protocol.MSG_HELLO:
+        raise protocol.ProtocolError("Expected HELLO")
+    version = protocol.unpack_hello(payload)
+    if version != protocol.PROTOCOL_VERSION:
+        raise protocol.ProtocolError(f"Unsupported protocol version {version}")
+
+def read_join(msg_type: int, payload: bytes):
+    """Extracts (player name, room code) from a request to be matched"""
+    if msg_type != protocol.MSG_JOIN:
+        raise protocol.ProtocolError("Expected JOIN")
+    return protocol.unpack_join(payload)
+
+class Player:
+    """
+    Per-connection state of a player: its game, the last snapshot its
+    client acknowledged, the last input applied, how often snapshots are
+    sent to it and, once it used the UDP channel, its datagram address.
+    A connection may play several games in a row, see join(). Its limits
+    (see backpressure.py) and link measurements (see qos.py) are per
+    connection.
+    """
+    def __init__(self, send_rate: int = SEND_RATE):
+        self.game = None
+        self.player_id = None
+        self.acked_seq = protocol.NO_SNAPSHOT
+        self.input_seq = protocol.NO_INPUT
+        self.send_interval = 1 / send_rate
+        self.link = qos.Link(send_rate)
+        self.connected = False
+        self.udp_token = 0
+        self.udp_addr = None
+        # Traffic counters, exported per client by metrics.py
+        self.bytes_sent = 0
+        self.frames_sent = 0
+        self.bytes_received = 0
+        self.frames_received = 0
+        # What the last frame sent was encoded from
+        self.last_sent = None
+        # Wakes the snapshot sender while it waits on an idle game
+        self.sender_wake = None
+        # Closes the connection, when another one resumes its session or it is evicted
+        self.hangup = None
+        self.limiter = backpressure.RateLimiter()
+        self.last_heard = time.monotonic()
+        # Since when the client is too far behind to be sent snapshots, None if it is not
+        self.behind_since = None
+        # Held while a frame is written, so a handoff never cuts one in two
+        self.send_lock = threading.Lock()
+    
+    def join(self, game: Game, player_id: int, input_seq: int = protocol.NO_INPUT):
+        """
+        Starts playing in `game`, with the state of the previous one (if any)
+        dropped. `input_seq` is the last input applied, if any already was
+        """
+        self.game = game
+        self.player_id = player_id
+        self.acked_seq = protocol.NO_SNAPSHOT
+        self.input_seq = input_seq
+        self.last_sent = None
+        self.sender_wake = None
+        self.last_heard = time.monotonic()
+        self.behind_since = None
+        self.connected = True
+    
+    def backlogged(self, unsent: int) -> bool:
+        """
+        Whether the client has more than backpressure.SEND_BACKLOG bytes
+        still unsent, `unsent`, so the snapshot due is skipped
+        """
+        if unsent <= backpressure.SEND_BACKLOG:
+            self.behind_since = None
+            return False
+        if self.behind_since is None:
+            self.behind_since = time.monotonic()
+        metrics.snapshots_skipped.inc()
+        return True
+    
+    def stalled(self) -> bool:
+        """Whether the client has been backlogged for longer than the write timeout"""
+        return (self.behind_since is not None and backpressure.write_timeout
+                and time.monotonic() - self.behind_since > backpressure.write_timeout)
+    
+    def ping(self, unsent: int) -> bytes:
+        """
+        PING to send now, given the bytes still `unsent`, with the send rate
+        adapted to the link first (see qos.py)
+        """
+        frame = self.link.ping(self.bytes_sent, unsent)
+        self.send_interval = 1 / self.link.send_rate
+        self.bytes_sent += len(frame)
+        self.frames_sent += 1
+        return frame
+    
+    def encode_snapshot(self, repeat: bool = True) -> bytes:
+        """
+        Encodes the latest snapshot as a delta against the last acknowledged
+        one. Every snapshot encoded is sent, so it is counted here. With
+        repeat=False, returns None instead of a copy of the previous frame:
+        over TCP nothing needs resending while a game is parked.
+        """
+        if not repeat:
+            sent = (self.game.get_state(), self.acked_seq, self.input_seq)
+            if sent == self.last_sent:
+                return None
+            self.last_sent = sent
+        sampled = metrics.serialize_sampler.sample()
+        if sampled:
+            start = time.perf_counter()
+        seq, tick, fields, base_fields = self.game.snapshot(self.acked_seq)
+        frame = protocol.pack_snapshot(seq, tick, self.input_seq, fields, self.acked_seq, base_fields)
+        if sampled:
+            metrics.serialize_seconds.observe(time.perf_counter() - start)
+        self.bytes_sent += len(frame)
+        self.frames_sent += 1
+        return frame
+    
+    def handle_message(self, msg_type: int, payload: bytes) -> bool:
+        """
+        Applies a message received from the client to its game.
+        Returns True when the message completes the votes for a rematch.
+        """
+        game = self.game
+        self.last_heard = time.monotonic()
+        self.bytes_received += protocol.HEADER.size + len(payload)
+        self.frames_received += 1
+        if msg_type == protocol.MSG_INPUT:
+            input_seq, direction, acked_seq = protocol.unpack_input(payload)
+            self.apply_input(input_seq, direction)
+            self.acknowledge(acked_seq)
+        elif msg_type == protocol.MSG_INPUTS:
+            inputs, acked_seq = protocol.unpack_inputs(payload)
+            for input_seq, direction in inputs:
+                self.apply_input(input_seq, direction)
+            self.acknowledge(acked_seq)
+        elif msg_type == protocol.MSG_PONG:
+            self.link.pong(protocol.unpack_pong(payload))
+        elif msg_type == protocol.MSG_PLAY_AGAIN:
+            votes = game.increment_play_again_votes()
+            print(f"Voto para reiniciar jogo {game.game_id}: {votes}/2")
             
-            with game.lock:
-                game.state["ball"].x = new_ball_x
-                game.state["ball"].y = new_ball_y
-                game.state["ball_speed"] = [ball_speed_x, ball_speed_y]
-                
-                if new_winner_id is not None:
-                    game.state["winner_id"] = new_winner_id
-                    if connected_players == 2:
-                        print(f'Game {game.game_id}: Player {new_winner_id+1} won!')
+            # If both voted, restart the game
+            if votes >= 2:
+                print(f"Restarting game {game.game_id}")
+                game.reset_game()
+                return True
+        return False
+    
+    def apply_input(self, input_seq: int, direction: int):
+        """Applies an input as soon as it arrives, each one exactly once"""
+        if protocol.seq_newer(input_seq, self.input_seq) or self.input_seq == protocol.NO_INPUT:
+            self.input_seq = input_seq
+            if direction:
+                self.game.move_paddle(self.player_id, direction)
+    
+    def acknowledge(self, acked_seq: int):
+        # Datagrams may arrive out of order, never move the ack backwards
+        if self.acked_seq == protocol.NO_SNAPSHOT or protocol.seq_newer(acked_seq, self.acked_seq):
+            self.acked_seq = acked_seq
+
+class UdpChannel:
+    """
+    Optional datagram channel on the same port as the TCP listener. Carries
+    inputs from clients and snapshots to them, so a lost packet does not
+    hold back everything sent after it. Players are identified by the token
+    they received in WELCOME.
+    """
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+        # Engines may swap this for their own non-blocking send
+        self.sendto = sock.sendto
+        self.players = {}
+        self.lock = threading.Lock()
+    
+    def register(self, player: Player, token: int = 0) -> int:
+        """Issues a token for the player's datagrams, or keeps the one given (handed over, see handoff.py)"""
+        with self.lock:
+            while token == 0 or token in self.players:
+                token = secrets.randbits(32)
+            self.players[token] = player
+        player.udp_token = token
+        return token
+    
+    def unregister(self, player: Player):
+        with self.lock:
+            self.players.pop(player.udp_token, None)
+    
+    def handle_datagram(self, data: bytes, addr):
+        try:
+            token, msg_type, payload = protocol.unpack_datagram(data)
+        except protocol.ProtocolError:
+            return
+        player = self.players.get(token)
+        # Only inputs may travel over UDP, session control stays on TCP
+        if player is None or player.game is None or msg_type not in (protocol.MSG_INPUT, protocol.MSG_INPUTS):
+            return
+        if not player.limiter.allow():
+            metrics.messages_throttled.inc()
+            return
+        try:
+            player.handle_message(msg_type, payload)
+        except protocol.ProtocolError:
+            return
+        # Follow the client if its address changes (NAT rebinding)
+        player.udp_addr = addr
+    
+    def send(self, player: Player, frame: bytes):
+        try:
+            self.sendto(frame, player.udp_addr)
+        except OSError:
+            pass
+
+def udp_receiver_thread(udp: UdpChannel):
+    """Reads datagrams for the threaded engine"""
+    while True:
+        try:
+            data, addr = udp.sock.recvfrom(2048)
+        except OSError:
+            break
+        udp.handle_datagram(data, addr)
+
+def snapshot_sender_thread(conn: socket.socket, player: Player, udp: UdpChannel = None):
+    """
+    Pushes snapshots to a client at its send rate, independently of what
+    (and how fast) the client sends. Once the game was closed, sends the
+    final state and hangs up, which also ends the client's reader.
+    """
+    game = player.game
+    next_send = time.perf_counter()
+    while player.connected:
+        try:
+            # Read first, so the frame sent is at least as new
+            ended = not game.get_state().active
+            if player.link.due():
+                with player.send_lock:
+                    conn.sendall(player.ping(backpressure.unsent_bytes(conn)))
+            if player.udp_addr is not None:
+                udp.send(player, player.encode_snapshot())
+            elif player.backlogged(backpressure.unsent_bytes(conn)):
+                # Skipped, the next one sent is the newest
+                if player.stalled():
+                    evict(player, game, "too far behind")
+                    break
+            else:
+                version = game.version
+                frame = player.encode_snapshot(repeat=False)
+                if frame:
+                    with player.send_lock:
+                        conn.sendall(frame)
+                elif not ended:
+                    # Nothing changed: sleep until the game does, if it is idle
+                    player.sender_wake = threading.Event()
+                    if game.watch(player.sender_wake.set, version) and player.connected:
+                        player.sender_wake.wait()
+                        next_send = time.perf_counter()
+                        continue
+            if ended:
+                conn.shutdown(socket.SHUT_RDWR)
+                break
+        except BlockingIOError:
+            # A send blocked past the write timeout, part of a frame may be sent
+            evict(player, game, "send timed out")
+            break
+        except OSError:
+            break
         
-        time.sleep(1/60)
-    print(f"Closing game {game.game_id} logic")
+        next_send += player.send_interval
+        delay = next_send - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        else:
+            # Fell behind, skip the missed sends instead of bursting them
+            next_send = time.perf_counter()
 
-def client_thread(conn: socket.socket, game: Game, player_id: int):
+def broadcast_thread(broadcast, send_interval: float):
     """
-    Thread that handles communication with a specific client.
+    Publishes a game's snapshots to its spectators at the send rate, sleeping
+    while the game is idle, until the game closes or nobody watches.
     """
+    game = broadcast.game
+    next_send = time.perf_counter()
+    while True:
+        version = game.version
+        published = broadcast.publish()
+        if broadcast.finished():
+            break
+        if not published:
+            # Nothing changed: sleep until the game does or a spectator joins, if it is idle
+            wake = threading.Event()
+            if broadcast.park(wake.set, version):
+                wake.wait()
+                next_send = time.perf_counter()
+                continue
+        
+        next_send += send_interval
+        delay = next_send - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        else:
+            next_send = time.perf_counter()
+
+def spectator_sender_thread(conn: socket.socket, spectator: Spectator, wake: threading.Event):
+    """Writes the frames queued for a spectator as they come, hangs up once the game closed"""
     try:
+        while True:
+            wake.wait()
+            wake.clear()
+            closed = spectator.closed
+            frames = spectator.take()
+            if frames:
+                conn.sendall(b"".join(frames))
+            if closed:
+                conn.shutdown(socket.SHUT_RDWR)
+                break
+    except OSError:
+        # Gone, or a send blocked past the write timeout: the reader sees it drop
+        shutdown(conn)
+
+def spectate(conn: socket.socket, reader: protocol.FrameReader, stands: Stands, room: str,
+             send_rate: int = SEND_RATE):
+    """
+    Streams the match of `room` (or the most watched one) to a spectator
+    until the game closes or the spectator leaves. Answers NO_MATCH if
+    there is nothing to watch.
+    """
+    backpressure.set_write_timeout(conn)
+    wake = threading.Event()
+    spectator = Spectator(wake.set)
+    game = stands.find(room)
+    broadcast, start = stands.watch(game, spectator) if game else (None, False)
+    if broadcast is None:
+        conn.sendall(protocol.pack_no_match())
+        return
+    print(f"Spectator watching game {game.game_id}")
+    conn.sendall(protocol.pack_spectating())
+    sender = threading.Thread(target=spectator_sender_thread, args=(conn, spectator, wake))
+    sender.start()
+    if start:
+        threading.Thread(target=broadcast_thread, args=(broadcast, 1 / send_rate), daemon=True).start()
+    
+    # A spectator only ever says it leaves
+    try:
+        while not spectator.closed:
+            msg_type, _ = reader.read_frame()
+            if msg_type == protocol.MSG_LEAVE:
+                break
+    except (ConnectionError, OSError, protocol.ProtocolError):
+        pass
+    broadcast.remove(spectator)
+    spectator.close()
+    shutdown(conn)
+    sender.join()
+    print(f"Spectator left game {game.game_id}")
+
+def evict(player: Player, game: Game, reason: str):
+    """
+    Hangs up on a player that fell behind or went silent, if still in
+    `game`. Its reader sees the connection drop, so the session is kept.
+    """
+    if player.game is not game or not player.connected:
+        return
+    print(f"Evicting player {player.player_id+1} of game {game.game_id}: {reason}")
+    metrics.clients_evicted.inc()
+    player.hangup()
+
+def shutdown(conn: socket.socket):
+    """Hangs up a connection, waking whatever blocks on it"""
+    try:
+        conn.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+def play_match(conn: socket.socket, reader: protocol.FrameReader, player: Player, session: Session,
+               lobby, sessions: Sessions, udp: UdpChannel = None, resumed: bool = False,
+               taken_over: bool = False, handed_over: bool = False):
+    """
+    Plays one match of a connected client: reads the client's messages as
+    they arrive while a sender thread streams snapshots. `lobby` is told
+    when the player leaves (lobby.cancel), in case its game was still
+    waiting for an opponent. If the connection drops mid-match, the session
+    is suspended for the client to resume instead. `resumed` plays on in a
+    session taken back with RESUME, `taken_over` if from a live connection
+    (the client gave up on it before the server noticed), `handed_over` in
+    a match the previous server process handed over mid-stream (see
+    handoff.py), unbeknownst to the client. Returns the (name, room
+    code) the client asked to be matched with next, or None once it is gone.
+    """
+    game, player_id, player_name = session.game, session.player_id, session.player_name
+    player.join(game, player_id, player.input_seq if handed_over else protocol.NO_INPUT)
+    metrics.add_player(player)
+    backpressure.set_write_timeout(conn)
+    if not handed_over:
+        conn.sendall(protocol.pack_matched(player_id, session.token))
+    
+    if handed_over:
+        print(f"Player {player_id+1} of game {game.game_id} handed over: {player_name}")
+    elif resumed:
+        print(f"Player {player_id+1} of game {game.game_id} resumed: {player_name}")
+        # Still counted in if the session was taken from a live connection
+        if not taken_over and game.resume_player():
+            start_countdown(game)
+    else:
         print(f"Connected client: Game {game.game_id}, Player {player_id+1}")
         
-        # Send player ID
-        conn.send(pickle.dumps(player_id))
-        
-        # Receive player name
-        try:
-            player_name = pickle.loads(conn.recv(2048))
-        except Exception as e:
-            print(f"Erro ao receber nome: {e}")
-            player_name = "So-and-so"
-        
-
         # Save player name
         game.set_player_name(player_id, player_name)
         print(f"Player {player_id+1} of game {game.game_id} defined as: {player_name}")
@@ -218,114 +1164,603 @@ def client_thread(conn: socket.socket, game: Game, player_id: int):
         game.update_connected_players(1)
         
         # If both players are connected, countdown starts
-        with game.lock:
-            if game.state["connected_players"] == 2 and not game.state["game_started"]:
-                countdown_logic = threading.Thread(target=countdown_thread, args=(game,))
-                countdown_logic.start()
-                game.state["game_started"] = True
-        
-        # Client main loop
-        while game.state["active"]:
-            try:
-                # Send curr game state
-                conn.send(pickle.dumps(game.get_state_copy()))
-                
-                data = conn.recv(2048)
-                if not data: # Disconnected client
-                    break
-                
-                received_data = pickle.loads(data)
-                
-                if isinstance(received_data, str) and received_data == "play_again":
-                    votes = game.increment_play_again_votes()
-                    print(f"Voto para reiniciar jogo {game.game_id}: {votes}/2")
-                    
-                    # If both voted, restart the game
-                    if votes >= 2:
-                        print(f"Restarting game {game.game_id}")
-                        game.reset_game()
-                        countdown_logic = threading.Thread(target=countdown_thread, args=(game,))
-                        countdown_logic.start()
-                        
-                elif isinstance(received_data, pygame.Rect):
-                    game.update_paddle(player_id, received_data)
-                
-            except Exception as e:
-                print(f"Error in communication with {player_name}: {e}")
+        if game.claim_start():
+            start_countdown(game)
+    
+    sender = threading.Thread(target=snapshot_sender_thread, args=(conn, player, udp))
+    sender.start()
+    deadline = backpressure.Deadline(player, game.timers, partial(evict, player, game, "silent for too long"))
+    
+    # Client main loop
+    join = None
+    dropped = False
+    while game.get_state().active:
+        if handoff.handing_over:
+            # At a frame boundary, the connection can go to the next server process
+            handoff.current.park(player, conn, reader, session)
+        try:
+            msg_type, payload = reader.read_frame()
+            # Over the rate: wait, and let TCP slow the client down meanwhile
+            delay = player.limiter.take()
+            if delay:
+                metrics.messages_throttled.inc()
+                time.sleep(delay)
+            if msg_type == protocol.MSG_JOIN:
+                # Wants a new opponent
+                join = read_join(msg_type, payload)
                 break
-        
-        print(f"Disconnecting {player_name} from game {game.game_id}")
+            if msg_type == protocol.MSG_LEAVE:
+                break
+            if player.handle_message(msg_type, payload):
+                start_countdown(game)
+            
+        except ConnectionError: # Disconnected client
+            dropped = True
+            break
+        except Exception as e:
+            print(f"Error in communication with {player_name}: {e}")
+            break
+    
+    # Stop the sender, even if it is blocked sending to a stalled client
+    # or waiting on an idle game
+    deadline.cancel()
+    player.connected = False
+    if join is None:
+        shutdown(conn)
+    if player.sender_wake:
+        player.sender_wake.set()
+    sender.join()
+    
+    # Keep the slot of a player who dropped out of a match in play
+    state = game.get_state()
+    if dropped and state.active and state.game_started and not state.player_leaved:
+        if sessions.suspend(session, player, partial(expire_session, lobby)):
+            print(f"{player_name} dropped from game {game.game_id}, slot kept for {sessions.grace}s")
+            return None
+    if not sessions.close(session, player):
+        # Another connection resumed the session, the match is theirs
+        return None
+    leave_match(game, player_name, lobby)
+    return join
+
+def leave_match(game: Game, player_name: str, lobby, connected: bool = True):
+    """A player left for good. `connected` is False if they were already counted out"""
+    print(f"Disconnecting {player_name} from game {game.game_id}")
+    # Nobody may join a game whose only player left
+    lobby.cancel(game)
+    if connected:
         game.update_connected_players(-1)
-        game.set_player_left()
+    game.set_player_left()
+    
+    if game.get_state().connected_players == 0:
+        game.deactivate()
+        print(f"Game {game.game_id} terminated - no players connected")
+
+def expire_session(lobby, session: Session):
+    """The grace period of a dropped player is over"""
+    print(f"{session.player_name} did not come back to game {session.game.game_id}")
+    leave_match(session.game, session.player_name, lobby, connected=False)
+
+def resume_match(conn: socket.socket, reader: protocol.FrameReader, player: Player, token: bytes,
+                 lobby, sessions: Sessions, udp: UdpChannel = None):
+    """
+    Takes a session back for a client that reconnected, then plays on like
+    play_match(). Hangs up on an unknown or expired token.
+    """
+    session, previous = sessions.resume(token, player)
+    if session is None:
+        conn.sendall(protocol.pack_resume_failed())
+        return None
+    if previous and previous.hangup:
+        # The old connection is half-open, or the client gave up on it first
+        previous.hangup()
+    return play_match(conn, reader, player, session, lobby, sessions, udp, resumed=True,
+                      taken_over=previous is not None)
+
+def client_thread(conn: socket.socket, matchmaker: Matchmaker, sessions: Sessions, stands: Stands, new_game,
+                  tick_rate: int = TICK_RATE, send_rate: int = SEND_RATE, udp: UdpChannel = None,
+                  handed_over: handoff.Parked = None):
+    """
+    Thread that handles a client for as long as it stays connected: the
+    handshake, then one match after another for as long as it asks for new
+    opponents, or a match watched as a spectator. new_game() creates a game
+    when there is nobody to join. A connection `handed_over` by the
+    previous server process (see handoff.py) picks up where it was instead.
+    """
+    player_name = "So-and-so"
+    player = handed_over.player if handed_over else Player(send_rate)
+    player.hangup = partial(shutdown, conn)
+    try:
+        if handed_over:
+            if handoff.current:
+                handoff.current.enter(player)
+            reader, join = handed_over.reader, handed_over.join
+            if handed_over.session:
+                join = play_match(conn, reader, player, handed_over.session, matchmaker, sessions, udp,
+                                  handed_over=True)
+        else:
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            reader = protocol.FrameReader(conn)
+            
+            # Check the protocol version and send the server's settings
+            try:
+                check_hello(*reader.read_frame())
+            except protocol.ProtocolError:
+                conn.sendall(protocol.pack_reject())
+                raise
+            udp_token = udp.register(player) if udp else 0
+            conn.sendall(protocol.pack_welcome(tick_rate, udp_token))
+            
+            # Receive player name and room, or the token of a dropped session
+            msg_type, payload = reader.read_frame()
+            if msg_type != protocol.MSG_SPECTATE and handoff.current:
+                handoff.current.enter(player)
+            if msg_type == protocol.MSG_SPECTATE:
+                spectate(conn, reader, stands, protocol.unpack_spectate(payload), send_rate)
+                join = None
+            elif msg_type == protocol.MSG_RESUME:
+                join = resume_match(conn, reader, player, protocol.unpack_resume(payload), matchmaker, sessions, udp)
+            else:
+                try:
+                    join = read_join(msg_type, payload)
+                except Exception as e:
+                    print(f"Erro ao receber nome: {e}")
+                    join = (player_name, "")
         
-        with game.lock:
-            if game.state["connected_players"] == 0:
-                game.deactivate()
-                print(f"Game {game.game_id} terminated - no players connected")
+        while join is not None:
+            if handoff.handing_over:
+                # Between two matches, the next server process matches it
+                handoff.current.park(player, conn, reader, join=join)
+            if handoff.draining:
+                print(f"Not matching {join[0]} again: the server is draining")
+                break
+            player_name, room = join
+            game, player_id = matchmaker.join(new_game, ratings.rating(player_name), room)
+            if player_id == 1:
+                print(f"Adding player to game {game.game_id}")
+            else:
+                stands.open(game, room)
+            session = sessions.issue(game, player_id, player_name, player)
+            join = play_match(conn, reader, player, session, matchmaker, sessions, udp)
+            if join is not None:
+                metrics.matchmaking_requeues.inc()
     except Exception as e:
-        print(f"Error in client thread of {player_name} in game {game.game_id}: {e}")
+        print(f"Error in client thread of {player_name}: {e}")
+    if handoff.current:
+        handoff.current.leave(player)
+    if udp:
+        udp.unregister(player)
+    metrics.remove_player(player)
     
     try:
         conn.close()
     except:
         pass
 
-def main():
+def create_game(tick_rate: int = TICK_RATE, physics=None, collision: str = "discrete") -> Game:
+    """Creates a game for a player nobody is waiting for, with its logic running"""
+    game = Game(str(randint(1000, 9999)), tick_rate, collision)
+    print(f"Creating new game {game.game_id}")
+    
+    # Start the game logic (ball movement, physics)
+    start_game_logic(game, physics)
+    return game
+
+# Fields of a GameState sent as they are when a game is handed over
+HANDED_OVER_FIELDS = ("tick", "steps", "ball_pos", "ball_speed", "winner_id", "game_started", "countdown",
+                      "player_names", "connected_players", "play_again_votes", "player_leaved")
+
+class Inheritance(NamedTuple):
+    """What take_over() got from the previous server process"""
+    listener: socket.socket
+    udp_sock: object            # None without --udp
+    matchmaker: Matchmaker
+    sessions: Sessions
+    stands: Stands
+    games: list
+    connections: list           # handoff.Parked
+
+def freeze(games, physics=None) -> ExitStack:
+    """Stops `games` where they are by holding their locks (and batch physics'), until the result is closed"""
+    frozen = ExitStack()
+    for game in games:
+        frozen.enter_context(game.lock)
+        if game.physics:
+            game.physics.store(game)
+    if physics:
+        frozen.enter_context(physics.lock)
+    return frozen
+
+def describe_game(game: Game, room: str, queued) -> dict:
+    """
+    A frozen game, as handed over: its state, room code and (rating bucket,
+    room code) if waiting for an opponent. Caller holds the lock
+    """
+    state = game.state
+    with game.snapshot_lock:
+        seq = game.snapshots[-1][0] if game.snapshots else protocol.NO_SNAPSHOT
+    recorder = game.recorder
+    if recorder:
+        recorder.flush()
+    fields = {name: getattr(state, name) for name in HANDED_OVER_FIELDS}
+    fields["paddles_x"] = [paddle.x for paddle in state.paddles]
+    return {"kind": "game", "id": game.game_id, "tick_rate": game.tick_rate, "collision": game.collision,
+            "room": room, "queued": queued, "seq": seq, "state": fields,
+            "recording": [recorder.path, recorder.step] if recorder else None}
+
+def restore_game(message: dict) -> Game:
+    """A game described by describe_game(), with its logic not started yet"""
+    game = Game(message["id"], message["tick_rate"], message["collision"])
+    # Recorded in the previous process's file, or not at all
+    game.recorder = recording.continue_recorder(*message["recording"]) if message["recording"] else None
+    state = game.state
+    for name in HANDED_OVER_FIELDS:
+        setattr(state, name, message["state"][name])
+    for paddle, x in zip(state.paddles, message["state"]["paddles_x"]):
+        paddle.x = x
+    state.ball.x, state.ball.y = state.ball_pos
+    # Snapshots go on from the last one sent, the first one is a keyframe
+    if message["seq"] != protocol.NO_SNAPSHOT:
+        game.snapshots.append((message["seq"], None))
+    with game.lock:
+        game.publish()
+    return game
+
+def resume_game(game: Game, physics=None):
+    """Starts the logic and timers of a game handed over, where the previous server process stopped them"""
+    start_game_logic(game, physics)
+    state = game.get_state()
+    if not state.active:
+        return
+    if state.winner_id is not None:
+        with game.lock:
+            game.open_rematch_window()
+    elif state.game_started and state.countdown > 0 and state.connected_players == 2:
+        start_countdown(game)
+    elif game.claim_start():
+        start_countdown(game)
+
+def hand_over(successor: handoff.Handoff, s: socket.socket, udp: UdpChannel, matchmaker: Matchmaker,
+              sessions: Sessions, stands: Stands, physics=None):
+    """
+    Hands every game and player over to the server process that connected
+    to the handoff socket, then exits, see handoff.py. Returns, with
+    everything going on as before, if the successor went away.
+    """
+    print("Handing over to a new server process")
+    parked = successor.wait_parked()
+    # Senders finish the frame they are writing, one stuck for longer is not handed over
+    sending = [entry for entry in parked if entry.player.send_lock.acquire(timeout=handoff.HANDOFF_TIMEOUT)]
+    handed = {entry.session for entry in sending if entry.session}
+    games = [game for game in list(stands.games) if game.get_state().active]
+    frozen = freeze(games, physics)
+    try:
+        channel = successor.channel
+        handoff.send_message(channel, {"kind": "server"}, [s] + ([udp.sock] if udp else []))
+        with stands.lock:
+            rooms = {game: room for room, game in stands.rooms.items()}
+        queued = matchmaker.queued()
+        for game in games:
+            handoff.send_message(channel, describe_game(game, rooms.get(game, ""), queued.get(game)))
+        with sessions.lock:
+            held = [session for session in sessions.sessions.values() if session.game in games]
+        for session in held:
+            status = "suspended" if session.player is None else "playing" if session in handed else "dropped"
+            handoff.send_message(channel, {"kind": "session", "token": session.token.hex(), "game": session.game.game_id,
+                                           "player_id": session.player_id, "name": session.player_name,
+                                           "status": status})
+        for entry in sending:
+            player = entry.player
+            handoff.send_message(channel, {"kind": "connection",
+                                           "token": entry.session.token.hex() if entry.session else None,
+                                           "join": entry.join, "input_seq": player.input_seq,
+                                           "udp_token": player.udp_token, "udp_addr": player.udp_addr,
+                                           "pending": base64.b64encode(entry.reader.pending()).decode()},
+                                 [entry.conn])
+        ratings.close()
+        recording.writer.flush()
+        handoff.send_message(channel, {"kind": "done"})
+    except OSError as e:
+        print(f"Handoff failed, playing on: {e}")
+        frozen.close()
+        for entry in sending:
+            entry.player.send_lock.release()
+        successor.resume()
+        return
+    print(f"Handed over {len(games)} games and {len(sending)} of {len(parked)} players, exiting")
+    sys.stdout.flush()
+    os._exit(0)
+
+def take_over(channel: socket.socket, send_rate: int = SEND_RATE) -> Inheritance:
+    """
+    Takes the games and connections of the server process listening on the
+    other end of `channel` (see handoff.py), once it exited. Their logic is
+    not started yet. Raises ConnectionError if it went away before handing
+    everything over.
+    """
+    listener = udp_sock = None
+    matchmaker, sessions, stands = Matchmaker(), Sessions(), Stands()
+    games, connections = {}, []
+    while True:
+        message, socks = handoff.recv_message(channel)
+        if message is None:
+            raise ConnectionError("the previous server went away before handing everything over")
+        kind = message["kind"]
+        if kind == "server":
+            listener = socks[0]
+            udp_sock = socks[1] if len(socks) > 1 else None
+        elif kind == "game":
+            game = restore_game(message)
+            games[game.game_id] = game
+            stands.open(game, message["room"])
+            if message["queued"]:
+                matchmaker.restore(game, *message["queued"])
+        elif kind == "session":
+            game = games[message["game"]]
+            dropped = message["status"] != "playing"
+            session = sessions.restore(bytes.fromhex(message["token"]), game, message["player_id"], message["name"],
+                                       partial(expire_session, matchmaker) if dropped else None)
+            if message["status"] == "dropped":
+                # Its connection was not handed over, the client will resume
+                game.suspend_player()
+        elif kind == "connection":
+            conn = socks[0]
+            player = Player(send_rate)
+            player.input_seq = message["input_seq"]
+            player.udp_token = message["udp_token"]
+            player.udp_addr = tuple(message["udp_addr"]) if message["udp_addr"] else None
+            reader = protocol.FrameReader(conn)
+            reader.push(base64.b64decode(message["pending"]))
+            session = sessions.sessions.get(bytes.fromhex(message["token"])) if message["token"] else None
+            if session:
+                session.player = player
+            join = tuple(message["join"]) if message["join"] else None
+            connections.append(handoff.Parked(player, conn, reader, session, join))
+        elif kind == "done":
+            break
+    handoff.wait_closed(channel)
+    return Inheritance(listener, udp_sock, matchmaker, sessions, stands, list(games.values()), connections)
+
+def drain(s: socket.socket, matchmaker: Matchmaker, stands: Stands):
+    """
+    Lets the matches in play end without starting new ones, see handoff.py.
+    Returns once every game is over.
+    """
+    print("Draining: no new matches, exiting once the current ones are over")
+    s.close()
+    # Nobody is coming to play the games waiting for an opponent, nor the rematches
+    matchmaker.cancel_where(lambda game: True)
+    for game in list(stands.games):
+        state = game.get_state()
+        if state.active and not state.game_started:
+            game.deactivate()
+        elif state.active and state.winner_id is not None:
+            game.close_rematch_window()
+    while any(game.get_state().active for game in list(stands.games)):
+        time.sleep(handoff.DRAIN_INTERVAL)
+    print("Drained, every match is over")
+
+def run_threaded_server(s: socket.socket, tick_rate: int = TICK_RATE, send_rate: int = SEND_RATE, udp: UdpChannel = None, physics=None,
+                        collision: str = "discrete", handoff_path: str = None, inherited: Inheritance = None):
+    """
+    Accept loop of the threaded engine: two threads per client (reader and
+    snapshot sender) and one game logic thread per game, or a single one
+    for all games with batch physics. Clients are paired by a Matchmaker
+    once they sent their name, on their own thread. Spectators get a reader
+    and a writer thread as well, and each game they watch a broadcast thread.
+    Plays on with what was `inherited` from the previous server process, and
+    with `handoff_path` hands everything over to the next one, see handoff.py.
+    Returns once drained.
+    """
+    if udp:
+        threading.Thread(target=udp_receiver_thread, args=(udp,), daemon=True).start()
+    if physics:
+        threading.Thread(target=batch_logic_thread, args=(physics,), daemon=True).start()
+    
+    if inherited:
+        matchmaker, sessions, stands = inherited.matchmaker, inherited.sessions, inherited.stands
+    else:
+        matchmaker, sessions, stands = Matchmaker(), Sessions(), Stands()
+    metrics.sessions_suspended.function = sessions.suspended
+    metrics.games_unmatched.function = matchmaker.waiting
+    new_game = partial(create_game, tick_rate, physics, collision)
+    
+    # Drains and handoffs wake the accept loop up
+    wakeup, waker = socket.socketpair()
+    handoff.wake = partial(waker.send, b"\0")
+    if handoff_path:
+        handoff.current = handoff.Handoff(handoff_path)
+        handoff.current.listen()
+    
+    if inherited:
+        for game in inherited.games:
+            resume_game(game, physics)
+        for parked in inherited.connections:
+            if udp and parked.player.udp_token:
+                udp.register(parked.player, parked.player.udp_token)
+            threading.Thread(target=client_thread, args=(parked.conn, matchmaker, sessions, stands, new_game,
+                                                         tick_rate, send_rate, udp, parked)).start()
+        print(f"Took over {len(inherited.games)} games and {len(inherited.connections)} players")
+    
+    while True:
+        readable, _, _ = select.select([s, wakeup], [], [])
+        if wakeup in readable:
+            wakeup.recv(64)
+            if handoff.draining:
+                drain(s, matchmaker, stands)
+                return
+            if handoff.handing_over:
+                hand_over(handoff.current, s, udp, matchmaker, sessions, stands, physics)
+            continue
+        conn, addr = s.accept()
+        print(f"New connection from {addr}")
+        
+        # Start client thread
+        client_logic = threading.Thread(target=client_thread, args=(conn, matchmaker, sessions, stands, new_game, tick_rate, send_rate, udp))
+        client_logic.start()
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Pong game server")
+    parser.add_argument("--engine", choices=ENGINES, default="threaded",
+                        help="threaded: one thread per client and per game; "
+                             "asyncio: every client and game on one event loop")
+    parser.add_argument("--tick-rate", type=int, default=TICK_RATE,
+                        help="simulation ticks per second")
+    parser.add_argument("--send-rate", type=int, default=SEND_RATE,
+                        help="snapshots sent to each client per second")
+    parser.add_argument("--udp", action="store_true",
+                        help="also accept inputs and send snapshots over UDP on the same port")
+    parser.add_argument("--physics", choices=PHYSICS, default="per-game",
+                        help="per-game: one logic loop per game; "
+                             "batch: every game stepped together with NumPy")
+    parser.add_argument("--collision", choices=COLLISIONS, default="discrete",
+                        help="discrete: the ball is tested against the rackets where each tick leaves it; "
+                             "swept: along its whole path, with angled bounces (per-game physics only)")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="run the games in this many worker processes behind one "
+                             "accepting front-end (0: everything in this process)")
+    parser.add_argument("--metrics-port", type=int, default=0,
+                        help="serve Prometheus metrics on this local HTTP port (0: off); "
+                             "with --workers, worker i serves its own on this port + 1 + i")
+    parser.add_argument("--record", metavar="DIR",
+                        help="record every match to a file in this directory, see replay.py")
+    parser.add_argument("--ratings", metavar="FILE",
+                        help="rate players by their results and pair them by rating, kept in this SQLite "
+                             "database, see ratings.py")
+    parser.add_argument("--write-timeout", type=float, default=backpressure.WRITE_TIMEOUT, metavar="SECONDS",
+                        help="evict a client that stays too far behind, or whose send blocks, this long (0: never)")
+    parser.add_argument("--read-timeout", type=float, default=backpressure.READ_TIMEOUT, metavar="SECONDS",
+                        help="evict a player that sends nothing for this long (0: never)")
+    parser.add_argument("--message-rate", type=int, default=backpressure.MESSAGE_RATE,
+                        help="messages per second a client may send, faster ones are delayed, "
+                             "or dropped over UDP (0: unlimited)")
+    parser.add_argument("--fixed-send-rate", action="store_true",
+                        help="send every client snapshots at the send rate, instead of adapting it to "
+                             "their link, see qos.py")
+    parser.add_argument("--handoff", metavar="PATH",
+                        help="take the matches and connections over from the server listening on this Unix "
+                             "socket, if one is, then listen on it for the next one (threaded engine only), "
+                             "see handoff.py")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.workers and args.udp:
+        print("--udp is not supported with --workers: datagrams would not reach the worker holding the player")
+        return
+    if args.collision == "swept" and args.physics == "batch":
+        print("--collision swept is not supported with --physics batch: batch physics only tests collisions discretely")
+        return
+    if args.handoff and (args.workers or args.engine != "threaded"):
+        print("--handoff is only supported by the threaded engine, without --workers")
+        return
     load_dotenv()
+    backpressure.configure(args.write_timeout, args.read_timeout, args.message_rate)
+    qos.adaptive = not args.fixed_send_rate
     
     ip_address = os.getenv("SERVER_IP")
     port_number = int(os.getenv("SERVER_PORT"))
     
-    # TCP socket
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM) 
+    # Before any game is created, handed over ones included
+    if args.metrics_port:
+        metrics.enable()
     
-    try:
-        s.bind((ip_address, port_number))
-        s.listen(5) 
-        print(f"Pong game server started at {ip_address}:{port_number}")
-        print("Waiting for connections...")
-    except socket.error as e:
-        print(f"Error starting server: {e}")
-        return
+    if args.record:
+        try:
+            recording.enable(args.record)
+        except OSError as e:
+            print(f"Error opening recordings directory: {e}")
+            return
+        print(f"Recording matches to {args.record}")
+    
+    # The server this one replaces, if it is listening for a successor
+    inherited = None
+    predecessor = handoff.connect(args.handoff) if args.handoff else None
+    if predecessor:
+        print(f"Taking over from the server listening on {args.handoff}")
+        try:
+            inherited = take_over(predecessor, args.send_rate)
+        except (ConnectionError, OSError) as e:
+            print(f"Error taking over: {e}")
+            return
+        s = inherited.listener
+        print(f"Pong game server took over {ip_address}:{port_number} ({args.engine} engine)")
+    else:
+        # TCP socket
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM) 
+        # A server started while a draining one still has connections on the port may bind it
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        
+        try:
+            s.bind((ip_address, port_number))
+            s.listen(128)
+            print(f"Pong game server started at {ip_address}:{port_number} ({args.engine} engine)")
+            print("Waiting for connections...")
+        except socket.error as e:
+            print(f"Error starting server: {e}")
+            return
+    
+    if args.metrics_port:
+        try:
+            metrics.serve(args.metrics_port)
+        except OSError as e:
+            print(f"Error starting metrics server: {e}")
+            s.close()
+            return
+    
+    if args.ratings:
+        try:
+            ratings.enable(args.ratings)
+        except Exception as e:
+            print(f"Error opening ratings database: {e}")
+            s.close()
+            return
+        print(f"Rating players in {args.ratings}")
+    
+    # Optional UDP socket on the same port, for inputs and snapshots
+    udp = None
+    if args.udp and inherited and inherited.udp_sock:
+        udp = UdpChannel(inherited.udp_sock)
+    elif args.udp:
+        u = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            u.bind((ip_address, port_number))
+        except socket.error as e:
+            print(f"Error starting UDP channel: {e}")
+            s.close()
+            return
+        udp = UdpChannel(u)
+        print(f"UDP channel open at {ip_address}:{port_number}")
     
-    # List of games waiting for a second player
-    unmatched_games = list()  
+    physics = None
+    if args.physics == "batch" and not args.workers:
+        import batch_physics
+        physics = batch_physics.BatchPhysics(args.tick_rate)
     
     try:
-        while True:
-            conn, addr = s.accept()
-            print(f"New connection from {addr}")
-            
-            game = None
-            player_id = int()
-
-            # Check if there is a game waiting for a player, otherwise create a new one
-            if len(unmatched_games) > 0:
-                game = unmatched_games.pop()
-                player_id = 1
-                print(f"Adding player to game {game.game_id}")
-            else:
-                # Create a new game
-                game_id = str(randint(1000, 9999))
-                game = Game(game_id)
-                unmatched_games.append(game)
-                player_id = 0
-                print(f"Creating new game {game.game_id}")
-                
-                # Start the game logic (ball movement, physics)
-                game_logic = threading.Thread(target=game_logic_thread, args=(game,))
-                game_logic.start()
-            
-            # Start client thread
-            client_logic = threading.Thread(target=client_thread, args=(conn, game, player_id))
-            client_logic.start()
-            
+        if args.workers:
+            import sharded_server
+            sharded_server.run_sharded_server(s, args.workers, args.engine, args.tick_rate, args.send_rate,
+                                              args.physics, args.metrics_port, args.collision)
+        elif args.engine == "asyncio":
+            import async_server
+            async_server.run(s, args.tick_rate, args.send_rate, udp, physics, args.collision)
+        else:
+            # SIGTERM drains, see handoff.py
+            signal.signal(signal.SIGTERM, handoff.on_sigterm)
+            run_threaded_server(s, args.tick_rate, args.send_rate, udp, physics, args.collision, args.handoff,
+                                inherited)
     except KeyboardInterrupt:
         print("\nServer interrupted by user")
     except Exception as e:
         print(f"Server error: {e}")
     finally:
         s.close()
+        if udp:
+            udp.sock.close()
+        if handoff.current:
+            handoff.current.close()
+        ratings.close()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,121 @@
+"""
+Resume tokens for the Pong server.
+
+Every player gets a random token with MATCHED. When their connection
+drops during a match, the slot is kept for RESUME_GRACE seconds and the
+match is paused; a client connecting again with RESUME(token) takes the
+slot back, with the game where it was. Only once the grace period is over
+does the opponent see them leave.
+
+Tokens start with a prefix chosen by the server (the worker index in
+sharded mode, so the front-end knows where to send a RESUME).
+"""
+
+import secrets
+import threading
+
+import metrics
+import protocol
+
+# Seconds a dropped player's slot is kept for them
+RESUME_GRACE = 20
+
+class Session:
+    """A player's slot in a game, and the connection (Player) holding it, None while suspended"""
+    __slots__ = ("token", "game", "player_id", "player_name", "player", "timer")
+
+    def __init__(self, token: bytes, game, player_id: int, player_name: str, player):
+        self.token = token
+        self.game = game
+        self.player_id = player_id
+        self.player_name = player_name
+        self.player = player
+        # Expiry of the grace period while suspended
+        self.timer = None
+
+class Sessions:
+    """
+    Resumable sessions of the players in a game, by token. Thread-safe;
+    grace periods run on each game's timers.
+    """
+    def __init__(self, grace: float = RESUME_GRACE, prefix: bytes = b""):
+        self.grace = grace
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.sessions = {}
+
+    def issue(self, game, player_id: int, player_name: str, player) -> Session:
+        """New session for a player who just joined a game"""
+        token = self.prefix + secrets.token_bytes(protocol.RESUME_TOKEN_BYTES - len(self.prefix))
+        session = Session(token, game, player_id, player_name, player)
+        with self.lock:
+            self.sessions[token] = session
+        return session
+
+    def restore(self, token: bytes, game, player_id: int, player_name: str, expire=None) -> Session:
+        """
+        Session handed over by the previous server process (see handoff.py),
+        held by no connection yet. With `expire` it is suspended, as by
+        suspend(), with its game already paused.
+        """
+        session = Session(token, game, player_id, player_name, None)
+        with self.lock:
+            self.sessions[token] = session
+            if expire:
+                session.timer = game.timers.call_later(self.grace, self.expire, session, expire)
+        return session
+
+    def suspend(self, session: Session, player, expire) -> bool:
+        """
+        Keeps the slot of a player whose connection dropped and pauses their
+        game. expire(session) is called if nobody resumed it within the grace
+        period. Returns False if another connection took the session over or
+        it was closed.
+        """
+        with self.lock:
+            if self.sessions.get(session.token) is not session or session.player is not player:
+                return False
+            session.player = None
+            session.timer = session.game.timers.call_later(self.grace, self.expire, session, expire)
+            # Paused before a resume can see the session suspended
+            session.game.suspend_player()
+        return True
+
+    def expire(self, session: Session, expire):
+        with self.lock:
+            if session.player is not None or self.sessions.get(session.token) is not session:
+                return
+            del self.sessions[session.token]
+        metrics.sessions_expired.inc()
+        expire(session)
+
+    def resume(self, token: bytes, player):
+        """
+        Hands a session over to a new connection. Returns (session, the
+        Player it was taken from, None if it was suspended), or (None, None)
+        if the token is unknown or its game is over.
+        """
+        with self.lock:
+            session = self.sessions.get(token)
+            if session is None or not session.game.get_state().active:
+                return None, None
+            previous, session.player = session.player, player
+            if session.timer:
+                session.timer.cancel()
+                session.timer = None
+        metrics.sessions_resumed.inc()
+        return session, previous
+
+    def close(self, session: Session, player) -> bool:
+        """Ends a session when its player leaves. False if another connection took it over"""
+        with self.lock:
+            if session.player is not player:
+                return False
+            if self.sessions.get(session.token) is session:
+                del self.sessions[session.token]
+            return True
+
+    def suspended(self) -> int:
+        """Dropped players whose slot is kept"""
+        with self.lock:
+            return sum(session.player is None for session in self.sessions.values())
@@ -0,0 +1,472 @@
+"""
+Sharded mode of the Pong server: one front-end process and N workers.
+
+The front-end owns the listening socket. It accepts connections, runs the
+handshake, pairs them into matches with a Matchmaker and hands both sockets
+of a match to the same worker over a Unix socket (SCM_RIGHTS). Each worker
+is a separate process with its own GIL running the usual engine (threaded
+or asyncio) on the connections it is given, so matches scale with the
+number of cores. A player asking for a new opponent is handed back to the
+front-end the same way, and a worker tells it when a waiting game's only
+player left, so nobody is paired into it. Resume tokens start with the
+index of the worker holding the session, so a RESUME goes straight there.
+A spectator is handed to the worker the room it asks for was last handed
+to, or with no room code to the worker that last started a match, which
+picks its most watched one. Workers report the results of their matches
+to the front-end, which keeps the ratings (see ratings.py).
+
+The front-end also supervises the workers: one that exits is started
+again. Matches running on it are lost, their clients see a disconnect.
+"""
+
+import multiprocessing
+import socket
+import struct
+import threading
+import time
+from collections import OrderedDict
+from random import randint
+from typing import NamedTuple
+
+import metrics
+import protocol
+import ratings
+from functools import partial
+from matchmaking import Matchmaker
+from sessions import Sessions
+from spectators import Stands
+from server import (Game, Player, play_match, resume_match, spectate, shutdown, start_game_logic,
+                    batch_logic_thread, check_hello, read_join)
+
+# Messages on a worker's channel: kind, player ID, lengths of the game ID and
+# room code, then the game ID, room code and player name
+CHANNEL_MESSAGE = struct.Struct("!BBBB")
+# Front-end to worker, with the socket: play this game
+HANDOFF = 1
+# Worker to front-end, with the socket: the player asks for a new opponent
+REQUEUE = 2
+# Worker to front-end: a waiting game's only player left
+CANCEL = 3
+# Front-end to worker, with the socket: resume the session whose token is
+# in the game ID field, in hex
+RESUME = 4
+# Front-end to worker, with the socket: a spectator for the room code given
+SPECTATE = 5
+# Worker to front-end: a match ended, the winner's name in the room code
+# field and the loser's in the name field
+RESULT = 6
+MAX_CHANNEL_MESSAGE = 512
+# Room codes whose worker the front-end remembers for spectators, most recent ones
+MAX_ROOM_ROUTES = 10000
+# How often the supervisor checks its workers, and the minimum time between
+# two starts of the same worker so a crash loop does not spin
+SUPERVISE_INTERVAL = 0.5
+RESTART_DELAY = 1.0
+
+def send_message(channel: socket.socket, kind: int, game_id: str = "", player_id: int = 0,
+                 room: str = "", name: str = "", conn: socket.socket = None):
+    game_id, room, name = game_id.encode(), room.encode(), name.encode()
+    msg = CHANNEL_MESSAGE.pack(kind, player_id, len(game_id), len(room)) + game_id + room + name
+    socket.send_fds(channel, [msg], [conn.fileno()] if conn else [])
+
+def recv_message(channel: socket.socket):
+    """
+    Returns (kind, game_id, player_id, room, name, conn) for the next
+    message, conn being None if no socket came with it, or None once the
+    other end closed the channel.
+    """
+    msg, fds, _, _ = socket.recv_fds(channel, MAX_CHANNEL_MESSAGE, 1)
+    if not msg:
+        return None
+    conn = socket.socket(fileno=fds[0]) if fds else None
+    kind, player_id, id_size, room_size = CHANNEL_MESSAGE.unpack_from(msg)
+    room_start = CHANNEL_MESSAGE.size + id_size
+    name_start = room_start + room_size
+    return (kind, msg[CHANNEL_MESSAGE.size:room_start].decode(), player_id,
+            msg[room_start:name_start].decode(errors="replace"), msg[name_start:].decode(errors="replace"), conn)
+
+class WorkerLobby:
+    """
+    Worker side of matchmaking, the pairing itself is done by the front-end:
+    creates and joins the games it was told to, and reports back games
+    whose player left and players asking for a new opponent.
+    """
+    def __init__(self, channel: socket.socket, tick_rate: int, collision: str = "discrete"):
+        self.channel = channel
+        self.tick_rate = tick_rate
+        self.collision = collision
+        self.lock = threading.Lock()
+        # Games waiting for a second player, by ID
+        self.unmatched_games = dict()
+
+    def join(self, game_id: str, player_id: int):
+        """Returns (game, created), or (None, False) if the game is not waiting here"""
+        with self.lock:
+            if player_id == 0:
+                game = Game(game_id, self.tick_rate, self.collision)
+                self.unmatched_games[game_id] = game
+                print(f"Creating new game {game.game_id}")
+                return game, True
+            game = self.unmatched_games.pop(game_id, None)
+        if game is not None:
+            print(f"Adding player to game {game.game_id}")
+        return game, False
+
+    def cancel(self, game: Game):
+        """Called when a player leaves a game, which may still be waiting"""
+        with self.lock:
+            if self.unmatched_games.get(game.game_id) is not game:
+                return
+            del self.unmatched_games[game.game_id]
+        self.send(CANCEL, game.game_id)
+
+    def report(self, winner: str, loser: str):
+        """Sends a match result to the front-end, which keeps the ratings"""
+        self.send(RESULT, room=winner, name=loser)
+
+    def requeue(self, conn: socket.socket, name: str, room: str):
+        """Hands a player back to the front-end to be matched again, the caller closes its copy"""
+        self.send(REQUEUE, room=room, name=name, conn=conn)
+
+    def send(self, kind: int, game_id: str = "", **fields):
+        try:
+            send_message(self.channel, kind, game_id, **fields)
+        except OSError as e:
+            print(f"Error reaching the front-end: {e}")
+
+    def waiting(self) -> int:
+        return len(self.unmatched_games)
+
+def worker_client_thread(conn: socket.socket, lobby: WorkerLobby, sessions: Sessions, send_rate: int,
+                         match=None, token: bytes = None):
+    """
+    Plays the match a client was handed over for, given as (game, player
+    ID, name), or resumes its session. Hands the client back to the
+    front-end if it then asks for a new opponent.
+    """
+    player = Player(send_rate)
+    player.hangup = partial(shutdown, conn)
+    player_name = match[2] if match else "resumed player"
+    try:
+        reader = protocol.FrameReader(conn)
+        if token is None:
+            session = sessions.issue(*match, player)
+            join = play_match(conn, reader, player, session, lobby, sessions)
+        else:
+            join = resume_match(conn, reader, player, token, lobby, sessions)
+        # The client sends nothing between JOIN and MATCHED, so nothing is left unread
+        if join is not None:
+            lobby.requeue(conn, *join)
+    except Exception as e:
+        print(f"Error in client thread of {player_name}: {e}")
+    metrics.remove_player(player)
+    conn.close()
+
+def worker_spectator_thread(conn: socket.socket, stands: Stands, room: str, send_rate: int):
+    """Streams a match to a spectator the front-end handed over"""
+    try:
+        spectate(conn, protocol.FrameReader(conn), stands, room, send_rate)
+    except Exception as e:
+        print(f"Error in spectator thread: {e}")
+    conn.close()
+
+def run_threaded_worker(channel: socket.socket, sessions: Sessions, tick_rate: int, send_rate: int, physics=None,
+                        collision: str = "discrete"):
+    """Threaded engine fed by the front-end instead of an accept loop"""
+    if physics:
+        threading.Thread(target=batch_logic_thread, args=(physics,), daemon=True).start()
+
+    lobby = WorkerLobby(channel, tick_rate, collision)
+    stands = Stands()
+    metrics.games_unmatched.function = lobby.waiting
+    if ratings.store:
+        # The front-end keeps the ratings
+        ratings.report = lobby.report
+
+    while True:
+        message = recv_message(channel)
+        if message is None:
+            # Front-end gone: take no new players, running matches carry on
+            break
+        kind, game_id, player_id, room, player_name, conn = message
+
+        if kind == RESUME:
+            threading.Thread(target=worker_client_thread,
+                             args=(conn, lobby, sessions, send_rate, None, bytes.fromhex(game_id))).start()
+            continue
+        if kind == SPECTATE:
+            threading.Thread(target=worker_spectator_thread, args=(conn, stands, room, send_rate)).start()
+            continue
+
+        game, created = lobby.join(game_id, player_id)
+        if game is None:
+            # Its first player left meanwhile: back to matchmaking
+            lobby.requeue(conn, player_name, room)
+            conn.close()
+            continue
+        if created:
+            start_game_logic(game, physics)
+            stands.open(game, room)
+
+        client_logic = threading.Thread(target=worker_client_thread,
+                                        args=(conn, lobby, sessions, send_rate, (game, player_id, player_name)))
+        client_logic.start()
+
+def worker_main(index: int, channel: socket.socket, inherited: list, engine: str,
+                tick_rate: int, send_rate: int, physics_kind: str, metrics_port: int, collision: str):
+    # Forked with the front-end's sockets, only the own channel end is ours
+    for sock in inherited:
+        sock.close()
+
+    # Each worker exports its own games and clients, next to the front-end's port
+    if metrics_port:
+        metrics.reset()
+        try:
+            metrics.serve(metrics_port + 1 + index)
+        except OSError as e:
+            print(f"Worker {index}: error starting metrics server: {e}")
+
+    # Tokens tell the front-end which worker holds the session
+    sessions = Sessions(prefix=bytes([index]))
+    metrics.sessions_suspended.function = sessions.suspended
+
+    physics = None
+    if physics_kind == "batch":
+        import batch_physics
+        physics = batch_physics.BatchPhysics(tick_rate)
+
+    print(f"Worker {index} started ({engine} engine)")
+    try:
+        if engine == "asyncio":
+            import async_server
+            async_server.run_worker(channel, sessions, tick_rate, send_rate, physics, collision)
+        else:
+            run_threaded_worker(channel, sessions, tick_rate, send_rate, physics, collision)
+    except KeyboardInterrupt:
+        pass
+
+class Worker:
+    """A worker process and the front-end's end of its handoff channel"""
+    def __init__(self, index: int, process, channel: socket.socket):
+        self.index = index
+        self.process = process
+        self.channel = channel
+        self.started_at = time.monotonic()
+
+class Supervisor:
+    """
+    Starts the workers, restarts the ones that exit and picks the worker
+    each new match goes to. on_start(worker) is called for every worker
+    started.
+    """
+    def __init__(self, s: socket.socket, count: int, engine: str,
+                 tick_rate: int, send_rate: int, physics_kind: str, metrics_port: int = 0, collision: str = "discrete",
+                 on_start=None):
+        self.s = s
+        self.on_start = on_start
+        self.config = (engine, tick_rate, send_rate, physics_kind, metrics_port, collision)
+        # Workers are forked: they inherit their channel end and the loaded modules
+        self.context = multiprocessing.get_context("fork")
+        self.lock = threading.Lock()
+        self.workers = [None] * count
+        self.next_worker = 0
+        self.running = True
+        for index in range(count):
+            self.workers[index] = self.start_worker(index)
+
+    def start_worker(self, index: int) -> Worker:
+        front, back = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        inherited = [self.s, front] + [w.channel for w in self.workers if w]
+        if metrics.server:
+            inherited.append(metrics.server.socket)
+        process = self.context.Process(target=worker_main, name=f"pong-worker-{index}",
+                                       args=(index, back, inherited) + self.config, daemon=True)
+        process.start()
+        back.close()
+        worker = Worker(index, process, front)
+        if self.on_start:
+            self.on_start(worker)
+        return worker
+
+    def supervise(self):
+        """Restarts workers that exited, until stop()"""
+        while self.running:
+            time.sleep(SUPERVISE_INTERVAL)
+            with self.lock:
+                for index, worker in enumerate(self.workers):
+                    if not self.running or worker.process.is_alive():
+                        continue
+                    if time.monotonic() - worker.started_at < RESTART_DELAY:
+                        continue
+                    print(f"Worker {index} exited with code {worker.process.exitcode}, restarting")
+                    worker.channel.close()
+                    self.workers[index] = self.start_worker(index)
+
+    def worker(self, index: int) -> Worker:
+        """The worker at `index` if it is running, else None"""
+        with self.lock:
+            if index < len(self.workers) and self.workers[index].process.is_alive():
+                return self.workers[index]
+        return None
+
+    def pick_worker(self) -> Worker:
+        """Round-robin over the live workers, None if every one is down"""
+        with self.lock:
+            for _ in range(len(self.workers)):
+                worker = self.workers[self.next_worker]
+                self.next_worker = (self.next_worker + 1) % len(self.workers)
+                if worker.process.is_alive():
+                    return worker
+        return None
+
+    def stop(self):
+        with self.lock:
+            self.running = False
+            for worker in self.workers:
+                worker.channel.close()
+                worker.process.terminate()
+        for worker in self.workers:
+            worker.process.join(timeout=2)
+            if worker.process.is_alive():
+                worker.process.kill()
+
+class RemoteGame(NamedTuple):
+    """A game the front-end handed to a worker, as queued by its Matchmaker"""
+    worker: Worker
+    game_id: str
+
+class FrontEnd:
+    """
+    Handshakes and matchmaking of the sharded server: each connection is
+    paired, then handed to the worker of its game.
+    """
+    def __init__(self, s: socket.socket, workers: int, engine: str, tick_rate: int, send_rate: int,
+                 physics_kind: str, metrics_port: int = 0, collision: str = "discrete"):
+        self.tick_rate = tick_rate
+        self.matchmaker = Matchmaker()
+        metrics.games_unmatched.function = self.matchmaker.waiting
+        # Room code -> worker its last game went to, for spectators
+        self.rooms = OrderedDict()
+        self.rooms_lock = threading.Lock()
+        # Worker of the last match that started, for spectators with no room code
+        self.last_match = None
+        self.supervisor = Supervisor(s, workers, engine, tick_rate, send_rate, physics_kind, metrics_port, collision,
+                                     on_start=self.listen)
+
+    def handshake(self, conn: socket.socket):
+        """Thread that checks the client's version and reads its name, then queues it or resumes its session"""
+        try:
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            reader = protocol.FrameReader(conn)
+            try:
+                check_hello(*reader.read_frame())
+            except protocol.ProtocolError:
+                conn.sendall(protocol.pack_reject())
+                raise
+            conn.sendall(protocol.pack_welcome(self.tick_rate))
+            msg_type, payload = reader.read_frame()
+            # Whatever is buffered here would be lost in the handoff
+            if reader.buffered():
+                raise protocol.ProtocolError("Data sent before being matched")
+            if msg_type == protocol.MSG_RESUME:
+                self.resume(conn, protocol.unpack_resume(payload))
+            elif msg_type == protocol.MSG_SPECTATE:
+                self.spectate(conn, protocol.unpack_spectate(payload))
+            else:
+                self.queue(conn, *read_join(msg_type, payload))
+        except Exception as e:
+            print(f"Error in handshake: {e}")
+        # The worker holds its own copy of the socket now
+        conn.close()
+
+    def queue(self, conn: socket.socket, player_name: str, room: str):
+        """Pairs a player and hands its socket to the worker of its game, the caller closes its copy"""
+        # Where the game goes, if the player has to wait for an opponent
+        worker = self.supervisor.pick_worker()
+        if worker is None:
+            print("No worker available, dropping connection")
+            return
+        game, player_id = self.matchmaker.join(lambda: RemoteGame(worker, str(randint(1000, 9999))),
+                                               ratings.rating(player_name), room)
+        if player_id == 1:
+            self.last_match = game.worker
+        elif room:
+            with self.rooms_lock:
+                self.rooms[room] = game.worker
+                self.rooms.move_to_end(room)
+                if len(self.rooms) > MAX_ROOM_ROUTES:
+                    self.rooms.popitem(last=False)
+        try:
+            send_message(game.worker.channel, HANDOFF, game.game_id, player_id, room, player_name, conn)
+            print(f"Game {game.game_id}, Player {player_id+1} handed to worker {game.worker.index}")
+        except OSError as e:
+            print(f"Error handing connection to worker {game.worker.index}: {e}")
+            self.matchmaker.cancel_where(lambda queued: queued.worker is game.worker)
+
+    def resume(self, conn: socket.socket, token: bytes):
+        """Hands a reconnecting player to the worker holding its session, the caller closes its copy"""
+        worker = self.supervisor.worker(token[0])
+        if worker is None:
+            # Restarted or gone, and its sessions with it
+            conn.sendall(protocol.pack_resume_failed())
+            return
+        send_message(worker.channel, RESUME, token.hex(), conn=conn)
+        print(f"Resumed session handed to worker {worker.index}")
+
+    def spectate(self, conn: socket.socket, room: str):
+        """Hands a spectator to the worker of the room's game, the caller closes its copy"""
+        if room:
+            with self.rooms_lock:
+                worker = self.rooms.get(room)
+        else:
+            worker = self.last_match
+        # Restarted since, its games are gone
+        if worker is not None and self.supervisor.worker(worker.index) is not worker:
+            worker = None
+        if worker is None:
+            conn.sendall(protocol.pack_no_match())
+            return
+        send_message(worker.channel, SPECTATE, room=room, conn=conn)
+        print(f"Spectator handed to worker {worker.index}")
+
+    def listen(self, worker: Worker):
+        threading.Thread(target=self.listen_worker, args=(worker,), daemon=True).start()
+
+    def listen_worker(self, worker: Worker):
+        """Thread reading a worker's channel: games whose player left, players handed back and match results"""
+        while True:
+            try:
+                message = recv_message(worker.channel)
+            except OSError:
+                message = None
+            if message is None:
+                break
+            kind, game_id, _, room, player_name, conn = message
+            if kind == CANCEL:
+                self.matchmaker.cancel(RemoteGame(worker, game_id))
+            elif kind == REQUEUE and conn:
+                metrics.matchmaking_requeues.inc()
+                self.queue(conn, player_name, room)
+            elif kind == RESULT and ratings.store:
+                ratings.store.record(room, player_name)
+            if conn:
+                conn.close()
+        # The worker is gone, its waiting games with it
+        self.matchmaker.cancel_where(lambda queued: queued.worker is worker)
+
+def run_sharded_server(s: socket.socket, workers: int, engine: str, tick_rate: int, send_rate: int,
+                       physics_kind: str, metrics_port: int = 0, collision: str = "discrete"):
+    """
+    Accept loop of the front-end. Each connection gets a handshake thread
+    that pairs it and hands it to the worker running its match.
+    """
+    frontend = FrontEnd(s, workers, engine, tick_rate, send_rate, physics_kind, metrics_port, collision)
+    threading.Thread(target=frontend.supervisor.supervise, daemon=True).start()
+
+    try:
+        while True:
+            conn, addr = s.accept()
+            print(f"New connection from {addr}")
+            threading.Thread(target=frontend.handshake, args=(conn,), daemon=True).start()
+    finally:
+        frontend.supervisor.stop()
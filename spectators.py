@@ -0,0 +1,212 @@
+"""
+Spectators for the Pong server.
+
+A spectator watches a match read-only. Every game being watched has a
+Broadcast: at the send rate its driver (a thread or a task, depending on
+the engine) encodes the game's latest snapshot once, as a delta against
+the snapshot broadcast before it, and queues the same bytes for every
+spectator. Encoding costs the same for one spectator or hundreds, each
+spectator only adds a copy into its socket.
+
+Each spectator has a bounded queue, drained by its own writer, and the
+broadcast never waits for it. A spectator whose queue is full has it
+dropped and gets the next snapshot as a keyframe (encoded once as well,
+and only on ticks where some spectator needs one), so a slow connection
+only ever costs itself frames and never holds back the game or the
+other spectators.
+
+Stands finds the game a spectator asked for: a private room by its code,
+or else the match in play with the most spectators.
+"""
+
+import threading
+import weakref
+from collections import deque
+
+import metrics
+import protocol
+
+# Frames queued for a spectator before it counts as behind
+SPECTATOR_QUEUE = 8
+
+class Spectator:
+    """
+    A spectator as its game's broadcast sees it: frames queued for its
+    writer, which `wake()` tells about new ones. `closed` is set once the
+    game closed, after the last frame was queued.
+    """
+    def __init__(self, wake):
+        self.wake = wake
+        self.frames = deque()
+        self.lock = threading.Lock()
+        # The last frame queued was kept (queued or taken), so a delta may follow it
+        self.synced = False
+        self.closed = False
+
+    def behind(self) -> bool:
+        """Whether the next frame queued has to be a keyframe"""
+        return not self.synced or len(self.frames) >= SPECTATOR_QUEUE
+
+    def push(self, delta: bytes, keyframe: bytes):
+        """Queues the latest snapshot, as a keyframe if behind(). Called by the broadcast only"""
+        with self.lock:
+            if len(self.frames) >= SPECTATOR_QUEUE:
+                # Too slow: skip what it did not send yet and start over from a keyframe
+                metrics.spectator_frames_dropped.inc(len(self.frames))
+                self.frames.clear()
+                self.synced = False
+            # The writer was already told about frames it did not take yet
+            wake = not self.frames
+            self.frames.append(delta if self.synced else keyframe)
+            self.synced = True
+        if wake:
+            self.wake()
+
+    def take(self) -> list:
+        """Every frame queued since the last call, oldest first, for one write"""
+        with self.lock:
+            frames = list(self.frames)
+            self.frames.clear()
+        return frames
+
+    def close(self):
+        self.closed = True
+        self.wake()
+
+class Broadcast:
+    """
+    The spectators of one game. Its driver calls publish() at the send rate
+    until finished() says to stop; add() tells whether a driver has to be
+    started.
+    """
+    def __init__(self, game):
+        self.game = game
+        # Replaced rather than changed, so publish() reads it without the lock
+        self.spectators = ()
+        self.lock = threading.Lock()
+        self.running = False
+        self.seq = protocol.NO_SNAPSHOT
+        self.last_state = None
+        # Wakes the driver while it sleeps on an idle game, see park()
+        self.wake = None
+
+    def add(self, spectator: Spectator) -> bool:
+        """Adds a spectator. Returns True if the caller has to start the driver"""
+        with self.lock:
+            self.spectators += (spectator,)
+            metrics.spectators.inc()
+            start = not self.running
+            self.running = True
+            # The newcomer needs the state the game is at, changed or not
+            self.last_state = None
+            wake, self.wake = self.wake, None
+        if wake:
+            wake()
+        return start
+
+    def park(self, wake, version: int) -> bool:
+        """
+        Lets the driver sleep while the game is idle: `wake` is called when
+        the game changes (see Game.watch) or a spectator joins. Returns
+        False, without registering it, if either already happened.
+        """
+        with self.lock:
+            if self.last_state is None:
+                return False
+            self.wake = wake
+        if self.game.watch(wake, version):
+            return True
+        with self.lock:
+            self.wake = None
+        return False
+
+    def remove(self, spectator: Spectator):
+        with self.lock:
+            if spectator in self.spectators:
+                self.spectators = tuple(s for s in self.spectators if s is not spectator)
+                metrics.spectators.dec()
+
+    def publish(self) -> bool:
+        """
+        Encodes the game's latest snapshot, if it changed since the last
+        one, and queues it for every spectator. Returns whether it did.
+        """
+        state = self.game.get_state()
+        if state == self.last_state:
+            return False
+        self.last_state = state
+        spectators = self.spectators
+        seq, tick, fields, base_fields = self.game.snapshot(self.seq)
+        delta = keyframe = None
+        if base_fields is not None:
+            delta = protocol.pack_snapshot(seq, tick, protocol.NO_INPUT, fields, self.seq, base_fields)
+        if delta is None or any(spectator.behind() for spectator in spectators):
+            keyframe = protocol.pack_snapshot(seq, tick, protocol.NO_INPUT, fields)
+        metrics.spectator_frames_encoded.inc((delta is not None) + (keyframe is not None))
+        for spectator in spectators:
+            spectator.push(delta or keyframe, keyframe)
+        self.seq = seq
+        return True
+
+    def finished(self) -> bool:
+        """
+        Whether the driver is done: nobody watches any more, or the game
+        closed, in which case its spectators get the final state and are
+        closed. A later add() starts a new driver.
+        """
+        with self.lock:
+            ended = not self.game.get_state().active
+            if self.spectators and not ended:
+                return False
+            if ended:
+                self.publish()
+                for spectator in self.spectators:
+                    spectator.close()
+                metrics.spectators.dec(len(self.spectators))
+                self.spectators = ()
+            self.running = False
+            return True
+
+class Stands:
+    """
+    Games spectators may watch: every game of this process, and private
+    rooms by their code. Thread-safe. Games are held weakly and closed ones
+    are skipped, so nothing has to be unregistered.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.games = weakref.WeakSet()
+        self.rooms = weakref.WeakValueDictionary()
+
+    def open(self, game, room: str = ""):
+        """Makes a new game watchable, by its room code if it has one"""
+        with self.lock:
+            self.games.add(game)
+            if room:
+                self.rooms[room] = game
+
+    def find(self, room: str = ""):
+        """The game of `room`, or with no code the active game with the most spectators. None if there is none"""
+        with self.lock:
+            if room:
+                games = [self.rooms.get(room)]
+            else:
+                games = list(self.games)
+        games = [game for game in games if game is not None and game.get_state().active]
+        return max(games, default=None,
+                   key=lambda game: (len(game.broadcast.spectators) if game.broadcast else 0,
+                                     game.get_state().game_started))
+
+    def watch(self, game, spectator: Spectator):
+        """
+        Adds a spectator to the game's broadcast. Returns (broadcast, True
+        if the caller has to start its driver), or (None, False) if the game
+        closed meanwhile.
+        """
+        with self.lock:
+            if not game.get_state().active:
+                return None, False
+            if game.broadcast is None:
+                game.broadcast = Broadcast(game)
+            broadcast = game.broadcast
+        return broadcast, broadcast.add(spectator)